@@ -0,0 +1,347 @@
+"""
+**Datalog** is the subset of logic programming without function symbols:
+the arguments of every relation are atoms or variables, never other
+relations.  Family trees, graphs, and most other databases of facts and the
+rules relating them fit in this subset.
+
+Our [logic programming library](logic.html) proves goals *top-down*, starting
+from a goal and working backwards through the rules that might prove it.
+Without function symbols there are only finitely many facts that could
+possibly be proved, so we can instead work *bottom-up*: start from the facts,
+apply the rules to derive every fact that follows from them, and keep going
+until nothing new can be derived.  The result is a *model* of the database,
+and any query can then be answered by simply looking up the facts in it.
+Computing the model takes time polynomial in the size of the database, and
+rules that would send a top-down prover into an infinite loop, such as
+
+    ancestor(?x, ?y) :- ancestor(?x, ?z), ancestor(?z, ?y)
+
+are no trouble at all.
+
+This module computes the model of a database built with `paip.logic`.  For
+example, with the [family tree](examples/prolog/family.prolog) database:
+
+    model = datalog.evaluate(db)
+    for solution in model.solve([logic.Relation('ancestor', (x, y))]):
+        print solution[x], solution[y]
+
+This implementation follows the presentation of semi-naive evaluation in
+chapter 13 of "Foundations of Databases" by Abiteboul, Hull, and Vianu.
+"""
+
+# -----------------------------------------------------------------------------
+## Table of contents
+
+# 1. [The Datalog fragment](#fragment)
+# 2. [Fact tables](#tables)
+# 3. [Joins](#joins)
+# 4. [Semi-naive evaluation](#evaluation)
+# 5. [Querying the model](#querying)
+
+
+# -----------------------------------------------------------------------------
+# <a id="fragment"></a>
+## The Datalog fragment
+
+# Before evaluating a database bottom-up we must make sure it is within the
+# Datalog fragment.  Besides having no function symbols, every clause must be
+# *safe*: each variable in its head must also appear in its body.  Otherwise a
+# fact like `likes(?x, ?x)` would state that infinitely many facts hold, one
+# for every possible atom, which we can't list.  Python procedures stored in
+# the database can't be evaluated bottom-up either.
+
+class NotDatalog(Exception):
+    def __init__(self, err):
+        self.err = err
+
+    def __str__(self):
+        return 'Not Datalog: %s' % self.err
+
+
+def check(db):
+    """Raise NotDatalog unless every clause in db is safe and function-free."""
+    for pred, clauses in db.items():
+        if not isinstance(clauses, (list, logic.FactTable)):
+            raise NotDatalog('%s is a Python procedure' % pred)
+        for clause in clauses:
+            check_clause(clause)
+            for relation in clause.body:
+                if relation.pred in logic.BUILTINS and relation.pred not in db:
+                    raise NotDatalog('%s is a built-in in %s' %
+                                     (relation.pred, clause))
+
+def check_clause(clause):
+    for relation in [clause.head] + list(clause.body):
+        if not isinstance(relation, logic.Relation):
+            raise NotDatalog('%s is not a relation in %s' % (relation, clause))
+        if relation.pred in logic.CONTROL and relation is not clause.head:
+            raise NotDatalog('%s is a control construct in %s' %
+                             (relation, clause))
+        for arg in relation.args:
+            if not isinstance(arg, (logic.Atom, logic.Var)):
+                raise NotDatalog('%s has a function symbol in %s' %
+                                 (arg, clause))
+    body_vars = set()
+    for relation in clause.body:
+        body_vars.update(relation.get_vars())
+    for var in clause.head.get_vars():
+        if var not in body_vars:
+            raise NotDatalog('%s appears only in the head of %s' %
+                             (var, clause))
+
+
+# -----------------------------------------------------------------------------
+# <a id="tables"></a>
+## Fact tables
+
+# Since every fact we derive is ground, we don't need Relations and Atoms to
+# represent them.  A fact is stored as a tuple of the values of its atoms, and
+# the facts of each predicate are stored in a set.
+#
+# Applying a rule means finding combinations of facts that agree on the values
+# of the rule's variables.  To find, say, the `parent` facts whose first value
+# is `james1` without scanning all of them, a table keeps *hash indexes* on the
+# combinations of columns that are looked up, built the first time each is
+# needed.
+
+class Table(object):
+
+    """A set of ground facts of a single predicate, with hash indexes."""
+
+    def __init__(self, rows=()):
+        self.rows = set()
+        self.indexes = {}
+        for row in rows:
+            self.add(row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __contains__(self, row):
+        return row in self.rows
+
+    def add(self, row):
+        """Add a fact, returning whether it is new."""
+        if row in self.rows:
+            return False
+        self.rows.add(row)
+        for columns, index in self.indexes.iteritems():
+            if len(row) > columns[-1]:
+                key = tuple(row[i] for i in columns)
+                index.setdefault(key, []).append(row)
+        return True
+
+    def lookup(self, columns, key):
+        """Return the facts whose values in columns are those in key."""
+        if not columns:
+            return self.rows
+        index = self.indexes.get(columns)
+        if index is None:
+            index = self.indexes[columns] = {}
+            for row in self.rows:
+                if len(row) > columns[-1]:
+                    row_key = tuple(row[i] for i in columns)
+                    index.setdefault(row_key, []).append(row)
+        return index.get(key, ())
+
+
+# -----------------------------------------------------------------------------
+# <a id="joins"></a>
+## Joins
+
+# To apply a rule, we find every way of matching its body relations against
+# facts, from left to right.  A partial match is a list holding a value for
+# each of the rule's variables, or None for those not yet matched.  Matching
+# the next body relation against a table is a *join*: we look up the facts
+# whose values agree with the constants and already-matched variables in the
+# relation, and extend the match with the values of its other variables.
+#
+# Which variables are matched at each step is known in advance, so each body
+# relation is compiled once into a `Pattern` describing the lookup.
+
+class Pattern(object):
+
+    """How to match a relation against a table, given the variables before."""
+
+    def __init__(self, relation, slots, matched):
+        """
+        Compile relation, where slots maps each variable to its position in a
+        match and matched is the set of variables already matched.  Variables
+        of relation are added to matched.
+        """
+        self.pred = relation.pred
+        self.arity = len(relation.args)
+        columns = []
+        self.key = [] # (is_slot, constant or slot) for each column looked up
+        self.binds = [] # (column, slot) for each variable first matched here
+        self.same = [] # (column, column) pairs for repeated new variables
+        first = {}
+        for i, arg in enumerate(relation.args):
+            if isinstance(arg, logic.Atom):
+                columns.append(i)
+                self.key.append((False, arg.atom))
+            elif arg in matched:
+                columns.append(i)
+                self.key.append((True, slots[arg]))
+            elif arg in first:
+                self.same.append((first[arg], i))
+            else:
+                first[arg] = i
+                self.binds.append((i, slots[arg]))
+        self.columns = tuple(columns)
+        matched.update(first)
+
+    def join(self, matches, table):
+        """Extend each match with the facts in table that agree with it."""
+        extended = []
+        for match in matches:
+            key = tuple(match[x] if is_slot else x for is_slot, x in self.key)
+            for row in table.lookup(self.columns, key):
+                if len(row) != self.arity:
+                    continue
+                if any(row[i] != row[j] for i, j in self.same):
+                    continue
+                new = list(match)
+                for i, slot in self.binds:
+                    new[slot] = row[i]
+                extended.append(new)
+        return extended
+
+
+class Rule(object):
+
+    """A rule of the database, compiled for joining."""
+
+    def __init__(self, clause):
+        self.clause = clause
+        self.slots = dict((v, i) for i, v in enumerate(clause.get_vars()))
+        matched = set()
+        self.body = [Pattern(r, self.slots, matched) for r in clause.body]
+        self.pred = clause.head.pred
+        self.head = [(True, self.slots[arg]) if isinstance(arg, logic.Var)
+                     else (False, arg.atom) for arg in clause.head.args]
+
+    def apply(self, tables, delta, i):
+        """
+        Generate the head facts derived by matching the ith body relation
+        against delta and the rest against tables.
+        """
+        matches = [[None] * len(self.slots)]
+        for j, pattern in enumerate(self.body):
+            table = delta if j == i else tables
+            matches = pattern.join(matches, table.get(pattern.pred, EMPTY))
+            if not matches:
+                return
+        for match in matches:
+            yield tuple(match[x] if is_slot else x for is_slot, x in self.head)
+
+
+EMPTY = Table()
+
+
+# -----------------------------------------------------------------------------
+# <a id="evaluation"></a>
+## Semi-naive evaluation
+
+# The simplest way to compute the model is *naive* evaluation: apply every
+# rule to all the facts known so far, add the facts derived, and repeat until
+# a round derives nothing new.  But each round derives again every fact
+# derived in the rounds before it.
+#
+# *Semi-naive* evaluation avoids most of this repeated work.  A fact derived
+# in some round can only lead to a new fact if at least one of the facts it
+# was derived from is itself new, that is, was derived in the round before.
+# So each round we only apply a rule with one of its body relations matched
+# against the facts new in the last round (the *delta*), once for each body
+# relation, and the others against all the facts.  Initially every fact in
+# the database is new.
+
+def evaluate(db):
+    """Compute the model of db, raising NotDatalog if it isn't Datalog."""
+    check(db)
+    tables = {}
+    rules = []
+    for pred, clauses in db.items():
+        tables.setdefault(pred, Table())
+        for clause in clauses:
+            if clause.body:
+                rules.append(Rule(clause))
+            else:
+                tables[pred].add(tuple(arg.atom for arg in clause.head.args))
+
+    delta = dict((pred, Table(table)) for pred, table in tables.items())
+    while delta:
+        new = {}
+        for rule in rules:
+            for i, pattern in enumerate(rule.body):
+                if pattern.pred not in delta:
+                    continue
+                for row in rule.apply(tables, delta, i):
+                    if row not in tables[rule.pred]:
+                        new.setdefault(rule.pred, Table()).add(row)
+        for pred, table in new.items():
+            for row in table:
+                tables[pred].add(row)
+        delta = new
+
+    logging.debug('Computed model with %d facts',
+                  sum(len(table) for table in tables.values()))
+    return Model(tables)
+
+
+# -----------------------------------------------------------------------------
+# <a id="querying"></a>
+## Querying the model
+
+# Once we have the model, answering a query is just another join, this time
+# of the goal relations against the tables of the model.
+
+class Model(object):
+
+    """All the facts that follow from a Datalog database."""
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def facts(self, pred):
+        """Return the facts of pred as a list of Relations."""
+        return [logic.Relation(pred, [logic.Atom(x) for x in row])
+                for row in self.tables.get(pred, EMPTY)]
+
+    def solve(self, goals):
+        """
+        Generate a dictionary of the variables in goals and their values for
+        each solution of goals, as `logic.solve` does.
+        """
+        if isinstance(goals, logic.Relation):
+            goals = [goals]
+        for goal in goals:
+            for arg in goal.args:
+                if not isinstance(arg, (logic.Atom, logic.Var)):
+                    raise NotDatalog('%s has a function symbol in %s' %
+                                     (arg, goal))
+        vars = logic.query_vars(goals)
+        slots = dict((v, i) for i, v in enumerate(vars))
+        matched = set()
+        matches = [[None] * len(vars)]
+        for goal in goals:
+            pattern = Pattern(goal, slots, matched)
+            matches = pattern.join(matches, self.tables.get(goal.pred, EMPTY))
+        for match in matches:
+            yield dict((var, logic.Atom(match[slots[var]])) for var in vars)
+
+    def to_db(self):
+        """Return a logic database with the facts of the model."""
+        db = {}
+        for pred in self.tables:
+            logic.retrieve(db, pred)
+            for fact in self.facts(pred):
+                logic.store(db, logic.Clause(fact))
+        return db
+
+
+import logging
+from paip import logic
@@ -8,14 +8,16 @@ def main():
     a = logic.Var('a')
     nil = logic.Atom('nil')
     more = logic.Var('more')
-    zero = logic.Atom('0')
+    zero = logic.Atom(0)
+    one = logic.Atom(1)
+    n = logic.Var('n')
 
+    # The length of a list is computed with the `is` built-in.
     length_nil = logic.Clause(logic.Relation('length', (nil, zero)))
     length_one = logic.Clause(
-        logic.Relation('length',
-                       (logic.Relation('pair', (x, more)),
-                        logic.Relation('+1', [a]))),
-        [logic.Relation('length', (more, a))])
+        logic.Relation('length', (logic.Relation('pair', (x, more)), a)),
+        [logic.Relation('length', (more, n)),
+         logic.Relation('is', (a, logic.Relation('+', (n, one))))])
 
     db = {}
     logic.store(db, length_nil)
@@ -101,6 +101,8 @@ This implementation is inspired by chapter 11 of "Paradigms of Artificial
 Intelligence Programming" by Peter Norvig.
 """
 
+import weakref
+
 # ----------------------------------------------------------------------------
 ## Table of contents
 
@@ -108,6 +110,12 @@ Intelligence Programming" by Peter Norvig.
 # 2. [Uniform database](#database)
 # 3. [Unification](#unification)
 # 4. [Goal proving](#proving)
+# 5. [Built-in predicates](#builtins)
+# 6. [Tabling](#tabling)
+# 7. [Profiling](#profiling)
+# 8. [Tracing](#tracing)
+# 9. [Budgets](#budgets)
+# 10. [Caching answers](#caching)
 
 
 # ----------------------------------------------------------------------------
@@ -120,6 +128,7 @@ Intelligence Programming" by Peter Norvig.
 # - *variables*, which represent undetermined atoms and relations;
 # - *relations*, which define relationships between atoms, variables, and
 #   other relations;
+# - *lists* of atoms, variables, relations and other lists;
 # - *clauses*, which represent facts and rules stored in the database.
 
 # We want each instance of these types to support a few common operations that
@@ -136,15 +145,44 @@ Intelligence Programming" by Peter Norvig.
 class Atom(object):
 
     """Represents any literal (symbol, number, string, etc)."""
-    
-    def __init__(self, atom):
-        self.atom = atom
-        
+
+    # A program mentions the same few atoms over and over, so each one is
+    # *interned*: creating an Atom equal to one that already exists returns the
+    # existing one, and equal atoms are usually the same object.  (Only usually,
+    # since `1` and `1.0` are equal but print differently.)  Atoms no longer
+    # used anywhere are forgotten.  Like the other terms, Atoms have no
+    # per-instance dictionary, just the slots listed.
+    __slots__ = ('atom', '__weakref__')
+    interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, atom):
+        try:
+            key = (type(atom), atom)
+            self = Atom.interned.get(key)
+        except TypeError: # an unhashable value can't be interned
+            key = self = None
+        if self is None:
+            self = object.__new__(cls)
+            self.atom = atom
+            if key is not None:
+                Atom.interned[key] = self
+        return self
+
+    def __reduce__(self):
+        return (Atom, (self.atom,))
+
     def __repr__(self):
         return str(self.atom)
 
     def __eq__(self, other):
-        return isinstance(other, Atom) and other.atom == self.atom
+        return self is other or (isinstance(other, Atom)
+                                 and other.atom == self.atom)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.atom)
 
     # These don't need to do anything for Atoms, since they don't contain Vars.
     def rename_vars(self, replacements): return self
@@ -155,6 +193,8 @@ class Var(object):
 
     """Represents a logic variable."""
 
+    __slots__ = ('var',)
+
     counter = 0 # for generating unused variables
     @staticmethod
     def get_unused_var():
@@ -168,13 +208,19 @@ class Var(object):
     
     def __init__(self, var):
         self.var = var
-        
+
+    def __reduce__(self):
+        return (Var, (self.var,))
+
     def __repr__(self):
         return '?%s' % str(self.var)
 
     def __eq__(self, other):
         return isinstance(other, Var) and other.var == self.var
 
+    def __ne__(self, other):
+        return not self == other
+
     def __hash__(self):
         return hash(self.var)
 
@@ -198,16 +244,11 @@ class Var(object):
         #    terminal Atom in a transitive binding
         # 3. That we don't go in a circle (eg, x->y and y->x)
 
-        encountered = [self, binding]
-        while (isinstance(binding, Var)
-               and binding in bindings
-               and bindings[binding] not in encountered):
-            binding = bindings.get(binding)
-            encountered.append(binding)
+        binding = chase(self, bindings)
 
-        # If the next binding leads to a relation, expand it.
-        if isinstance(binding, Relation):
-            return binding.bind_vars(bindings)
+        # If the next binding leads to a relation or list, expand it.
+        if isinstance(binding, (Relation, List)):
+            return bind_term(binding, bindings)
 
         return binding
     
@@ -223,28 +264,94 @@ class Var(object):
 class Relation(object):
 
     """A relationship (specified by a predicate) that holds between terms."""
-    
-    def __init__(self, pred, args):
+
+    # The arguments of a relation are kept in a tuple, and a relation with no
+    # variables anywhere in it is *ground*.  Ground relations are interned just
+    # like atoms, so two ground relations are equal exactly when they are the
+    # same object, and a database of facts shares every repeated subterm.
+    # Their hash is computed once, when they are created.  Other relations
+    # hash by identity, as they always have: hashing their structure would
+    # recurse through arbitrarily deep terms.
+    __slots__ = ('pred', 'args', 'ground', 'hash', '__weakref__')
+    interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, pred, args):
+        if isinstance(args, list):
+            args = tuple(args)
+        ground = isinstance(args, tuple)
+        for arg in args:
+            kind = type(arg)
+            if not (kind is Atom or (kind is Relation or kind is List)
+                    and arg.ground):
+                ground = False
+                break
+        if ground:
+            # Keyed like atoms, so that f(1) and f(1.0) stay different.
+            try:
+                key = (pred, tuple([symbol_key(arg) for arg in args]))
+                self = Relation.interned.get(key)
+            except TypeError: # an atom with an unhashable value
+                self = None
+                ground = False
+            if self is not None:
+                return self
+        self = object.__new__(cls)
         self.pred = pred
         self.args = args
-        
+        self.ground = ground
+        self.hash = None
+        if ground:
+            self.hash = hash(key)
+            Relation.interned[key] = self
+        return self
+
+    def __reduce__(self):
+        return (Relation, (self.pred, self.args))
+
     def __repr__(self):
+        # Relations without arguments and control constructs (see below) are
+        # written as in Prolog.
+        if not self.args:
+            return str(self.pred)
+        if self.pred in (',', ';', '->', ':-') and len(self.args) == 2:
+            return '(%s%s %s)' % (self.args[0], ' ' * (self.pred != ',') +
+                                  self.pred, self.args[1])
+        if self.pred == '\\+' and len(self.args) == 1:
+            return '\\+ %s' % self.args[0]
+        # So are arithmetic (see below).
+        if self.pred in INFIX and len(self.args) == 2:
+            form = '%s %s %s' if INFIX[self.pred] else '(%s %s %s)'
+            return form % (self.args[0], self.pred, self.args[1])
+        if self.pred == '-' and len(self.args) == 1:
+            return '-%s' % self.args[0]
         return '%s(%s)' % (self.pred, ', '.join(map(str, self.args)))
 
     def __eq__(self, other):
-        return (isinstance(other, Relation)
-                and self.pred == other.pred
-                and list(self.args) == list(other.args))
+        if self is other:
+            return True
+        if not isinstance(other, Relation) or self.ground and other.ground:
+            return False
+        if type(self.args) is not type(other.args):
+            return (self.pred == other.pred
+                    and list(self.args) == list(other.args))
+        return self.pred == other.pred and self.args == other.args
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self.hash is None:
+            return object.__hash__(self)
+        return self.hash
 
     def bind_vars(self, bindings):
         """Replace each Var in this relation with its bound term."""
-        bound = []
-        for arg in self.args:
-            bound.append(arg.lookup(bindings) if arg in bindings else arg)
-        return Relation(self.pred, bound)
+        return bind_term(self, bindings)
 
     def rename_vars(self, replacements):
         """Recursively rename each Var in this relation."""
+        if self.ground:
+            return self
         renamed = []
         for arg in self.args:
             renamed.append(arg.rename_vars(replacements))
@@ -252,10 +359,223 @@ class Relation(object):
 
     def get_vars(self):
         """Return all Vars in this relation."""
-        vars = []
-        for arg in self.args:
-            vars.extend(v for v in arg.get_vars() if v not in vars)
-        return vars
+        if self.ground:
+            return []
+        return term_vars([self])
+
+
+# ----------------------------------------------------------------------------
+
+# Lists could be built from relations, as `pair(a, pair(b, nil))`, but then
+# finding the length of a list or its nth element means walking it one pair
+# at a time, and every step of a proof that renames or instantiates it
+# rebuilds every pair.  Instead, a `List` keeps its elements in a tuple,
+# followed by a *tail*: the empty list `[]` (the atom `NIL`) for a proper
+# list, or a variable for a list whose end is not yet known.  We write lists
+# as in Prolog, `[a, b]` for a proper list and `[a, b | ?t]` for one with a
+# variable tail.
+#
+# Splitting a list into its first element and the rest, as unifying it with
+# `[?h | ?t]` does, shouldn't copy the rest, so a List is a view of its tuple
+# of elements from some start position.  All the views of a tuple share it.
+# A list's tail may also be another List, as when one list is appended to
+# another, so a list may be made of several *segments*.  The empty list is
+# never a List, always `NIL`.
+
+NIL = Atom('[]')
+
+class List(object):
+
+    """A list of terms, ending with a tail."""
+
+    __slots__ = ('items', 'start', 'tail', 'ground', 'hash')
+
+    def __init__(self, items, tail=NIL):
+        self.items = tuple(items)
+        self.start = 0
+        self.tail = tail
+        self.ground = isinstance(tail, Atom) or (isinstance(tail, List)
+                                                 and tail.ground)
+        for item in self.items:
+            kind = type(item)
+            if not (kind is Atom or (kind is Relation or kind is List)
+                    and item.ground):
+                self.ground = False
+                break
+        self.hash = None
+
+    def view(self, start):
+        """Return this list without its first start elements."""
+        if start == len(self.items) - self.start:
+            return self.tail
+        if start == 0:
+            return self
+        rest = List.__new__(List)
+        rest.items = self.items
+        rest.start = self.start + start
+        rest.tail = self.tail
+        rest.ground = self.ground
+        rest.hash = None
+        return rest
+
+    def __len__(self):
+        """The number of elements in the first segment of this list."""
+        return len(self.items) - self.start
+
+    def head(self):
+        return self.items[self.start]
+
+    def segment(self):
+        """Return the elements in the first segment of this list."""
+        return self.items[self.start:] if self.start else self.items
+
+    def __reduce__(self):
+        return (List, (self.segment(), self.tail))
+
+    def elements(self):
+        """Return all the elements of this list, and its final tail."""
+        elements = []
+        term = self
+        while isinstance(term, List):
+            elements.extend(term.segment())
+            term = term.tail
+        return elements, term
+
+    def __repr__(self):
+        elements, tail = self.elements()
+        elements = ', '.join(map(str, elements))
+        if tail == NIL:
+            return '[%s]' % elements
+        return '[%s | %s]' % (elements, tail)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        return (isinstance(other, List)
+                and self.elements() == other.elements())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # As with relations, only ground lists hash by their elements.
+        if not self.ground:
+            return object.__hash__(self)
+        if self.hash is None:
+            elements, tail = self.elements()
+            self.hash = hash((tuple(elements), tail))
+        return self.hash
+
+    def bind_vars(self, bindings):
+        """Replace each Var in this list with its bound term."""
+        return bind_term(self, bindings)
+
+    def rename_vars(self, replacements):
+        """Recursively rename each Var in this list."""
+        if self.ground:
+            return self
+        elements, tail = self.elements()
+        return List([arg.rename_vars(replacements) for arg in elements],
+                    tail.rename_vars(replacements))
+
+    def get_vars(self):
+        """Return all Vars in this list."""
+        if self.ground:
+            return []
+        return term_vars([self])
+
+def make_list(elements, tail=NIL):
+    """Return the list of elements followed by tail."""
+    return List(elements, tail) if elements else tail
+
+# Terms may be nested far deeper than Python's stack, as a list built an
+# element at a time by a recursive predicate is, so the functions that walk
+# them keep a stack of their own.
+
+def term_vars(terms):
+    """Return the Vars in terms, in the order they first appear."""
+    vars = []
+    seen = set()
+    stack = list(reversed(terms))
+    while stack:
+        term = stack.pop()
+        kind = type(term)
+        if kind is Var:
+            if term not in seen:
+                seen.add(term)
+                vars.append(term)
+        elif kind is Relation:
+            if not term.ground:
+                stack.extend(reversed(term.args))
+        elif kind is List:
+            if not term.ground:
+                elements, tail = term.elements()
+                stack.append(tail)
+                stack.extend(reversed(elements))
+    return vars
+
+def chase(var, bindings):
+    """
+    Return the term var is bound to in bindings, following bindings to other
+    Vars, or None if it isn't bound.
+    """
+    # While looking up the binding for var, we must detect:
+    #
+    # 1. That we are looking up the binding of a Var (otherwise meaningless)
+    # 2. That we stop before reaching None, in the case that there is no
+    #    terminal Atom in a transitive binding
+    # 3. That we don't go in a circle (eg, x->y and y->x)
+    binding = bindings.get(var)
+    encountered = set([var])
+    while (isinstance(binding, Var) and binding not in encountered
+           and binding in bindings):
+        encountered.add(binding)
+        binding = bindings[binding]
+    return binding
+
+def arguments(term):
+    """Return the arguments of a relation, or a list's elements and tail."""
+    if type(term) is List:
+        elements, tail = term.elements()
+        return elements + [tail]
+    return term.args
+
+def bind_term(term, bindings):
+    """
+    Return the relation or list term with each Var among its arguments
+    replaced by its bound term, expanded in turn.  A Var bound (through
+    others) to a term containing it is left as it is inside that term.
+    """
+    # Each entry is a term being rebuilt, its arguments, those bound so far,
+    # and the Var it is the value of.
+    stack = [(term, arguments(term), [], None)]
+    expanding = set()
+    while True:
+        term, args, bound, var = stack[-1]
+        if len(bound) < len(args):
+            arg = args[len(bound)]
+            if isinstance(arg, Var) and arg in bindings:
+                value = chase(arg, bindings)
+                if isinstance(value, (Relation, List)):
+                    if arg not in expanding:
+                        expanding.add(arg)
+                        stack.append((value, arguments(value), [], arg))
+                        continue
+                else:
+                    arg = value
+            bound.append(arg)
+            continue
+        stack.pop()
+        expanding.discard(var)
+        if type(term) is List:
+            tail = bound.pop()
+            term = List(bound, tail)
+        else:
+            term = Relation(term.pred, bound)
+        if not stack:
+            return term
+        stack[-1][2].append(term)
+
 
 
 class Clause(object):
@@ -265,6 +585,7 @@ class Clause(object):
     def __init__(self, head, body=None):
         self.head = head
         self.body = body or []
+        self.compiled = None
 
     def __repr__(self):
         if self.body:
@@ -293,15 +614,17 @@ class Clause(object):
     def recursive_rename(self):
         """Replace each var in self with an unused one."""
         renames = {v: Var.get_unused_var() for v in self.get_vars()}
-        logging.debug('Renamed vars: %s' % renames)
         return self.rename_vars(renames)
 
+    def compile(self):
+        """Return this clause compiled for proving (see below)."""
+        if self.compiled is None:
+            self.compiled = CompiledClause(self)
+        return self.compiled
+
     def get_vars(self):
         """Return a list of all Vars in this Clause."""
-        vars = self.head.get_vars()
-        for rel in self.body:
-            vars.extend(v for v in rel.get_vars() if v not in vars)
-        return vars
+        return term_vars([self.head] + list(self.body))
 
 
 # ----------------------------------------------------------------------------
@@ -318,17 +641,63 @@ class Clause(object):
 
 # The implementation of the database is a single Python dictionary.  Keys are
 # the predicates of relations, and values are lists of clauses with identical
-# head predicates.
+# head predicates.  The lists created by `store` are `Predicate`s, which also
+# index their clauses on the heads' arguments (see below).
+#
+# Clauses can be added and removed while the database is in use, even by the
+# goals being proved (see `assertz`, `asserta` and `retract` below).  A goal
+# always sees the clauses its predicate had when the goal was called, however
+# they change while its alternatives are being tried: this is Prolog's
+# *logical update view*.
+
+#
+# The facts of a predicate may instead be kept in a `FactTable` (see below),
+# which stores them far more compactly.
 
 # ----------------------------------------------------------------------------
 
 def store(db, clause):
     """Store the clause in the database, indexed on the head's predicate."""
-    db.setdefault(clause.head.pred, []).append(clause)
+    clauses = db.get(clause.head.pred)
+    if isinstance(clauses, FactTable):
+        if not clause.body and clauses.add(clause.head):
+            return
+        clauses = db[clause.head.pred] = Predicate(clauses)
+    elif not isinstance(clauses, Predicate):
+        clauses = db[clause.head.pred] = Predicate(clauses or [])
+    clauses.append(clause)
+
+# Storing a clause adds it after the others of its predicate, as Prolog's
+# `assertz` does.
+assertz = store
+
+def asserta(db, clause):
+    """Store the clause before the others with the same head predicate."""
+    retrieve(db, clause.head.pred).prepend(clause)
+
+def retract(db, clause, bindings=None):
+    """
+    Remove the first clause in db that unifies with clause.  Returns the
+    bindings that unify them, or None if there is no such clause.
+    """
+    bindings = Bindings(bindings or {})
+    for removed in retractions(db, clause_term(clause), bindings):
+        return bindings
+    return None
 
-def retrieve(db, pred):
-    """Retrieve all clauses with matching head's predicate."""
-    return db.setdefault(pred, [])
+def retrieve(db, pred, args=None, bindings=None):
+    """
+    Retrieve all clauses with matching head's predicate.
+
+    If the goal's `args` are given, only the clauses whose heads might unify
+    with them (under `bindings`) are returned.
+    """
+    clauses = db.get(pred)
+    if not isinstance(clauses, Predicate):
+        clauses = db[pred] = Predicate(clauses or [])
+    if args is None:
+        return clauses
+    return clauses.candidates(args, bindings or {})
 
 # It will be useful to store Python functions in the database so that we can
 # induce side-effects by proving "relations".
@@ -337,6 +706,440 @@ def define_procedure(db, name, proc):
     """Store a Python function in the database with the given name."""
     db[name] = proc
 
+### Argument indexing
+
+# Indexing only on predicates is not enough for large tables of facts.  To
+# prove `linked(a, ?x)` against a hundred thousand `linked` facts we would
+# rename and unify every one of them, even though only the few facts whose
+# first argument is `a` can possibly match.  So within each predicate we also
+# index the clauses on the *principal functor* of their head arguments: the
+# atom itself for an Atom, and the predicate and arity for a Relation.  A Var
+# in a clause head can match anything, so such clauses belong to every key.
+#
+# Indexes are built lazily, the first time a goal with a bound argument at
+# that position is proved, and are then kept up to date as clauses are added.
+# When a goal has several bound arguments, we use whichever index leaves the
+# fewest candidates.
+
+def index_key(term):
+    """The key under which term is indexed, or None if it matches anything."""
+    if isinstance(term, Atom):
+        return term.atom
+    if isinstance(term, Relation):
+        return (term.pred, len(term.args))
+    if isinstance(term, List):
+        return List
+    return None
+
+def deref(term, bindings):
+    """Follow Var bindings from term until reaching an unbound Var or a value."""
+    while isinstance(term, Var) and term in bindings:
+        term = bindings[term]
+    return term
+
+
+class ArgumentIndex(object):
+
+    """Clauses of a predicate, hashed on the key of one head argument."""
+
+    def __init__(self, position, clauses=()):
+        self.position = position
+        self.buckets = {}
+        # Clauses whose argument is a Var, in order.  They match every key.
+        self.unkeyed = []
+        for clause in clauses:
+            self.add(clause)
+
+    def key(self, clause):
+        args = clause.head.args
+        if self.position < len(args):
+            return index_key(args[self.position])
+        return None
+
+    def add(self, clause):
+        """Add a clause after all those already indexed."""
+        key = self.key(clause)
+        if key is None:
+            self.unkeyed.append(clause)
+            for bucket in self.buckets.itervalues():
+                bucket.append(clause)
+        elif key in self.buckets:
+            self.buckets[key].append(clause)
+        else:
+            # A new bucket starts with every clause that matches any key, so
+            # that clause order is preserved within each bucket.
+            self.buckets[key] = self.unkeyed + [clause]
+
+    def prepend(self, clause, writable):
+        """
+        Add a clause before all those already indexed, changing only the
+        lists returned by writable (see `Predicate`).
+        """
+        key = self.key(clause)
+        if key is None:
+            self.unkeyed = writable(self.unkeyed)
+            self.unkeyed.insert(0, clause)
+            keys = self.buckets.keys()
+        elif key in self.buckets:
+            keys = [key]
+        else:
+            self.buckets[key] = [clause] + self.unkeyed
+            keys = []
+        for key in keys:
+            bucket = self.buckets[key] = writable(self.buckets[key])
+            bucket.insert(0, clause)
+
+    def discard(self, clause, writable):
+        """Remove the clause, changing only the lists returned by writable."""
+        key = self.key(clause)
+        if key is None:
+            self.unkeyed = writable(self.unkeyed)
+            remove_clause(self.unkeyed, clause)
+            keys = self.buckets.keys()
+        else:
+            keys = [key] if key in self.buckets else []
+        for key in keys:
+            bucket = self.buckets[key] = writable(self.buckets[key])
+            remove_clause(bucket, clause)
+
+    def lookup(self, key):
+        """Return the clauses, in order, that might match key."""
+        return self.buckets.get(key, self.unkeyed)
+
+def remove_clause(clauses, clause):
+    """Remove clause itself (not just an equal clause) from clauses."""
+    for i, other in enumerate(clauses):
+        if other is clause:
+            list.__delitem__(clauses, i) # even from a Predicate
+            return True
+    return False
+
+
+# To give goals their logical view of the database, the lists of clauses
+# that goals are proved with, the `clauses` of a predicate and the buckets of
+# its indexes, are only ever changed in place by adding clauses at the end.
+# A goal only tries the clauses that were in its list when it was called, so
+# clauses added later aren't seen.  Adding a clause at the front or removing
+# one changes the list in place only if no goal can have seen it since it was
+# last changed.  Otherwise the list is copied first, and goals still using
+# the old list carry on undisturbed.
+
+class Predicate(list):
+
+    """The list of clauses for a single predicate, with argument indexes."""
+
+    # Scanning a handful of clauses is cheaper than maintaining indexes.
+    min_indexed = 8
+
+    # Whether goals of this predicate are proved by tabling (see below).
+    tabled = False
+
+    # Counts the changes to the clauses, so that answers found with them can
+    # be told to be out of date (see [caching](#caching)).
+    version = 0
+
+    def __init__(self, clauses=()):
+        list.__init__(self)
+        self.indexes = {}
+        self.clauses = []
+        # The lists copied since goals last looked, by id, which can safely
+        # be changed in place.
+        self.copies = {}
+        self.extend(clauses)
+
+    def __reduce__(self):
+        return (Predicate, (list(self),), {'tabled': self.tabled})
+
+    def writable(self, clauses):
+        """Return clauses, or a copy of them if goals may be using them."""
+        if id(clauses) in self.copies:
+            return clauses
+        copy = list(clauses)
+        self.copies[id(copy)] = copy
+        return copy
+
+    def append(self, clause):
+        list.append(self, clause)
+        self.version += 1
+        self.clauses.append(clause)
+        for index in self.indexes.itervalues():
+            index.add(clause)
+
+    def extend(self, clauses):
+        for clause in clauses:
+            self.append(clause)
+
+    def prepend(self, clause):
+        """Add a clause before all the others."""
+        list.insert(self, 0, clause)
+        self.version += 1
+        self.clauses = self.writable(self.clauses)
+        self.clauses.insert(0, clause)
+        for index in self.indexes.itervalues():
+            index.prepend(clause, self.writable)
+
+    def discard(self, clause):
+        """Remove the clause itself, returning whether it was present."""
+        if not remove_clause(self, clause):
+            return False
+        self.version += 1
+        self.clauses = self.writable(self.clauses)
+        remove_clause(self.clauses, clause)
+        for index in self.indexes.itervalues():
+            index.discard(clause, self.writable)
+        return True
+
+    # Any other modification of the list makes the indexes stale, so we drop
+    # them and let them be rebuilt on demand.
+
+    def reset(self):
+        self.version += 1
+        self.indexes.clear()
+        self.clauses = list(self)
+
+    def insert(self, i, clause):
+        list.insert(self, i, clause)
+        self.reset()
+
+    def remove(self, clause):
+        list.remove(self, clause)
+        self.reset()
+
+    def __setitem__(self, i, clause):
+        list.__setitem__(self, i, clause)
+        self.reset()
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self.reset()
+
+    def argument_index(self, position):
+        """Return the index on the argument at position, building it if needed."""
+        index = self.indexes.get(position)
+        if index is None:
+            index = self.indexes[position] = ArgumentIndex(position,
+                                                           self.clauses)
+        return index
+
+    def candidates(self, args, bindings):
+        """
+        Return the clauses whose heads might unify with a goal's args.  Only
+        the first `len` of them are to be tried, since clauses may be added
+        to the end of the list later.
+        """
+        # Whichever list we return, goals may now be using all of them.
+        if self.copies:
+            self.copies.clear()
+        if len(self.clauses) < Predicate.min_indexed:
+            return self.clauses
+        best = self.clauses
+        for position, arg in enumerate(args):
+            key = index_key(deref(arg, bindings))
+            if key is None:
+                continue
+            clauses = self.argument_index(position).lookup(key)
+            if len(clauses) < len(best):
+                best = clauses
+                if not best:
+                    break
+        return best
+
+
+### Fact tables
+
+# A large table of ground facts, like a million `linked(a, b)`s, needs a
+# Clause for each fact, with a Relation and a tuple of arguments, all of them
+# Python objects, and most of the memory they take is overhead.  Yet a ground
+# fact is just a row of values.  A `FactTable` stores the facts of a
+# predicate in *columns*, one for each argument, each an `array` of integers.
+# Each distinct value is a *symbol*, numbered the first time it is stored, so
+# a fact takes one machine integer for each argument, and the values
+# themselves are shared by every fact using them.
+#
+# Goals are proved against the rows directly, without making clauses.  As in
+# a Predicate, each column's hash index, mapping each symbol to the array of
+# rows that have it there, is built the first time a goal has a bound
+# argument in that column, and is kept up to date as rows are added.
+#
+# Only ground facts with the table's arity can be stored in a table.
+# Storing any other clause in it, or adding a fact before the others, turns
+# it back into a Predicate, with a clause for each row.  Retracting a fact
+# marks its row as removed, recording when it was removed, so that goals
+# already using the table still see it: the logical update view again.
+
+def fact_table(db, pred):
+    """
+    Declare that the facts of pred are to be stored in a FactTable.  Raises
+    ValueError if pred already has clauses that can't be.
+    """
+    clauses = db.get(pred)
+    if isinstance(clauses, FactTable):
+        return clauses
+    table = FactTable(pred)
+    for clause in clauses or []:
+        if clause.body or not table.add(clause.head):
+            raise ValueError('%s is not a ground fact' % clause)
+    db[pred] = table
+    return table
+
+def symbol_key(term):
+    """The key under which the symbol for ground term is numbered."""
+    # Numbers equal in value but not in type, like 1 and 1.0, are different
+    # symbols, since they print differently.  Ground relations are interned
+    # by these keys, so they are already told apart.
+    if isinstance(term, Atom):
+        return (type(term.atom), term.atom)
+    if isinstance(term, List):
+        elements, tail = term.elements()
+        return (List, tuple([symbol_key(element) for element in elements]),
+                symbol_key(tail))
+    return term
+
+
+class FactTable(object):
+
+    """The ground facts of a single predicate, stored in columns of symbols."""
+
+    tabled = False
+
+    def __init__(self, pred, facts=()):
+        self.pred = pred
+        self.arity = None
+        self.columns = []
+        self.count = 0
+        # The value of each symbol, and the number of each value's symbol.
+        self.symbols = []
+        self.numbers = {}
+        self.indexes = {}
+        # The version at which each removed row was removed.
+        self.removed = {}
+        self.version = 0
+        for fact in facts:
+            self.add(fact)
+
+    def __len__(self):
+        return self.count - len(self.removed)
+
+    def __iter__(self):
+        """Generate a clause for each fact in the table."""
+        for row in xrange(self.count):
+            if row not in self.removed:
+                yield Clause(self.fact(row))
+
+    def fact(self, row):
+        """Return the fact stored in row."""
+        return Relation(self.pred, [self.symbols[column[row]]
+                                    for column in self.columns])
+
+    def storable(self, fact):
+        """Return whether fact can be stored in the table."""
+        return (isinstance(fact, Relation) and fact.pred == self.pred
+                and fact.ground
+                and (self.arity is None or len(fact.args) == self.arity))
+
+    def add(self, fact):
+        """Add fact after the others, returning whether it could be."""
+        if not self.storable(fact):
+            return False
+        if self.arity is None:
+            self.arity = len(fact.args)
+            self.columns = [array.array('l') for arg in fact.args]
+        row = self.count
+        for position, arg in enumerate(fact.args):
+            key = symbol_key(arg)
+            number = self.numbers.get(key)
+            if number is None:
+                number = self.numbers[key] = len(self.symbols)
+                self.symbols.append(arg)
+            self.columns[position].append(number)
+            index = self.indexes.get(position)
+            if index is not None:
+                index.setdefault(number, array.array('l')).append(row)
+        self.count += 1
+        self.version += 1
+        return True
+
+    def discard(self, row):
+        """Remove the fact in row, returning whether it was present."""
+        if row in self.removed:
+            return False
+        self.version += 1
+        self.removed[row] = self.version
+        return True
+
+    def equal_symbols(self, term):
+        """Return the numbers of the symbols equal to the ground term."""
+        if (isinstance(term, Atom) and isinstance(term.atom, (int, long, float))
+            and not isinstance(term.atom, bool)):
+            keys = [(kind, term.atom) for kind in (int, long, float)]
+        else:
+            keys = [symbol_key(term)]
+        return [self.numbers[key] for key in keys if key in self.numbers]
+
+    def rows(self, position, numbers):
+        """Return the rows, in order, with one of numbers at position."""
+        index = self.indexes.get(position)
+        if index is None:
+            index = self.indexes[position] = {}
+            for row, number in enumerate(self.columns[position]):
+                index.setdefault(number, array.array('l')).append(row)
+        if len(numbers) == 1:
+            return index.get(numbers[0], ())
+        return sorted(itertools.chain(*[index.get(n, ()) for n in numbers]))
+
+    def matches(self, goal, bindings):
+        """
+        Generate each row whose fact unifies with goal, extending bindings.
+        Only the rows the table has now are tried.
+        """
+        if len(goal.args) != self.arity:
+            return
+        count = self.count
+        version = self.version
+        removed = self.removed
+        symbols = self.symbols
+        # The bound arguments are compared by symbol, and the rest unified.
+        compared = []
+        unified = []
+        candidates = None
+        for position, arg in enumerate(goal.args):
+            arg = bindings.deref(arg)
+            column = self.columns[position]
+            if isinstance(arg, Atom) or (isinstance(arg, (Relation, List))
+                                         and arg.ground):
+                numbers = self.equal_symbols(arg)
+                if not numbers:
+                    return
+                rows = self.rows(position, numbers)
+                if candidates is None or len(rows) < len(candidates):
+                    candidates = rows
+                compared.append((column, numbers))
+            else:
+                unified.append((column, arg))
+        if candidates is None:
+            candidates = xrange(count)
+        mark = bindings.mark()
+        for row in candidates:
+            if row >= count:
+                break
+            if removed and removed.get(row, version + 1) <= version:
+                continue
+            for column, numbers in compared:
+                if column[row] not in numbers:
+                    break
+            else:
+                for column, term in unified:
+                    if not bindings.unify(term, symbols[column[row]]):
+                        break
+                else:
+                    yield row
+                bindings.undo(mark)
+
+    def alternatives(self, goal, bindings, pending):
+        """Generate the pending goals for each fact unifying with goal."""
+        for row in self.matches(goal, bindings):
+            yield pending
+
 
 # ----------------------------------------------------------------------------
 # <a id="unification"></a>
@@ -377,73 +1180,186 @@ def define_procedure(db, name, proc):
 # pattern matching and unification in Peter Norvig's *PAIP* are nearly
 # identical, a testament to the utility of Lisp's uniform syntax.
 
-# ----------------------------------------------------------------------------
+### Bindings with a trail
 
-def unify(x, y, bindings):
-    """Unify x and y, if possible.  Returns updated bindings or None."""
-    logging.debug('Unify %s and %s (bindings=%s)' % (x, y, bindings))
+# While proving a goal we unify many times, and when a step fails we must be
+# able to return to the bindings we had before it.  The simplest way to do so
+# is to copy the bindings before every change, but then each unification costs
+# time proportional to the number of bindings.  Instead, we keep a single
+# dictionary of bindings that is changed in place, along with a *trail* that
+# records, in order, every variable that has been bound.  To backtrack to an
+# earlier point we only need to remember the length of the trail at that
+# point, and unbind the variables recorded since then.
 
-    # False bindings means we failed in a previous step.  Re-fail.
-    if bindings == False:
-        return False
-
-    # Make a copy of bindings so we can backtrack if necessary.
-    bindings = dict(bindings)
-
-    # When x and y are equal (the same Var or Atom), there's nothing to do.
-    if x == y:
-        return bindings
-
-    #### Unification of Vars with anything else
-    if isinstance(x, Var):
-        # If x (or y) is already bound to something, dereference and try again.
-        if x in bindings:
-            return unify(bindings[x], y, bindings)
-        if y in bindings:
-            return unify(x, bindings[y], bindings)
-
-        # Otherwise, bind x to y.
-        bindings[x] = y
-        return bindings
-    if isinstance(y, Var):
-        return unify(y, x, bindings)
-
-    #### Unification of Relations with Relations
-    if isinstance(x, Relation) and isinstance(y, Relation):
-        # Two relations must have the same predicate and arity to unify.
-        if x.pred != y.pred:
-            return False
-        if len(x.args) != len(y.args):
-            return False
+# ----------------------------------------------------------------------------
 
-        # Unify corresponding terms in the relations.
-        for i, xi in enumerate(x.args):
-            yi = y.args[i]
-            bindings = unify(xi, yi, bindings)
-            if bindings == False:
-                return False
+class Bindings(dict):
+
+    """A dictionary of variable bindings that can be undone using a trail."""
+
+    __slots__ = ('trail',)
+
+    def __init__(self, bindings=()):
+        dict.__init__(self, bindings)
+        self.trail = []
+
+    def mark(self):
+        """Return a marker of the current state of the bindings for `undo`."""
+        return len(self.trail)
+
+    def undo(self, mark):
+        """Unbind every variable bound since mark was taken."""
+        trail = self.trail
+        while len(trail) > mark:
+            del self[trail.pop()]
+
+    def bind(self, var, value):
+        """Bind var to value, recording it on the trail."""
+        self[var] = value
+        self.trail.append(var)
+
+    def deref(self, term):
+        """Follow the bindings from term to an unbound Var or a value."""
+        while isinstance(term, Var):
+            value = self.get(term)
+            if value is None:
+                return term
+            term = value
+        return term
+
+    def instantiate(self, term):
+        """Return term with each bound Var replaced by its value, throughout."""
+        term = self.deref(term)
+        if not isinstance(term, (Relation, List)) or term.ground:
+            return term
+
+        # Relations can be nested arbitrarily deeply, so rather than recursing
+        # we keep a stack of the relations being rebuilt, each with its parts
+        # and the parts instantiated so far.  The parts of a list are its
+        # elements, through every segment, followed by its tail.
+        stack = [(term, self.parts(term), [])]
+        while True:
+            compound, parts, args = stack[-1]
+            if len(args) < len(parts):
+                arg = self.deref(parts[len(args)])
+                if isinstance(arg, (Relation, List)) and not arg.ground:
+                    stack.append((arg, self.parts(arg), []))
+                else:
+                    args.append(arg)
+                continue
+            stack.pop()
+            if type(compound) is List:
+                instance = make_list(args[:-1], args[-1])
+            else:
+                instance = Relation(compound.pred, args)
+            if not stack:
+                return instance
+            stack[-1][2].append(instance)
+
+    def parts(self, term):
+        if type(term) is List:
+            elements, tail = self.elements(term)
+            elements.append(tail)
+            return elements
+        return term.args
+
+    def elements(self, term):
+        """
+        Return the elements of the list term and its tail, following the
+        bindings of the tails of its segments.
+        """
+        elements = []
+        term = self.deref(term)
+        while type(term) is List:
+            elements.extend(term.segment())
+            term = self.deref(term.tail)
+        return elements, term
+
+    def drop(self, term, n):
+        """Return the list term without its first n elements, sharing them."""
+        term = self.deref(term)
+        while n and type(term) is List:
+            if n < len(term):
+                return term.view(n)
+            n -= len(term)
+            term = self.deref(term.tail)
+        return term
+
+    def unify(self, x, y):
+        """
+        Unify x and y, extending these bindings.  Returns True if successful;
+        otherwise returns False, leaving the bindings unchanged.
+        """
+        mark = len(self.trail)
+        # Pairs of terms still to be unified.  They are pushed in reverse so
+        # that arguments are unified from left to right.
+        pairs = [(x, y)]
+        while pairs:
+            x, y = pairs.pop()
+            x = self.deref(x)
+            y = self.deref(y)
+
+            # When x and y are equal (the same Var or Atom), there's nothing
+            # to do.  Since we dereferenced them, an unbound Var is bound
+            # directly to the value of the other term.
+            if x is y:
+                continue
+            if isinstance(x, Var):
+                if not x == y:
+                    self.bind(x, y)
+            elif isinstance(y, Var):
+                self.bind(y, x)
+
+            # Two relations must have the same predicate and arity to unify,
+            # and then their corresponding arguments must unify.  (Even
+            # distinct ground relations may, as f(1) and f(1.0) do.)
+            elif isinstance(x, Relation):
+                if not (isinstance(y, Relation) and x.pred == y.pred
+                        and len(x.args) == len(y.args)):
+                    break
+                pairs.extend(reversed(zip(x.args, y.args)))
+
+            # Lists unify element by element, a segment at a time.  Once the
+            # shorter segment runs out, what remains of the longer one must
+            # unify with its tail.
+            elif type(x) is List:
+                if type(y) is not List:
+                    break
+                n = min(len(x), len(y))
+                pairs.append((x.view(n), y.view(n)))
+                pairs.extend(reversed(zip(x.segment()[:n], y.segment()[:n])))
+
+            # Clauses unify if their heads and each of their body terms do.
+            elif isinstance(x, Clause):
+                if not (isinstance(y, Clause) and len(x.body) == len(y.body)):
+                    break
+                pairs.extend(reversed(zip(x.body, y.body)))
+                pairs.append((x.head, y.head))
+
+            # Nothing else can unify unless it is equal.
+            elif not x == y:
+                break
+        else:
+            return True
+        self.undo(mark)
+        return False
 
-        return bindings
+# ----------------------------------------------------------------------------
 
-    #### Unification of Clauses with Clauses
-    if isinstance(x, Clause) and isinstance(y, Clause):
-        # Clause bodies must have the same length to unify.
-        if len(x.body) != len(y.body):
-            return False
+# Code that works with plain dictionaries of bindings can still use `unify`,
+# which returns a new dictionary and leaves the one it was given untouched.
 
-        # Unify head term and body terms.
-        bindings = unify(x.head, y.head, bindings)
-        if bindings == False:
-            return False
-        for i, xi in enumerate(x.body):
-            yi = y.body[i]
-            bindings = unify(xi, yi, bindings)
-            if bindings == False:
-                return False
-        return bindings
+def unify(x, y, bindings):
+    """Unify x and y, if possible.  Returns updated bindings or False."""
+    # False bindings means we failed in a previous step.  Re-fail.
+    if bindings == False:
+        return False
 
-    #### Nothing else can unify.
-    return False
+    # Work on a copy of bindings so that the caller's can be used to backtrack.
+    extended = Bindings(bindings)
+    if not extended.unify(x, y):
+        return False
+    return dict(extended)
 
 
 # ----------------------------------------------------------------------------
@@ -485,7 +1401,7 @@ def unify(x, y, bindings):
 #      with bindings of `?x` -> `Me` for the first clause and `?x` -> `You` for
 #      the second clause.
 #
-# 3.   For each clause whose head unifies with the goal, recurse to prove each
+# 3.   For each clause whose head unifies with the goal, go on to prove each
 #      body relation of the clause.  If proving fails for any body relation, we
 #      move on to the next retrieved candidate clause.
 #
@@ -495,83 +1411,605 @@ def unify(x, y, bindings):
 #      clause, and try to prove `likes(?x, Programmers)`.
 #
 # We will keep track of the goals we're proving with a stack, implemented as a
-# Python list.  In this way we can keep track of all the goals we must prove
-# even when we recurse while proving.
+# linked list of `(goal, barrier, rest)` triples.  (The barrier is explained
+# in the section on control constructs below.)  Proving a goal with a rule pushes the
+# rule's body on top of the goals that remain, and since the remaining goals
+# are shared rather than copied this takes time proportional to the length of
+# the body alone.
+#
+# Each time more than one clause might prove a goal we have a *choice point*:
+# if we later fail, we must come back and try the next clause.  Choice points
+# are kept on a second stack.  Rather than recursing, the prover loops, each
+# time either proving the next goal or, on failure, resuming the most recent
+# choice point that still has alternatives.  The Python stack therefore stays
+# the same size no matter how deep the proof goes.
 
 # ----------------------------------------------------------------------------
 
-def prove(goal, bindings, db, remaining=None):
+def push_goals(goals, pending, barrier=0):
     """
-    Prove goal and all remaining goals using the given bindings and database.
-
-    If successful, returns the extended bindings that satisfy all the goals.
-    Otherwise, returns False.
+    Push goals, in order, on top of the pending goal stack, cutting back to
+    barrier.
     """
+    for goal in reversed(goals):
+        pending = (goal, barrier, pending)
+    return pending
+
+def pending_goals(pending):
+    """Return the goals on the pending goal stack as a list."""
+    goals = []
+    while pending is not None:
+        goal, barrier, pending = pending
+        if type(goal) is not Frame:
+            goals.append(goal)
+    return goals
+
+def resolve(goals, bindings, db, tabling=None, monitor=None, budget=None):
+    """
+    Generate each set of bindings that proves all the goals, one at a time.
 
-    # False bindings means we failed somewhere earlier, so re-fail.
-    if bindings == False:
-        return False
-    
-    logging.debug('Prove %s (bindings=%s)' % (goal, bindings))
-    remaining = remaining or []
-    
-    # Find the clauses in the database that might help us prove goal.
-    query = db.get(goal.pred)
-    if not query:
-        return False
-    
-    if not isinstance(query, list):
-        # If the retrieved data from the database isn't a list of clauses,
-        # it must be a Python function--call it and return the results.
-        return query(goal.args, bindings, db, remaining)
-
-    logging.debug('Candidate clauses: %s' % query)
-
-    # Try to use the retrieved clauses to prove the goal.
-    for clause in query:
-        logging.debug('Trying candidate clause %s for goal %s' % (clause, goal))
-        
-        # First, rename the variables in clause so they don't collide with
-        # those in goal.
-        renamed = clause.recursive_rename()
+    Solutions are found depth-first, trying clauses in the order they were
+    stored, exactly as Prolog does.  Each is generated only when the previous
+    one has been consumed.  The generated `Bindings` are changed in place as
+    the search continues, so copy them if they are needed for longer.
 
-        # Next, we try to unify goal with the head of the candidate clause.
-        # If unification is possible, then the candidate clause might either be
+    The answer tables of tabled goals are kept in `tabling`, if given.  If a
+    `monitor` is given, it is told of each port of each call, and if a
+    `budget` is given, each goal tried is charged to it (see below).
+    """
+    if not isinstance(bindings, Bindings):
+        bindings = Bindings(bindings)
+    pending = push_goals(goals, None)
+    choices = []
+    # When monitoring, the frames of the calls whose choice points these are,
+    # and the frame of the call whose body is being proved.
+    frames = []
+    frame = None
+    try:
+        while True:
+            # Prove the goal on top of the stack.  Proving a relation pushes a
+            # choice point over the clauses that might prove it; the loop below
+            # then tries the first of them.
+            if pending is None:
+                yield bindings
+            else:
+                goal, barrier, pending = pending
+                if monitor is not None and type(goal) is Frame:
+                    # We have proved the body of this call.
+                    monitor.exit(goal, bindings)
+                    goal.active = False
+                    frame = goal.parent
+                    continue
+                if budget is not None:
+                    budget.charge(goal, len(choices))
+                query = db.get(goal.pred)
+                if query is None:
+                    query = BUILTINS.get(goal.pred)
+                if isinstance(query, (list, FactTable)):
+                    if monitor is not None:
+                        # The frame is pushed beneath the body of each clause
+                        # proving the call, so that we know when the call exits.
+                        frame = Frame(goal, frame)
+                        monitor.call(frame, bindings)
+                        pending = (frame, None, pending)
+                        frames.append((frame, True))
+                    if isinstance(query, Predicate) and query.tabled:
+                        if tabling is None:
+                            tabling = Tabling(monitor, budget)
+                        choices.append(
+                            tabling.answers(goal, bindings, pending, db))
+                    elif type(query) is FactTable:
+                        choices.append(query.alternatives(goal, bindings,
+                                                          pending))
+                    else:
+                        # A cut in the body of a clause removes the choice
+                        # point of the call, and all those above it.
+                        choices.append(alternatives(goal, query, bindings,
+                                                    pending, len(choices),
+                                                    frame, monitor))
+                elif isinstance(query, Builtin):
+                    if monitor is not None:
+                        frame = Frame(goal, frame)
+                        monitor.call(frame, bindings)
+                    if not query.deterministic:
+                        if monitor is not None:
+                            pending = (frame, None, pending)
+                            frames.append((frame, True))
+                        choices.append(builtin_solutions(query, goal.args,
+                                                         bindings, pending, db))
+                    elif (query.function(goal.args, bindings, db)
+                          if query.database
+                          else query.function(goal.args, bindings)):
+                        if monitor is not None:
+                            monitor.exit(frame, bindings)
+                            frame.active = False
+                            frame = frame.parent
+                        continue
+                    elif monitor is not None:
+                        frame.active = False
+                        monitor.fail(frame, bindings)
+                        frame = frame.parent
+                elif query:
+                    # If the retrieved data from the database isn't a list of
+                    # clauses, it must be a Python function.  It is responsible
+                    # for proving the remaining goals, so its result is a solution.
+                    if monitor is not None:
+                        frame = Frame(goal, frame)
+                        monitor.call(frame, bindings)
+                    result = query(goal.args, dict(bindings), db,
+                                   pending_goals(pending))
+                    # It fails by returning False (or None); even empty
+                    # bindings are a solution.
+                    proved = result is not False and result is not None
+                    if monitor is not None:
+                        if proved:
+                            monitor.exit(frame, bindings)
+                        else:
+                            monitor.fail(frame, bindings)
+                        frame = frame.parent
+                    if proved:
+                        yield Bindings(result)
+                elif goal.pred in CONTROL:
+                    # Control constructs (see below) either cut choice
+                    # points, push their subgoals, or push a choice point
+                    # over their branches.
+                    if goal.pred == '!':
+                        if monitor is not None and barrier < len(choices):
+                            # Leave the call being cut an empty choice point,
+                            # so that the monitor hears when it fails.
+                            choices[barrier:] = [iter(())]
+                            frames[barrier:] = frames[barrier:barrier + 1]
+                        else:
+                            del choices[barrier:]
+                        continue
+                    if goal.pred == 'true':
+                        continue
+                    if goal.pred == ',':
+                        pending = push_goals(goal.args, pending, barrier)
+                        continue
+                    if goal.pred != 'fail':
+                        choices.append(branches(goal, bindings, pending,
+                                                barrier, len(choices)))
+                        if monitor is not None:
+                            frames.append((frame, False))
+                elif monitor is not None:
+                    unknown = Frame(goal, frame)
+                    monitor.call(unknown, bindings)
+                    unknown.active = False
+                    monitor.fail(unknown, bindings)
+
+            # Backtrack to the most recent choice point with an alternative left.
+            # Each choice point undoes its own bindings before trying the next.
+            while choices:
+                if monitor is not None:
+                    # The call that made the choice point, or for a control
+                    # construct, the call whose body it is in.
+                    frame, call = frames[-1]
+                    if frame is not None and not frame.active:
+                        redo(frame, bindings, monitor)
+                pending = next(choices[-1], False)
+                if pending is not False:
+                    break
+                choices.pop()
+                if monitor is not None:
+                    frames.pop()
+                    if call:
+                        frame.active = False
+                        monitor.fail(frame, bindings)
+            else:
+                return
+    finally:
+        # If we stop before the search is over, the calls we are still
+        # proving are abandoned, which to the monitor is failure.
+        while monitor is not None and frame is not None and frame.active:
+            frame.active = False
+            monitor.fail(frame, bindings)
+            frame = frame.parent
+
+def alternatives(goal, clauses, bindings, pending, barrier=0, frame=None,
+                 monitor=None):
+    """
+    Generate the new pending goals for each clause that unifies with goal,
+    extending bindings in place.  Cuts in the bodies of the clauses cut back
+    to barrier.  The monitor, if any, is told of each clause used to prove the
+    call in frame.
+    """
+    mark = bindings.mark()
+
+    # If the clauses are indexed, only try those that might match the goal.
+    # Clauses added while we try them are ignored.
+    if isinstance(clauses, Predicate):
+        clauses = clauses.candidates(goal.args, bindings)
+    for clause in itertools.islice(clauses, len(clauses)):
+        # We try to unify goal with the head of the candidate clause, with
+        # its variables renamed so they don't collide with those in goal.
+        # (Compiled clauses, described below, do both at once.)  If
+        # unification is possible, then the candidate clause might either be
         # a rule that can prove goal or a fact that states goal is already true.
-        unified = unify(goal, renamed.head, bindings)
-        if unified == False:
+        compiled = clause.compile()
+        body = compiled.match(goal, bindings)
+        if body is None:
             continue
 
         # Make sure the candidate clause doesn't lead to an infinite loop
-        # by checking to see if its head is in its body.
-        renamed = renamed.bind_vars(unified)
-        if renamed.head in renamed.body:
-            continue
+        # by checking to see if its head is in its body.  Only rules that
+        # mention their own predicate can do this.
+        if compiled.recursive:
+            bound = [term.bind_vars(bindings) for term in body]
+            if goal.bind_vars(bindings) in bound:
+                bindings.undo(mark)
+                continue
+
+        # To use the candidate clause we need to prove its subgoals before
+        # the remaining goals.  When we come back here, we have failed to
+        # do so and must undo the bindings made since.
+        if monitor is not None:
+            monitor.clause(frame, clause, bindings, mark)
+            frame.clause = clause
+        yield push_goals(body, pending, barrier)
+        bindings.undo(mark)
+
+### Control constructs
+
+# Prolog programs control the search for proofs with a few special goals.
+#
+# - The *cut*, `!`, always succeeds, but commits to the choices made since the
+#   clause containing it was chosen: if we later backtrack to the cut, the
+#   goal the clause is proving fails, without trying any other clauses or
+#   other solutions of the goals before the cut.
+# - `true` always succeeds, and `fail` never does.
+# - A conjunction `(a, b)` proves `a` and then `b`.
+# - A disjunction `(a ; b)` proves `a`, or else `b`.
+# - An if-then-else `(c -> t ; e)` proves `t` if `c` can be proved, using its
+#   first solution, and `e` otherwise.  Without an else branch, the goal
+#   fails if `c` can't be proved.
+# - The negation `\+ g` succeeds exactly when `g` can't be proved.  This is
+#   *negation as failure*: `g` is assumed false if it can't be proved true.
+#
+# These are represented by relations, `!`, `true` and `fail` with no
+# arguments, `,`, `;` and `->` with two, and `\+` with one.
+#
+# Each pending goal is pushed along with a *barrier*, the height of the
+# choice point stack to cut back to.  The goals in the body of a clause have
+# the height at which the choice point over the clauses was pushed, so a cut
+# removes it along with those pushed since.  The goals in the branches of a
+# control construct keep the barrier of the construct, so a cut in a branch
+# still cuts the whole clause.
+#
+# An if-then-else is a choice point over its branches.  Its condition is
+# followed by a cut back to below the choice point, which commits to the
+# first solution of the condition and removes the else branch.  If the
+# condition fails, we backtrack into the choice point and take the else
+# branch instead.  A cut in the condition itself only cuts the condition.
+# Negation is then an if-then-else, `(g -> fail ; true)`.
+
+CONTROL = frozenset(['!', 'true', 'fail', ',', ';', '->', '\\+'])
+CUT = Relation('!', ())
+TRUE = Relation('true', ())
+FAIL = Relation('fail', ())
+
+def conjunction(goals):
+    """Return a goal proving each of goals in turn."""
+    if not goals:
+        return TRUE
+    goal = goals[-1]
+    for other in reversed(goals[:-1]):
+        goal = Relation(',', (other, goal))
+    return goal
 
-        # We need to prove the subgoals of the candidate clause before
-        # using it to prove goal.  Then prove the remaining goals as well.
-        extended = prove_all(renamed.body + remaining, unified, db)
-        
-        # If we can't prove all the subgoals, or the bindings that result from
-        # proving the subgoals make it so that the remaining goals can't be
-        # proved, move on.
-        if extended == False:
-            continue
+def branches(goal, bindings, pending, barrier, height):
+    """
+    Generate the new pending goals for each branch of a disjunction,
+    if-then-else or negation with the given barrier, whose choice point is at
+    height in the choice point stack.
+    """
+    mark = bindings.mark()
+    if goal.pred == ';':
+        first, second = goal.args
+    elif goal.pred == '->':
+        first, second = goal, FAIL
+    else:
+        first, second = Relation('->', (goal.args[0], FAIL)), TRUE
+    if isinstance(first, Relation) and first.pred == '->':
+        condition, then = first.args
+        yield (condition, height + 1,
+               (CUT, height, (then, barrier, pending)))
+    else:
+        yield (first, barrier, pending)
+    bindings.undo(mark)
+    yield (second, barrier, pending)
+    bindings.undo(mark)
+
+### Compiling clauses
+
+# Trying a clause as described above is wasteful.  Renaming the clause walks
+# it to find its variables and then rebuilds every relation in it, and `unify`
+# then walks the renamed head again, checking the type of every term.  All of
+# this is repeated each time the clause is tried, yet the structure of the
+# clause never changes.
+#
+# So the first time a clause is tried we *compile* it.  Its variables are
+# numbered, and each is replaced by its number, a *slot*.  Relations that
+# contain variables become `Structure`s, and everything else is left as a
+# constant.  To try the compiled clause against a goal we keep a list with a
+# value for each slot, initially empty, and match the head's arguments with
+# the goal's:
+#
+# - A constant matches a term equal to it, or binds a Var.
+# - An empty slot matches anything, and takes the term as its value, so the
+#   variables of the head never need to be created at all.
+# - A filled slot matches a term that unifies with its value.
+# - A structure matches a relation with the same predicate and arity whose
+#   arguments match its own, or binds a Var to a new relation built from it.
+#   Lists containing variables are compiled to structures too, but are built
+#   and then unified.
+#
+# Finally we build the body from the slots, creating new variables for those
+# still empty.  Matching a fact against a goal with different atoms thus takes
+# a couple of comparisons, and no new terms are created at all.
 
-        # Otherwise return the bindings that satisfied the goals.
-        return extended
+class Structure(object):
 
-    logging.debug('Failed to prove %s' % goal)
-    return False
-    
-def prove_all(goals, bindings, db):
+    """A relation containing variables in a compiled clause."""
+
+    __slots__ = ('pred', 'args')
+
+    def __init__(self, pred, args):
+        self.pred = pred
+        self.args = args
+
+
+class CompiledClause(object):
+
+    """A clause compiled for matching goals against its head."""
+
+    def __init__(self, clause):
+        self.clause = clause
+        slots = {}
+        self.pred = clause.head.pred
+        self.head = tuple(self.pattern(arg, slots) for arg in clause.head.args)
+        self.body = tuple(self.pattern(rel, slots) for rel in clause.body)
+        self.size = len(slots)
+        # Only a rule that mentions its own predicate can loop (see above).
+        self.recursive = any(rel.pred == self.pred for rel in clause.body)
+
+    def pattern(self, term, slots):
+        """Compile term, numbering its variables with the slots given so far."""
+        if isinstance(term, Var):
+            return slots.setdefault(term, len(slots))
+        if isinstance(term, Relation):
+            args = tuple(self.pattern(arg, slots) for arg in term.args)
+            if any(not isinstance(arg, (Atom, Relation, List)) for arg in args):
+                return Structure(term.pred, args)
+        if isinstance(term, List) and not term.ground:
+            elements, tail = term.elements()
+            args = tuple(self.pattern(arg, slots) for arg in elements + [tail])
+            return Structure(List, args)
+        return term
+
+    def build(self, pattern, slots):
+        """Build the term for pattern, creating new Vars for empty slots."""
+        if type(pattern) is int:
+            value = slots[pattern]
+            if value is None:
+                value = slots[pattern] = Var.get_unused_var()
+            return value
+        if type(pattern) is Structure:
+            args = [self.build(arg, slots) for arg in pattern.args]
+            if pattern.pred is List:
+                return make_list(args[:-1], args[-1])
+            return Relation(pattern.pred, args)
+        return pattern
+
+    def match(self, goal, bindings):
+        """
+        Match the head of the clause with goal, extending bindings.  Returns
+        the body of the clause if successful; otherwise returns None, leaving
+        the bindings unchanged.
+        """
+        if len(goal.args) != len(self.head):
+            return None
+        mark = bindings.mark()
+        slots = [None] * self.size
+        deref = bindings.deref
+        pairs = zip(self.head, goal.args)
+        pairs.reverse()
+        while pairs:
+            pattern, term = pairs.pop()
+            term = deref(term)
+            kind = type(pattern)
+            if kind is int:
+                value = slots[pattern]
+                if value is None:
+                    slots[pattern] = term
+                elif not bindings.unify(value, term):
+                    break
+            elif kind is Structure:
+                if pattern.pred is List:
+                    if not bindings.unify(self.build(pattern, slots), term):
+                        break
+                elif isinstance(term, Var):
+                    bindings.bind(term, self.build(pattern, slots))
+                elif (isinstance(term, Relation) and term.pred == pattern.pred
+                      and len(term.args) == len(pattern.args)):
+                    pairs.extend(reversed(zip(pattern.args, term.args)))
+                else:
+                    break
+            elif pattern is term:
+                continue
+            elif isinstance(term, Var):
+                bindings.bind(term, pattern)
+            elif kind is Atom:
+                if not pattern == term:
+                    break
+            elif not bindings.unify(pattern, term):
+                break
+        else:
+            return [self.build(rel, slots) for rel in self.body]
+        bindings.undo(mark)
+        return None
+
+def prove(goal, bindings, db, remaining=None, budget=None):
+    """
+    Prove goal and all remaining goals using the given bindings and database.
+
+    If successful, returns the extended bindings that satisfy all the goals.
+    Otherwise, returns False.  Raises BudgetExceeded if the budget, if given,
+    runs out first.
+    """
+    return prove_all([goal] + list(remaining or []), bindings, db, budget)
+
+def prove_all(goals, bindings, db, budget=None):
     """Prove all the goals with the given bindings and rule database."""
+    # False bindings means we failed somewhere earlier, so re-fail.
     if bindings == False:
         return False
-    if not goals:
-        return bindings
-    logging.debug('Proving goals: %s (bindings=%s)' % (goals, bindings))
-    return prove(goals[0], bindings, db, goals[1:])
+    for solution in resolve(goals, bindings, db, budget=budget):
+        return dict(solution)
+    return False
+
+### Streaming solutions
+
+# Programs that use this library usually want the solutions themselves rather
+# than the whole of the bindings used to find them.  `solve` generates, for
+# each solution, a dictionary from the variables in the goals to the terms
+# they are bound to.  Since it is a generator, solutions are only searched for
+# as they are consumed: taking the first few never explores the rest of the
+# search tree.
+
+def solve(goals, db, limit=None, monitor=None, budget=None):
+    """
+    Generate a dictionary of the variables in goals and their values for each
+    solution of goals, at most `limit` of them if it is given.
+
+    `goals` may be a list of relations or a single relation.  The monitor and
+    budget, if given, are passed on to `resolve`.
+    """
+    if isinstance(goals, Relation):
+        goals = [goals]
+    vars = query_vars(goals)
+    solutions = resolve(goals, {}, db, monitor=monitor, budget=budget)
+    for bindings in itertools.islice(solutions, limit):
+        yield {var: bindings.instantiate(var) for var in vars}
+
+def first(goals, db, monitor=None, budget=None):
+    """Return the first solution of goals as solve does, or None if none."""
+    for solution in solve(goals, db, limit=1, monitor=monitor, budget=budget):
+        return solution
+    return None
+
+def query_vars(goals):
+    """Return the variables in goals, in order of their first appearance."""
+    return term_vars(goals)
+
+### Batches of queries
+
+# A program answering many independent queries against the same database
+# needn't answer each one from scratch.  `solve_many` answers a whole batch:
+#
+# - Queries that are variants of each other (the same up to renaming their
+#   variables) are proved only once.
+# - The tables of tabled predicates (see [tabling](#tabling)) are kept for the
+#   whole batch, so a subgoal tabled while answering one query is just read
+#   by the rest.
+# - Given a number of `workers`, the queries are handed out to a pool of that
+#   many processes (see [OR-parallel proving](parallel.html)), which are sent
+#   the database once for the whole batch.  Each worker keeps the clauses it
+#   has compiled and indexed, and its tables, from one query to the next.
+#
+# Threads would save starting the processes, but since only one thread at a
+# time can run Python code they wouldn't prove anything any faster.
+#
+# The answers to a query are its *template*, a relation of its variables,
+# instantiated for each solution.  A variant of the query has the
+# corresponding variables in the same order, so it can share the answers.
+#
+# One query running out of budget, or failing to evaluate an expression,
+# mustn't stop the rest of the batch.  Its error is reported alongside the
+# solutions it found first, and the batch goes on.
+
+def query_answers(goals, template, db, limit=None, tabling=None, budget=None):
+    """
+    Return the instantiated template for each solution of goals, at most
+    `limit` of them, using the answer tables in tabling, and the
+    BudgetExceeded or EvaluationError that stopped the proof, or None.
+    """
+    if tabling is not None:
+        tabling.budget = budget
+    answers = []
+    try:
+        solutions = resolve(goals, {}, db, tabling, budget=budget)
+        for bindings in itertools.islice(solutions, limit):
+            answers.append(bindings.instantiate(template))
+    except (BudgetExceeded, EvaluationError) as e:
+        return answers, e
+    return answers, None
+
+def template_solutions(vars, answers):
+    """Return the solution dictionaries for the answers of a query."""
+    solutions = []
+    for answer in answers:
+        if not answer.ground:
+            # Each query gets its own copies of any unbound variables.
+            answer = answer.rename_vars({v: Var.get_unused_var()
+                                         for v in answer.get_vars()})
+        solutions.append(dict(zip(vars, answer.args)))
+    return solutions
+
+def batch_queries(queries):
+    """
+    Return the goals, variables and template of each of queries, with the
+    index of the first query it is a variant of.
+    """
+    batch = []
+    first = {}
+    for i, goals in enumerate(queries):
+        if isinstance(goals, Relation):
+            goals = [goals]
+        vars = query_vars(goals)
+        key = variant_key(conjunction(goals), {})
+        batch.append((goals, vars, Relation('solution', vars),
+                      first.setdefault(key, i)))
+    return batch
+
+def solve_many(queries, db, limit=None, workers=None, ordered=True,
+               inferences=None, timeout=None):
+    """
+    Generate `(i, solutions, error)` for the ith of queries, where solutions
+    is the list of solutions `solve` would generate for it, at most `limit`
+    of them, and error is the BudgetExceeded or EvaluationError that stopped
+    it early, or None.
+
+    Each query may be a list of relations or a single relation.  Given a
+    number of `workers`, queries are proved in that many processes, and
+    unless `ordered`, their solutions are generated as soon as they are
+    found, rather than in the order of the queries.  Each query may use at
+    most `inferences` inferences and `timeout` seconds.
+    """
+    if workers:
+        from paip import parallel
+        pool = parallel.ProverPool(db, workers)
+        results = pool.solve_many(queries, limit, ordered, inferences,
+                                  timeout)
+        try:
+            for result in results:
+                yield result
+        finally:
+            results.close()
+            pool.close()
+        return
+
+    tabling = Tabling()
+    answers = {}
+    for i, (goals, vars, template, first) in enumerate(batch_queries(queries)):
+        if first == i:
+            budget = None
+            if inferences is not None or timeout is not None:
+                budget = Budget(inferences, timeout)
+            answers[i] = query_answers(goals, template, db, limit, tabling,
+                                       budget)
+        found, error = answers[first]
+        yield i, template_solutions(vars, found), error
 
 # ----------------------------------------------------------------------------
 
@@ -586,43 +2024,1210 @@ def prove_all(goals, bindings, db):
 # to the user; we need a mechanism to force the system to fail before it returns
 # if the user doesn't like the bindings that were found.
 #
-# We accomplish this task with a built-in function called `display_bindings`.
-# This function is stored in the database so that it looks like a clause, and
-# before we ask the system to prove a goal we add the goal "display_bindings"
-# to the list of goals to prove.  When the system tries to prove it, the
-# retrieved value from the database will be the function `display_bindings`
-# instead of a list of clauses.  Our `prove` function will detect that this
-# is not a list of clauses, call `display_bindings` with the current state of
-# the system, and return the return value of that function call.  We will let
-# `display_bindings` decide how to handle finding more solutions.
+# We accomplish this task with `resolve`, which generates the solutions one at
+# a time.  `prolog_prove` shows the bindings of each to the user, and asks
+# whether to continue; if so, it asks `resolve` for the next solution, which
+# backtracks just as if the goals had failed.  Since the bindings are shown
+# between solutions rather than by a goal, a monitor profiling or tracing the
+# query, and its budget, see only the user's own goals.
 
 # ----------------------------------------------------------------------------
 
-def prolog_prove(goals, db):
-    """Prove each goal in goals using the rules and facts in db."""
+def prolog_prove(goals, db, monitor=None, budget=None):
+    """
+    Prove each goal in goals using the rules and facts in db, telling the
+    monitor, if given, of each port of each call, and charging each goal tried
+    to the budget, if given.
+    """
     if goals:
-        vars = []
-        for goal in goals:
-            vars.extend(goal.get_vars())
-        db['display_bindings'] = display_bindings
-        prove_all(goals + [Relation('display_bindings', vars)], {}, db)
+        vars = query_vars(goals)
+        for bindings in resolve(goals, {}, db, monitor=monitor,
+                                budget=budget):
+            if not display_bindings(vars, bindings):
+                break
     print 'No.'
 
-def display_bindings(vars, bindings, db, remaining):
+def display_bindings(vars, bindings):
     """
-    Displays bindings to the user and determines if more solutions are needed.
-
-    If the user wants to see another solution, returns False, causing the
-    proving process to fail and try another path.  Otherwise, continues proving
-    the remaining goals.
+    Displays bindings to the user and returns whether they want another
+    solution.
     """
     if not vars:
         print 'Yes.'
     for var in vars:
         print var, ':', var.lookup(bindings)
-    if raw_input('Continue? ').strip().lower() in ('yes', 'y'):
-        return False
-    return prove_all(remaining, bindings, db)
+    return raw_input('Continue? ').strip().lower() in ('yes', 'y')
+
+# ----------------------------------------------------------------------------
+# <a id="builtins"></a>
+## Built-in predicates
+
+# Some relations are better proved by computing than by searching the
+# database.  Counting with relations, say with `0`, `+1(0)`, `+1(+1(0))` and
+# so on, takes time and space proportional to the numbers involved; Python can
+# add them in a single step.
+#
+# A *built-in predicate* is a Python function of the arguments of a goal and
+# the current bindings.  It may extend the bindings, and returns whether it
+# succeeded.  A built-in with more than one solution is instead a generator,
+# extending the bindings and yielding once for each solution; when we
+# backtrack into it, the bindings of the last solution are undone before it
+# continues.  Built-ins are wrapped in `Builtin` and stored in the database
+# with `define_procedure`, like any other procedure, except that the prover
+# takes care of the remaining goals.  Built-ins that use the database itself
+# are also given it, as a third argument.
+#
+# The standard built-ins are stored in a database of their own, `BUILTINS`,
+# which is consulted for any predicate with no clauses in the database being
+# used.
+
+class Builtin(object):
+
+    """A predicate proved by a Python function."""
+
+    def __init__(self, function, deterministic=True, database=False):
+        self.function = function
+        self.deterministic = deterministic
+        self.database = database
+
+    def __repr__(self):
+        return '<builtin %s>' % self.function.__name__
+
+def builtin_solutions(builtin, args, bindings, pending, db):
+    """Generate the pending goals for each solution of a built-in."""
+    mark = bindings.mark()
+    if builtin.database:
+        solutions = builtin.function(args, bindings, db)
+    else:
+        solutions = builtin.function(args, bindings)
+    for solution in solutions:
+        yield pending
+        bindings.undo(mark)
+
+BUILTINS = {}
+
+def builtin(name, deterministic=True, database=False):
+    """Define the decorated function as a standard built-in."""
+    def define(function):
+        define_procedure(BUILTINS, name,
+                         Builtin(function, deterministic, database))
+        return function
+    return define
+
+### Arithmetic
+
+# Numbers are atoms whose values are Python ints or floats.  Arithmetic is
+# done by *evaluating* an expression, a relation whose predicate is one of
+# the operators below, with numbers or other expressions as arguments.  The
+# built-in `is(?x, expr)` unifies `?x` with the value of `expr`, and the
+# comparisons `<`, `>`, `=<`, `>=`, `=:=` (equal) and `=\=` (not equal) compare
+# the values of two expressions.  Every variable in an expression must be
+# bound to a number by the time it is evaluated.
+
+class EvaluationError(Exception):
+    def __init__(self, err):
+        Exception.__init__(self, err) # so that it can be pickled
+        self.err = err
+
+    def __str__(self):
+        return 'Evaluation error: %s' % self.err
+
+
+def divide(x, y):
+    # Dividing integers gives an integer if it can, as in most Prologs.
+    if isinstance(x, (int, long)) and isinstance(y, (int, long)) and not x % y:
+        return x // y
+    return float(x) / y
+
+def int_divide(x, y):
+    # Integer division truncates towards zero.
+    if not isinstance(x, (int, long)) or not isinstance(y, (int, long)):
+        raise EvaluationError('// needs integers, not %s and %s' % (x, y))
+    quotient = abs(x) // abs(y)
+    return quotient if (x < 0) == (y < 0) else -quotient
+
+def modulo(x, y):
+    if not isinstance(x, (int, long)) or not isinstance(y, (int, long)):
+        raise EvaluationError('mod needs integers, not %s and %s' % (x, y))
+    return x % y
+
+OPERATORS = {
+    ('+', 2): lambda x, y: x + y,
+    ('-', 2): lambda x, y: x - y,
+    ('*', 2): lambda x, y: x * y,
+    ('/', 2): divide,
+    ('//', 2): int_divide,
+    ('mod', 2): modulo,
+    ('min', 2): min,
+    ('max', 2): max,
+    ('-', 1): lambda x: -x,
+    ('abs', 1): abs,
+}
+
+def evaluate(expr, bindings):
+    """Return the value of the arithmetic expression expr under bindings."""
+    expr = bindings.deref(expr)
+    if isinstance(expr, Atom):
+        if isinstance(expr.atom, (int, long, float)):
+            return expr.atom
+        raise EvaluationError('%s is not a number' % expr)
+    if isinstance(expr, Var):
+        raise EvaluationError('%s is unbound' % expr)
+    if isinstance(expr, Relation):
+        operator = OPERATORS.get((expr.pred, len(expr.args)))
+        if operator is None:
+            raise EvaluationError('%s is not an arithmetic operator' %
+                                  expr.pred)
+        try:
+            return operator(*[evaluate(arg, bindings) for arg in expr.args])
+        except ZeroDivisionError:
+            raise EvaluationError('division by zero in %s' %
+                                  bindings.instantiate(expr))
+    raise EvaluationError('%s is not an expression' % expr)
+
+@builtin('is')
+def is_(args, bindings):
+    x, expr = args
+    return bindings.unify(x, Atom(evaluate(expr, bindings)))
+
+def comparison(name, compare):
+    @builtin(name)
+    def compare_values(args, bindings):
+        x, y = args
+        return compare(evaluate(x, bindings), evaluate(y, bindings))
+    compare_values.__name__ = name
+
+comparison('<', lambda x, y: x < y)
+comparison('>', lambda x, y: x > y)
+comparison('=<', lambda x, y: x <= y)
+comparison('>=', lambda x, y: x >= y)
+comparison('=:=', lambda x, y: x == y)
+comparison('=\\=', lambda x, y: x != y)
+
+# Arithmetic expressions and comparisons are written with infix operators.
+# Expressions are parenthesized when printed; comparisons are not.
+INFIX = {'+': False, '-': False, '*': False, '/': False, '//': False,
+         'mod': False, 'is': True, '<': True, '>': True, '=<': True,
+         '>=': True, '=:=': True, '=\\=': True}
+
+### Lists
+
+# `length(?list, ?n)`, `nth(?n, ?list, ?x)` (counting from 1) and
+# `append(?x, ?y, ?xy)` work a segment at a time rather than an element at a
+# time, so that the length or nth element of a list held in a single segment
+# is found at once, and appending a list to another shares the second list.
+# Like their Prolog counterparts, they also work backwards: `length` of a list
+# with a variable tail extends it with new variables, and `append` with an
+# unbound first argument splits its third.
+
+def unify_all(bindings, pairs):
+    """Unify each pair of terms, leaving the bindings unchanged on failure."""
+    mark = bindings.mark()
+    for x, y in pairs:
+        if not bindings.unify(x, y):
+            bindings.undo(mark)
+            return False
+    return True
+
+def new_vars(n):
+    return [Var.get_unused_var() for i in xrange(n)]
+
+def integer(term, bindings):
+    """Return the value of term if it is bound to an integer, else None."""
+    term = bindings.deref(term)
+    if isinstance(term, Atom) and isinstance(term.atom, (int, long)):
+        return term.atom
+    return None
+
+@builtin('length', deterministic=False)
+def length(args, bindings):
+    items, n = args
+    elements, tail = bindings.elements(items)
+    count = len(elements)
+    if tail == NIL:
+        if bindings.unify(n, Atom(count)):
+            yield True
+    elif isinstance(tail, Var):
+        wanted = integer(n, bindings)
+        if wanted is not None:
+            if wanted >= count:
+                bindings.bind(tail, make_list(new_vars(wanted - count)))
+                yield True
+        elif isinstance(bindings.deref(n), Var):
+            for extra in itertools.count():
+                if unify_all(bindings, [(tail, make_list(new_vars(extra))),
+                                        (n, Atom(count + extra))]):
+                    yield True
+
+@builtin('nth', deterministic=False)
+def nth(args, bindings):
+    n, items, x = args
+    index = integer(n, bindings)
+    if index is not None:
+        term = bindings.drop(items, index - 1) if index > 0 else None
+        if type(term) is List and bindings.unify(term.head(), x):
+            yield True
+        return
+    elements, tail = bindings.elements(items)
+    for i, element in enumerate(elements):
+        if unify_all(bindings, [(n, Atom(i + 1)), (x, element)]):
+            yield True
+
+@builtin('append', deterministic=False)
+def append(args, bindings):
+    first, second, both = args
+    elements, tail = bindings.elements(first)
+    if tail == NIL:
+        if bindings.unify(both, make_list(elements, second)):
+            yield True
+        return
+    if not isinstance(tail, Var):
+        return
+    # The first list is partial, so find every way of splitting the third.
+    all_elements, all_tail = bindings.elements(both)
+    if all_tail == NIL:
+        for i in xrange(len(elements), len(all_elements) + 1):
+            if unify_all(bindings,
+                         [(first, make_list(all_elements[:i])),
+                          (second, bindings.drop(both, i))]):
+                yield True
+        return
+    # Otherwise there are infinitely many ways.
+    for i in itertools.count(len(elements)):
+        prefix = elements + new_vars(i - len(elements))
+        if unify_all(bindings, [(tail, make_list(prefix[len(elements):])),
+                                (both, make_list(prefix, second))]):
+            yield True
+
+### Changing the database
+
+# `assertz(clause)` adds a clause after the others of its predicate, and
+# `asserta(clause)` before them.  `retract(clause)` removes the first clause
+# that unifies with its argument, and on backtracking the next.  A clause is
+# written as a term `(head :- body)`, or as just its head for a fact;
+# `retract(head)` only removes facts.  Asserted clauses are copies, with the
+# variables bound when they were asserted replaced by their values.
+
+def clause_term(clause):
+    """Return the term `(head :- body)` for clause."""
+    return Relation(':-', (clause.head, conjunction(clause.body)))
+
+def term_clause(term):
+    """Return the clause written as term, or None if it isn't a clause."""
+    body = []
+    if isinstance(term, Relation) and term.pred == ':-' and len(term.args) == 2:
+        term, goal = term.args
+        while (isinstance(goal, Relation) and goal.pred == ','
+               and len(goal.args) == 2):
+            body.append(goal.args[0])
+            goal = goal.args[1]
+        if not goal == TRUE:
+            body.append(goal)
+    if isinstance(term, Atom) and isinstance(term.atom, str):
+        term = Relation(term.atom, ())
+    if not isinstance(term, Relation) or term.pred in CONTROL:
+        return None
+    if not all(isinstance(goal, Relation) for goal in body):
+        return None
+    return Clause(term, body)
+
+def retractions(db, term, bindings):
+    """
+    Remove each clause in db that unifies with the clause term in turn,
+    extending bindings, and yield after each.
+    """
+    term = bindings.deref(term)
+    if not (isinstance(term, Relation) and term.pred == ':-'
+            and len(term.args) == 2):
+        term = Relation(':-', (term, TRUE))
+    head = bindings.deref(term.args[0])
+    if isinstance(head, Atom):
+        head = Relation(head.atom, ())
+    if not isinstance(head, Relation):
+        return
+    table = db.get(head.pred)
+    if isinstance(table, FactTable):
+        # Facts have the body `true`.
+        mark = bindings.mark()
+        if bindings.unify(term.args[1], TRUE):
+            for row in table.matches(head, bindings):
+                if table.discard(row):
+                    yield table.fact(row)
+        bindings.undo(mark)
+        return
+    if not isinstance(table, list):
+        return
+    predicate = retrieve(db, head.pred)
+    clauses = predicate.candidates(head.args, bindings)
+    for clause in itertools.islice(clauses, len(clauses)):
+        mark = bindings.mark()
+        if (bindings.unify(term, clause_term(clause.recursive_rename()))
+            and predicate.discard(clause)):
+            yield clause
+        bindings.undo(mark)
+
+@builtin('assertz', database=True)
+def assertz_(args, bindings, db):
+    clause = term_clause(bindings.instantiate(args[0]))
+    if clause is not None:
+        assertz(db, clause)
+    return clause is not None
+
+@builtin('asserta', database=True)
+def asserta_(args, bindings, db):
+    clause = term_clause(bindings.instantiate(args[0]))
+    if clause is not None:
+        asserta(db, clause)
+    return clause is not None
+
+@builtin('retract', deterministic=False, database=True)
+def retract_(args, bindings, db):
+    return retractions(db, args[0], bindings)
+
+# ----------------------------------------------------------------------------
+# <a id="tabling"></a>
+## Tabling
+
+# Some perfectly sensible rules send our prover into an infinite loop.
+# Consider finding the nodes reachable in a graph:
+#
+#     reachable(?x, ?y) :- linked(?x, ?y)
+#     reachable(?x, ?y) :- reachable(?x, ?z), linked(?z, ?y)
+#
+# To prove `reachable(a, ?y)` with the second rule we must first prove
+# `reachable(a, ?z)`, which is the same goal again, and so on forever.  Even
+# rules that do terminate may prove the same subgoals over and over, taking
+# time exponential in the size of the graph.
+#
+# *Tabling* solves both problems.  The first time a goal of a tabled
+# predicate is proved, we find *all* of its answers and record them in a
+# table; any later goal that is a *variant* of it (the same up to renaming its
+# variables) simply reads the table.  To find the answers, we prove the goal
+# with each of the predicate's clauses, and whenever a proof needs a variant
+# of a goal whose table is still being filled in, it uses the answers found
+# so far.  We repeat this until no new answers turn up, at which point the
+# table is *complete*.
+#
+# Tables that are filled in only because another table needs them are found
+# the same way.  When proving goal A needs a new table B, we set A aside,
+# complete B first, and then go back to A.  If B in turn needs A's answers,
+# the two depend on each other, and we repeat them both until neither finds
+# new answers.  For predicates without function symbols, where the number of
+# possible answers is finite, this always terminates.
+#
+# Tabling is opt-in, since it changes the order of solutions and finds all of
+# a goal's answers even if only one is wanted.  The tables last for a single
+# call of `resolve`, unless it is given a `Tabling` to keep them in.
+
+# ----------------------------------------------------------------------------
+
+def table(db, pred):
+    """Declare that goals with predicate pred are to be proved by tabling."""
+    predicate = retrieve(db, pred)
+    predicate.tabled = True
+    predicate.version += 1 # tabling changes the order of answers
+
+def variant_key(term, bindings):
+    """
+    Return a hashable key for term under bindings, such that two terms have
+    the same key exactly when they are variants of each other.
+    """
+    # We list the parts of term in order, tagged with their type, numbering
+    # the variables by their first appearance.
+    key = []
+    numbers = {}
+    terms = [term]
+    while terms:
+        term = terms.pop()
+        while isinstance(term, Var) and term in bindings:
+            term = bindings[term]
+        if isinstance(term, Var):
+            key.extend((Var, numbers.setdefault(term, len(numbers))))
+        elif isinstance(term, Relation):
+            key.extend((Relation, term.pred, len(term.args)))
+            terms.extend(reversed(term.args))
+        elif isinstance(term, List):
+            # The same list may be split into segments differently.
+            elements = []
+            while isinstance(term, List):
+                elements.extend(term.segment())
+                term = deref(term.tail, bindings)
+            key.extend((List, len(elements)))
+            terms.append(term)
+            terms.extend(reversed(elements))
+        else:
+            key.extend((Atom, term.atom))
+    return tuple(key)
+
+
+class AnswerTable(object):
+
+    """The answers found so far for a variant of a tabled goal."""
+
+    def __init__(self, goal):
+        self.goal = goal
+        # Each answer is stored along with its variables, if any, which must
+        # be renamed before it is used.
+        self.answers = []
+        self.keys = set()
+        self.complete = False
+        # While the table is being completed, the position on the stack of
+        # tables (see below) of the deepest table its answers depend on, and
+        # the tables that must be completed along with it.
+        self.position = None
+        self.depends = None
+        self.members = []
+
+    def add(self, answer):
+        """Add an answer if it is new.  Returns whether it was."""
+        key = variant_key(answer, {})
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        self.answers.append((answer, answer.get_vars()))
+        return True
+
+
+class NewTable(Exception):
+
+    """Raised to set aside a goal whose proof needs a new table."""
+
+    def __init__(self, table):
+        self.table = table
+
+
+class Tabling(object):
+
+    """The answer tables for the tabled goals met in one proof."""
+
+    def __init__(self, monitor=None, budget=None):
+        self.tables = {}
+        self.monitor = monitor
+        self.budget = budget
+        # The tables being completed, innermost last, or None if we aren't
+        # completing any.
+        self.stack = None
+
+    def answers(self, goal, bindings, pending, db):
+        """
+        Generate the new pending goals for each answer of a tabled goal,
+        completing its table first if needed.
+        """
+        key = variant_key(goal, bindings)
+        table = self.tables.get(key)
+        if table is None:
+            table = self.tables[key] = AnswerTable(bindings.instantiate(goal))
+            if self.stack is not None:
+                raise NewTable(table)
+            self.complete(table, db)
+        elif not table.complete:
+            # The answers to the goal being proved depend on this table, so
+            # they can't be complete before it is.
+            top = self.stack[-1]
+            top.depends = min(top.depends, table.position)
+
+        # Answers are read by position, since more may be added while we are
+        # using them.
+        mark = bindings.mark()
+        i = 0
+        while i < len(table.answers):
+            answer, vars = table.answers[i]
+            i += 1
+            if vars:
+                answer = answer.rename_vars(
+                    {v: Var.get_unused_var() for v in vars})
+            if bindings.unify(goal, answer):
+                yield pending
+                bindings.undo(mark)
+
+    def complete(self, table, db):
+        """Find all the answers to the goal of table."""
+        self.stack = [table]
+        try:
+            self.complete_stack(db)
+        finally:
+            # If we were interrupted, forget the tables we didn't complete.
+            for key, table in self.tables.items():
+                if not table.complete:
+                    del self.tables[key]
+            self.stack = None
+
+    def complete_stack(self, db):
+        stack = self.stack
+        stack[0].position = 0
+        while stack:
+            top = stack[-1]
+            try:
+                # Find answers for the top table and those that must be
+                # completed with it, until no new ones turn up.
+                # If they use no incomplete tables, once is enough.
+                group = [top] + top.members
+                while True:
+                    top.depends = top.position + 1
+                    found = False
+                    for table in group:
+                        found |= self.evaluate(table, db)
+                    if not found or top.depends != top.position:
+                        break
+            except NewTable as e:
+                # Complete the new table before coming back to top.
+                e.table.position = len(stack)
+                stack.append(e.table)
+                continue
+
+            stack.pop()
+            if top.depends < top.position:
+                # The answers depend on a table deeper in the stack, so we
+                # will find them again along with the table below.
+                below = stack[-1]
+                below.members.extend(group)
+                for table in group:
+                    table.position = below.position
+                top.members = []
+            else:
+                for table in group:
+                    table.complete = True
+                top.members = []
+
+    def evaluate(self, table, db):
+        """Prove the goal of table with each clause, adding new answers."""
+        found = False
+        goal = table.goal
+        clauses = retrieve(db, goal.pred, goal.args)
+        for clause in itertools.islice(clauses, len(clauses)):
+            bindings = Bindings()
+            body = clause.compile().match(goal, bindings)
+            if body is None:
+                continue
+            for solution in resolve(body, bindings, db, self, self.monitor,
+                                    self.budget):
+                found |= table.add(solution.instantiate(goal))
+        return found
+
+
+# ----------------------------------------------------------------------------
+# <a id="profiling"></a>
+## Profiling
+
+# When a query is slow, we want to know which predicates it spends its time
+# on.  A good way to see what the prover is doing is the *box model* of Prolog
+# execution, due to Lawrence Byrd.  Each call of a goal is a box with four
+# *ports*, through which control passes:
+#
+# - *call*, when the goal is first proved;
+# - *exit*, each time it is proved, with a solution;
+# - *redo*, each time we backtrack into it, looking for another solution;
+# - *fail*, when it has no solutions left.
+#
+# When `resolve` is given a *monitor*, it keeps a `Frame` for each call, and
+# tells the monitor as control passes through each port.  A frame is pushed
+# on the goal stack beneath the body of the clause proving its call, so the
+# call exits when the frame is popped.  Each choice point remembers the frame
+# of its call, so a call fails when its choice point runs out of
+# alternatives.  Backtracking into a choice point is a redo of its call and
+# of every enclosing call that had already exited.
+#
+# A monitor also hears of each clause whose head unifies with a call.  Without
+# a monitor, none of this is done, and the prover runs as fast as before.
+
+class Frame(object):
+
+    """A call of a goal, while it is being proved."""
+
+    __slots__ = ('goal', 'parent', 'depth', 'clause', 'active', 'info')
+
+    def __init__(self, goal, parent):
+        self.goal = goal
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        # The clause being used to prove the goal, if any, and whether we are
+        # proving it (rather than having exited).
+        self.clause = None
+        self.active = True
+        # Anything the monitor wants to keep about the call.
+        self.info = None
+
+def redo(frame, bindings, monitor):
+    """Tell monitor of the redo of frame and the exited calls enclosing it."""
+    frames = []
+    while frame is not None and not frame.active:
+        frames.append(frame)
+        frame = frame.parent
+    for frame in reversed(frames):
+        frame.active = True
+        monitor.redo(frame, bindings)
+
+# ----------------------------------------------------------------------------
+
+# A `Profile` is a monitor that counts how many times control passes through
+# each port of each predicate, and times the calls.  The *inclusive* time of a
+# predicate is the time spent between entering its calls (by call or redo) and
+# leaving them (by exit or fail), including the time spent proving their
+# subgoals; for recursive predicates, only the outermost call is counted.  Its
+# *exclusive* time leaves out the time spent in other calls: it is the time
+# between each port and the next, charged to the call that is proving goals
+# in the meantime.  The same counts and times are kept for each clause: a
+# clause is entered when it is chosen to prove a call or the call is redone,
+# and left when the call exits or fails or another clause is chosen.
+
+class Counts(object):
+
+    """The counts and times of the ports of a predicate or clause."""
+
+    __slots__ = ('calls', 'exits', 'redos', 'fails', 'inclusive',
+                 'exclusive', 'active', 'entered')
+
+    def __init__(self):
+        self.calls = self.exits = self.redos = self.fails = 0
+        self.inclusive = self.exclusive = 0.0
+        # The number of calls being proved, and when the outermost began.
+        self.active = 0
+        self.entered = None
+
+
+class Profile(object):
+
+    """A monitor counting the ports of each predicate and clause."""
+
+    def __init__(self, clock=None):
+        self.clock = clock or timeit.default_timer
+        self.predicates = {}
+        self.clauses = {}
+        # The call proving goals since the last port, and when it was.
+        self.running = None
+        self.last = None
+
+    def counts(self, pred):
+        counts = self.predicates.get(pred)
+        if counts is None:
+            counts = self.predicates[pred] = Counts()
+        return counts
+
+    def switch(self, frame):
+        """Charge the time since the last port, and switch to frame."""
+        now = self.clock()
+        running = self.running
+        if running is not None:
+            running.info.exclusive += now - self.last
+            if running.clause is not None:
+                self.clauses[running.clause].exclusive += now - self.last
+        self.running = frame
+        self.last = now
+        return now
+
+    def enter(self, frame):
+        counts = frame.info
+        counts.active += 1
+        if counts.active == 1:
+            counts.entered = self.switch(frame)
+        else:
+            self.switch(frame)
+        return counts
+
+    def leave(self, frame):
+        counts = frame.info
+        now = self.switch(frame.parent)
+        counts.active -= 1
+        if counts.active == 0:
+            counts.inclusive += now - counts.entered
+        return counts
+
+    def enter_clause(self, clause):
+        counts = self.clauses[clause]
+        counts.active += 1
+        if counts.active == 1:
+            counts.entered = self.last
+        return counts
+
+    def leave_clause(self, clause):
+        counts = self.clauses[clause]
+        counts.active -= 1
+        if counts.active == 0:
+            counts.inclusive += self.last - counts.entered
+        return counts
+
+    def call(self, frame, bindings):
+        frame.info = self.counts(frame.goal.pred)
+        self.enter(frame).calls += 1
+
+    def exit(self, frame, bindings):
+        self.leave(frame).exits += 1
+        if frame.clause is not None:
+            self.leave_clause(frame.clause).exits += 1
+
+    def redo(self, frame, bindings):
+        self.enter(frame).redos += 1
+        if frame.clause is not None:
+            self.enter_clause(frame.clause).redos += 1
+
+    def fail(self, frame, bindings):
+        self.leave(frame).fails += 1
+        if frame.clause is not None:
+            self.leave_clause(frame.clause).fails += 1
+
+    def clause(self, frame, clause, bindings, mark):
+        # The time until now was spent on the clause used before, if any,
+        # which failed to prove the call again.
+        self.switch(frame)
+        if frame.clause is not None:
+            self.leave_clause(frame.clause).fails += 1
+        if clause not in self.clauses:
+            self.clauses[clause] = Counts()
+        self.enter_clause(clause).calls += 1
+
+    def table(self):
+        """
+        Return a list of `(pred, calls, exits, redos, fails, inclusive,
+        exclusive)` rows, one for each predicate, most inclusive time first.
+        """
+        rows = [(pred, c.calls, c.exits, c.redos, c.fails, c.inclusive,
+                 c.exclusive) for pred, c in self.predicates.items()]
+        rows.sort(key=lambda row: (-row[5], row[0]))
+        return rows
+
+    def clause_table(self, db, pred):
+        """
+        Return a list of `(clause, calls, exits, redos, fails, inclusive,
+        exclusive)` rows for each clause of pred in db, in order.
+        """
+        rows = []
+        for clause in retrieve(db, pred):
+            c = self.clauses.get(clause) or Counts()
+            rows.append((clause, c.calls, c.exits, c.redos, c.fails,
+                         c.inclusive, c.exclusive))
+        return rows
+
+    def format(self, db=None):
+        """
+        Return the table as a string, followed for each predicate by the
+        counts of its clauses if db is given.
+        """
+        lines = ['%-20s %8s %8s %8s %8s %10s %10s' % (
+            'Predicate', 'Call', 'Exit', 'Redo', 'Fail', 'Incl (s)',
+            'Excl (s)')]
+        for row in self.table():
+            lines.append('%-20s %8d %8d %8d %8d %10.4f %10.4f' % row)
+            if db is not None and isinstance(db.get(row[0]), list):
+                for i, clause_row in enumerate(self.clause_table(db, row[0])):
+                    lines.append('  %-18s %8d %8d %8d %8d %10.4f %10.4f  %s'
+                                 % (('#%d' % (i + 1),) + clause_row[1:] +
+                                    clause_row[:1]))
+        return '\n'.join(lines)
+
+
+# ----------------------------------------------------------------------------
+# <a id="tracing"></a>
+## Tracing
+
+# To see exactly how a goal is proved, a `Tracer` monitor turns each port into
+# a `TraceEvent` and hands it to a *sink*, which is any function of one
+# argument.  Besides the four ports, there is a *clause* event for each clause
+# whose head unifies with a call, listing the variables that unification bound
+# and their values.  The goal of each event is instantiated with the bindings
+# at the time, and its depth is the number of calls enclosing it.
+#
+# Like any monitor, a tracer costs nothing unless it is used.  In particular,
+# nothing is formatted unless the sink formats it: `print_trace` prints each
+# event, indented by its depth, and `log_trace` logs it at the debug level.
+
+class TraceEvent(object):
+
+    """Something that happened while proving a goal."""
+
+    __slots__ = ('port', 'goal', 'clause', 'bindings', 'depth')
+
+    def __init__(self, port, goal, depth, clause=None, bindings=()):
+        self.port = port
+        self.goal = goal
+        self.depth = depth
+        self.clause = clause
+        self.bindings = bindings
+
+    def __repr__(self):
+        if self.port == 'clause':
+            bound = ', '.join('%s: %s' % b for b in self.bindings)
+            return '%sClause: %s {%s}' % ('  ' * self.depth, self.clause,
+                                           bound)
+        return '%s%s: %s' % ('  ' * self.depth, self.port.capitalize(),
+                             self.goal)
+
+
+class Tracer(object):
+
+    """A monitor sending an event for each port to a sink."""
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    def event(self, port, frame, bindings):
+        self.sink(TraceEvent(port, bindings.instantiate(frame.goal),
+                             frame.depth))
+
+    def call(self, frame, bindings):
+        self.event('call', frame, bindings)
+
+    def exit(self, frame, bindings):
+        self.event('exit', frame, bindings)
+
+    def redo(self, frame, bindings):
+        self.event('redo', frame, bindings)
+
+    def fail(self, frame, bindings):
+        self.event('fail', frame, bindings)
+
+    def clause(self, frame, clause, bindings, mark):
+        delta = [(var, bindings.instantiate(var))
+                 for var in bindings.trail[mark:]]
+        self.sink(TraceEvent('clause', bindings.instantiate(frame.goal),
+                             frame.depth, clause, delta))
+
+
+def print_trace(event):
+    """A sink printing each event."""
+    print event
+
+def log_trace(event):
+    """A sink logging each event at the debug level."""
+    logging.debug('%s', event)
+
+# ----------------------------------------------------------------------------
+
+# To both trace and profile a proof, we can combine monitors.
+
+class Monitors(object):
+
+    """A monitor telling each of several monitors of each port."""
+
+    def __init__(self, monitors):
+        self.monitors = monitors
+
+    def call(self, frame, bindings):
+        for monitor in self.monitors:
+            monitor.call(frame, bindings)
+
+    def exit(self, frame, bindings):
+        for monitor in self.monitors:
+            monitor.exit(frame, bindings)
+
+    def redo(self, frame, bindings):
+        for monitor in self.monitors:
+            monitor.redo(frame, bindings)
+
+    def fail(self, frame, bindings):
+        for monitor in self.monitors:
+            monitor.fail(frame, bindings)
+
+    def clause(self, frame, clause, bindings, mark):
+        for monitor in self.monitors:
+            monitor.clause(frame, clause, bindings, mark)
+
+
+# ----------------------------------------------------------------------------
+# <a id="budgets"></a>
+## Budgets
+
+# A proof can go on forever: rules like `reachable` in the graph example
+# loop, and even proofs that end may take far longer than anyone will wait.
+# So that a runaway query can't hold up the program proving it, a proof can
+# be given a `Budget`, which limits the number of *inferences* (goals tried)
+# it may make, the time it may take, or both.  It can also be cancelled,
+# perhaps from another thread, by setting an event such as a
+# `threading.Event`.  Once the budget runs out the proof stops, raising
+# `BudgetExceeded` from wherever it was.
+#
+# The budget also keeps statistics of the proof: the number of inferences made
+# so far, and the deepest goal, the goal tried with the most choice points
+# (calls not yet done with) beneath it.  When a proof is stopped, they show
+# how far it had got; a deepest goal that is very deep usually means it was
+# looping.
+#
+# Counting inferences takes very little time, but looking at the clock and
+# the cancellation event takes a little more, so we only do so every
+# `interval` inferences.
+#
+# A looping proof's deepest goal may itself be huge, too deep even to print,
+# so the exception only keeps its predicate and arity, and an abbreviation
+# of it with the deeper parts left out.
+
+class BudgetExceeded(Exception):
+    def __init__(self, reason, inferences, deepest, goal, elapsed,
+                 predicate=None):
+        Exception.__init__(self, reason, inferences, deepest, goal, elapsed,
+                           predicate)
+        self.reason = reason
+        self.inferences = inferences
+        self.deepest = deepest
+        self.goal = goal
+        self.elapsed = elapsed
+        self.predicate = predicate
+
+    def __str__(self):
+        return ('Budget exceeded (%s) after %d inferences in %.3fs; '
+                'deepest goal %s at depth %d' %
+                (self.reason, self.inferences, self.elapsed, self.goal,
+                 self.deepest))
+
+ELLIPSIS = Atom('...')
+
+def abbreviate(term, depth=4, width=8):
+    """
+    Return term with its parts nested more than depth deep, and the arguments
+    or elements after the first width, replaced by `...`.
+    """
+    if isinstance(term, (Relation, List)) and depth == 0:
+        return ELLIPSIS
+    if isinstance(term, Relation):
+        args = [abbreviate(arg, depth - 1, width) for arg in term.args[:width]]
+        if len(term.args) > width:
+            args.append(ELLIPSIS)
+        return Relation(term.pred, args)
+    if isinstance(term, List):
+        elements, tail = term.elements()
+        items = [abbreviate(item, depth - 1, width)
+                 for item in elements[:width]]
+        if len(elements) > width:
+            items.append(ELLIPSIS)
+        return List(items, abbreviate(tail, depth - 1, width))
+    return term
+
+def describe_goal(goal, length=200):
+    """Return a short description of goal, at most about length long."""
+    text = repr(abbreviate(goal))
+    if len(text) > length:
+        text = text[:length] + '...'
+    return text
+
+
+class Budget(object):
+
+    """Limits on the inferences, time, or both, that proofs may use."""
+
+    interval = 256
+
+    def __init__(self, inferences=None, timeout=None, cancel=None,
+                 clock=None):
+        """
+        Allow at most `inferences` inferences, and `timeout` seconds from now,
+        until `cancel.is_set()` is true.  Each limit is optional.
+        """
+        self.limit = inferences
+        self.clock = clock or timeit.default_timer
+        self.start = self.clock()
+        self.deadline = None if timeout is None else self.start + timeout
+        self.cancel = cancel
+        self.inferences = 0
+        self.deepest = 0
+        self.goal = None
+        self.next_check = 0
+
+    def elapsed(self):
+        return self.clock() - self.start
+
+    def exceeded(self, reason):
+        goal = predicate = None
+        if self.goal is not None:
+            goal = describe_goal(self.goal)
+            if isinstance(self.goal, Relation):
+                predicate = '%s/%d' % (self.goal.pred, len(self.goal.args))
+        return BudgetExceeded(reason, self.inferences, self.deepest, goal,
+                              self.elapsed(), predicate)
+
+    def charge(self, goal, depth):
+        """Charge for trying goal with depth choice points beneath it."""
+        if self.inferences >= self.next_check:
+            self.check()
+        self.inferences += 1
+        if depth >= self.deepest:
+            self.deepest = depth
+            self.goal = goal
+
+    def check(self):
+        """Raise BudgetExceeded if no more inferences may be made."""
+        if self.limit is not None and self.inferences >= self.limit:
+            raise self.exceeded('inferences')
+        if self.deadline is not None and self.clock() > self.deadline:
+            raise self.exceeded('timeout')
+        if self.cancel is not None and self.cancel.is_set():
+            raise self.exceeded('cancelled')
+        self.next_check = self.inferences + self.interval
+        if self.limit is not None:
+            self.next_check = min(self.next_check, self.limit)
+
+
+# ----------------------------------------------------------------------------
+# <a id="caching"></a>
+## Caching answers
+
+# Programs often ask the same questions again and again of a database that
+# seldom changes.  An `AnswerCache` remembers all the answers to each query it
+# has proved, and when it is asked a variant of the query, it returns them
+# without proving anything.
+#
+# An answer stays correct only as long as the clauses used to find it are
+# unchanged.  The clauses a query may use are those of its predicates, the
+# predicates their bodies call, and so on.  Each `Predicate` counts the
+# changes made to it, so we record the count for each predicate the query
+# depends on, and before reusing the answers check that none has changed.
+# Predicates that didn't exist yet count too, since clauses may be stored for
+# them later.  A query using Python procedures or the built-ins that change
+# the database isn't cached at all, since proving it may do more than find
+# answers.
+#
+# Only queries whose answers are all found are cached: a query that was
+# stopped early, by reaching its limit or running out of budget, may have
+# more.  The cache holds the answers to at most `max_queries` queries and at
+# most `max_answers` answers in all, forgetting the least recently used
+# queries to make room for new ones.
+
+class AnswerCache(object):
+
+    """The answers to queries against a database, while they are current."""
+
+    def __init__(self, db, max_queries=1000, max_answers=100000):
+        self.db = db
+        self.max_queries = max_queries
+        self.max_answers = max_answers
+        # For each query's variant key, its answers and the versions of the
+        # predicates it depends on, least recently used first.
+        self.entries = collections.OrderedDict()
+        self.answers = 0
+        # The predicates called by the clauses of each predicate, along with
+        # its version when they were found.
+        self.callees = {}
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def version(self, pred):
+        """Return the state of the clauses of pred."""
+        clauses = self.db.get(pred)
+        return clauses, getattr(clauses, 'version', None)
+
+    def dependencies(self, goals):
+        """
+        Return the versions of the predicates goals depend on, or None if
+        they may change the database.
+        """
+        versions = {}
+        goals = list(goals)
+        while goals:
+            goal = goals.pop()
+            if not isinstance(goal, Relation) or goal.pred in versions:
+                continue
+            if goal.pred in CONTROL:
+                goals.extend(goal.args)
+                continue
+            clauses, version = versions[goal.pred] = self.version(goal.pred)
+            if isinstance(clauses, list):
+                goals.extend(self.called(goal.pred, clauses, version))
+            elif isinstance(clauses, FactTable):
+                continue
+            elif clauses is not None:
+                return None
+            else:
+                query = BUILTINS.get(goal.pred)
+                if query is not None and query.database:
+                    return None
+        return versions
+
+    def called(self, pred, clauses, version):
+        """Return the goals in the bodies of the clauses of pred."""
+        known = self.callees.get(pred)
+        if known is not None and known[0] is clauses and known[1] == version:
+            return known[2]
+        goals = []
+        preds = set()
+        for clause in clauses:
+            for goal in clause.body:
+                if not isinstance(goal, Relation):
+                    continue
+                if goal.pred in CONTROL or goal.pred not in preds:
+                    preds.add(goal.pred)
+                    goals.append(goal)
+        self.callees[pred] = (clauses, version, goals)
+        return goals
+
+    def current(self, versions):
+        """Return whether none of the predicates in versions has changed."""
+        for pred, (clauses, version) in versions.iteritems():
+            if self.db.get(pred) is not clauses:
+                return False
+            if getattr(clauses, 'version', None) != version:
+                return False
+        return True
+
+    def lookup(self, key):
+        """Return the current answers cached for key, or None."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        answers, versions = entry
+        if not self.current(versions):
+            self.answers -= len(answers)
+            return None
+        self.entries[key] = entry # now the most recently used
+        return answers
+
+    def add(self, key, answers, versions):
+        """Cache the answers for key, making room for them if needed."""
+        if len(answers) > self.max_answers or self.max_queries < 1:
+            return
+        while self.entries and (len(self.entries) >= self.max_queries or
+                                self.answers + len(answers) > self.max_answers):
+            _, (forgotten, _) = self.entries.popitem(last=False)
+            self.answers -= len(forgotten)
+        self.entries[key] = (answers, versions)
+        self.answers += len(answers)
+
+    def clear(self):
+        """Forget all the cached answers."""
+        self.entries.clear()
+        self.answers = 0
+
+    def solve(self, goals, limit=None, monitor=None, budget=None):
+        """
+        Generate the solutions of goals as `solve` does, reusing the cached
+        answers to any variant of goals if they are current.
+        """
+        if isinstance(goals, Relation):
+            goals = [goals]
+        vars = query_vars(goals)
+        key = variant_key(conjunction(goals), {})
+        answers = self.lookup(key)
+        if answers is not None:
+            self.hits += 1
+            for solution in template_solutions(vars, answers[:limit]):
+                yield solution
+            return
+
+        self.misses += 1
+        # The dependencies are found before proving goals, which may add
+        # clauses to the database that its answers then depend on.
+        versions = self.dependencies(goals)
+        template = Relation('solution', vars)
+        answers = []
+        found = 0
+        solutions = resolve(goals, {}, self.db, monitor=monitor, budget=budget)
+        for bindings in itertools.islice(solutions, limit):
+            found += 1
+            answer = bindings.instantiate(template)
+            if versions is not None:
+                if len(answers) < self.max_answers:
+                    answers.append(answer)
+                else:
+                    versions = None
+            yield dict(zip(vars, answer.args))
+        # If we stopped at the limit, there may be more answers.
+        if versions is not None and found != limit and self.current(versions):
+            self.add(key, answers, versions)
+
+    def first(self, goals, monitor=None, budget=None):
+        """Return the first solution of goals, or None if there is none."""
+        for solution in self.solve(goals, 1, monitor, budget):
+            return solution
+        return None
+
 
 # ----------------------------------------------------------------------------
 ## Conclusion
@@ -630,6 +3235,10 @@ def display_bindings(vars, bindings, db, remaining):
 # That's all there is to it.  See the examples mentioned earlier for some
 # interesting applications of logic programming.
 
+import array
+import collections
+import itertools
 import logging
+import timeit
 
 __author__ = 'Daniel Connelly (dhconnelly@gmail.com)'
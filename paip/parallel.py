@@ -0,0 +1,299 @@
+"""
+**OR-parallel proving** tries the alternative ways of proving a goal at the
+same time, on different processors.
+
+Our [logic programming library](logic.html) tries the clauses that might
+prove a goal one after another.  But the proofs using different clauses
+share nothing except the goal they started from, so they needn't wait for
+each other: given a query like
+
+    ?- likes(?who, ?what), expensive(?what)
+
+with many `likes` clauses, we can hand the proof using each clause to a
+different process, and merge the solutions they find.  This is called
+*OR-parallelism*, since the alternatives are the branches of an "or".
+
+A `ProverPool` starts a pool of worker processes, each with its own copy of a
+database, which is sent to them just once.  Its `solve` method splits each
+query into branches and generates their solutions, in the order a
+sequential proof would find them or as soon as they are found, and `first`
+returns whichever solution is found first:
+
+    pool = parallel.ProverPool(db, processes=4)
+    for solution in pool.solve([logic.Relation('likes', (x, y))]):
+        print solution[x], solution[y]
+    pool.close()
+
+Its `solve_many` method answers a whole batch of queries instead, handing
+each query to a worker without splitting it (see `logic.solve_many`).
+"""
+
+# -----------------------------------------------------------------------------
+## Table of contents
+
+# 1. [Splitting a query](#splitting)
+# 2. [Workers](#workers)
+# 3. [The pool](#pool)
+
+
+# -----------------------------------------------------------------------------
+# <a id="splitting"></a>
+## Splitting a query
+
+# A query is split at its *choice points*: the first goal of the query, if it
+# has several clauses or is a disjunction `(a ; b)`, is replaced by one
+# *branch* for each alternative.  A branch is the list of goals left to prove
+# after choosing the alternative, with the bindings made so far substituted
+# in, along with a *template* recording the values of the query's variables
+# in terms of the branch's.  Splitting the first goal of each branch again
+# gives more, smaller branches; how many times we do so is the *depth*.
+#
+# Not every choice point can be split.  A cut in a clause commits to that
+# clause, discarding the alternatives that another process may already be
+# proving, so we never split the goals of predicates with cuts in their
+# clauses.  Nor do we split a query with a cut in the goals after the choice
+# point, since the cut would have to discard the other branches too.
+# Tabled predicates, built-ins, and the other control constructs aren't
+# split either.
+
+def has_cut(goals):
+    """Return whether any of goals contains a cut."""
+    goals = list(goals)
+    while goals:
+        goal = goals.pop()
+        if isinstance(goal, logic.Relation):
+            if goal.pred == '!':
+                return True
+            if goal.pred in logic.CONTROL:
+                goals.extend(goal.args)
+    return False
+
+def split(goals, template, db):
+    """
+    Return the branches for each way of proving the first of goals, or None
+    if its choice point can't be split.
+    """
+    # Conjunctions are flattened first.
+    while goals and goals[0].pred in (',', 'true'):
+        goals = list(goals[0].args) + goals[1:]
+    if not goals:
+        return None
+    goal, rest = goals[0], goals[1:]
+    if has_cut(rest):
+        return None
+
+    if goal.pred == ';' and len(goal.args) == 2:
+        left, right = goal.args
+        if has_cut([goal]) or (isinstance(left, logic.Relation)
+                               and left.pred == '->'):
+            return None
+        return [([left] + rest, template), ([right] + rest, template)]
+
+    clauses = db.get(goal.pred)
+    if (not isinstance(clauses, list) or getattr(clauses, 'tabled', False)
+        or any(has_cut(clause.body) for clause in clauses)):
+        return None
+    branches = []
+    bindings = logic.Bindings()
+    pending = logic.push_goals(rest, None)
+    for alternative in logic.alternatives(goal, clauses, bindings, pending):
+        branch = [bindings.instantiate(g)
+                  for g in logic.pending_goals(alternative)]
+        branches.append((branch, bindings.instantiate(template)))
+    return branches
+
+def branches(goals, template, db, depth):
+    """Split goals into branches, depth levels deep."""
+    branches = [(list(goals), template)]
+    for level in xrange(depth):
+        expanded = []
+        for goals, template in branches:
+            parts = split(goals, template, db)
+            expanded.extend([(goals, template)] if parts is None else parts)
+        branches = expanded
+    return branches
+
+
+# -----------------------------------------------------------------------------
+# <a id="workers"></a>
+## Workers
+
+# Each worker process keeps the database it was started with, and proves the
+# branches sent to it, returning the instantiated template for each solution.
+# The variables of a branch were made by the pool's process, and a worker
+# makes its own fresh variables with a counter copied from that process when
+# it was started, so the worker renames the branch's variables apart first.
+# While a pool is answering one query, its workers share an event that is set
+# when the query no longer needs their answers, because it has found enough or
+# been abandoned.  Workers prove their branches with a `logic.Budget` that is
+# cancelled by the event, so they stop soon afterwards.
+
+DB = None
+STOP = None
+
+def install(db, stop):
+    global DB, STOP
+    DB = db
+    STOP = stop
+
+def prove_branch(task):
+    """Return the instantiated template for solutions of a branch."""
+    goals, template, limit, inferences, timeout = task
+    branch = logic.Clause(template, goals).recursive_rename()
+    goals, template = branch.body, branch.head
+    budget = logic.Budget(inferences, timeout, STOP)
+    answers = []
+    try:
+        solutions = logic.resolve(goals, {}, DB, budget=budget)
+        for bindings in itertools.islice(solutions, limit):
+            answers.append(bindings.instantiate(template))
+    except logic.BudgetExceeded as e:
+        if e.reason != 'cancelled':
+            raise
+    return answers
+
+# For a batch of queries, a worker proves whole queries, keeping the tables of
+# tabled predicates until the next batch.
+
+TABLING = None
+BATCH = None
+
+def prove_query(task):
+    """
+    Return the index of a query, the instantiated template for each of its
+    solutions, and the error that stopped it, if any.
+    """
+    global TABLING, BATCH
+    i, goals, template, limit, inferences, timeout, batch = task
+    if batch != BATCH:
+        TABLING = logic.Tabling()
+        BATCH = batch
+    budget = logic.Budget(inferences, timeout, STOP)
+    answers, error = logic.query_answers(goals, template, DB, limit, TABLING,
+                                         budget)
+    return i, answers, error
+
+
+# -----------------------------------------------------------------------------
+# <a id="pool"></a>
+## The pool
+
+# The branches of a query are handed out to the workers in order.  When
+# solutions are wanted in order, we wait for the branches in turn; otherwise
+# we take them as they are finished.  A pool answers one query at a time.
+
+class ProverPool(object):
+
+    """A pool of worker processes proving goals against a database."""
+
+    def __init__(self, db, processes=None, depth=1):
+        """
+        Start processes workers (one per processor by default), each with a
+        copy of db.  Queries are split depth levels deep.
+        """
+        self.db = db
+        self.depth = depth
+        self.stop = multiprocessing.Event()
+        self.batches = 0
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.processes, install,
+                                         (db, self.stop))
+
+    def solve(self, goals, limit=None, ordered=True, inferences=None,
+              timeout=None):
+        """
+        Generate a dictionary of the variables in goals and their values for
+        each solution of goals, at most `limit` of them, as `logic.solve`
+        does.  Unless `ordered`, solutions are generated as they are found,
+        rather than in the order a sequential proof would find them.  Each
+        branch may use at most `inferences` inferences and `timeout` seconds.
+        """
+        if isinstance(goals, logic.Relation):
+            goals = [goals]
+        vars = logic.query_vars(goals)
+        template = logic.Relation('solution', vars)
+        tasks = [(branch, template, limit, inferences, timeout)
+                 for branch, template in branches(goals, template, self.db,
+                                                  self.depth)]
+        self.stop.clear()
+        if ordered:
+            results = self.pool.imap(prove_branch, tasks)
+        else:
+            results = self.pool.imap_unordered(prove_branch, tasks)
+        found = 0
+        try:
+            for answers in results:
+                for answer in answers:
+                    if found == limit:
+                        return
+                    found += 1
+                    yield dict(zip(vars, answer.args))
+        finally:
+            self.finish(results)
+
+    def solve_many(self, queries, limit=None, ordered=True, inferences=None,
+                   timeout=None):
+        """
+        Generate `(i, solutions, error)` for each of queries, as
+        `logic.solve_many` does, with the queries proved by the workers.
+        """
+        batch = logic.batch_queries(queries)
+        self.batches += 1
+        tasks = [(i, goals, template, limit, inferences, timeout, self.batches)
+                 for i, (goals, vars, template, first) in enumerate(batch)
+                 if first == i]
+        self.stop.clear()
+        chunksize = max(1, len(tasks) // (4 * self.processes))
+        if ordered:
+            results = self.pool.imap(prove_query, tasks, chunksize)
+        else:
+            results = self.pool.imap_unordered(prove_query, tasks, chunksize)
+        try:
+            if ordered:
+                answers = {}
+                for i, (goals, vars, template, first) in enumerate(batch):
+                    if first == i:
+                        answers[i] = next(results)[1:]
+                    found, error = answers[first]
+                    yield i, logic.template_solutions(vars, found), error
+            else:
+                # The variants of each query are answered along with it.
+                variants = {}
+                for i, (goals, vars, template, first) in enumerate(batch):
+                    variants.setdefault(first, []).append(i)
+                for first, answers, error in results:
+                    for i in variants[first]:
+                        yield (i, logic.template_solutions(batch[i][1],
+                                                           answers), error)
+        finally:
+            self.finish(results)
+
+    def finish(self, results):
+        """
+        Stop the workers, and wait for them to finish, so that they don't go
+        on with this query while answering the next.
+        """
+        self.stop.set()
+        while True:
+            try:
+                next(results)
+            except StopIteration:
+                break
+            except Exception: # already reported, or not wanted
+                pass
+
+    def first(self, goals, inferences=None, timeout=None):
+        """Return the first solution found, or None if there is none."""
+        for solution in self.solve(goals, 1, False, inferences, timeout):
+            return solution
+        return None
+
+    def close(self):
+        """Shut down the workers."""
+        self.pool.close()
+        self.pool.join()
+
+
+import itertools
+import multiprocessing
+from paip import logic
@@ -0,0 +1,179 @@
+"""
+The lexer prolog.py used before its regular expression lexer, which reads a
+line a character at a time.  The tests check that both find the same tokens,
+and run_benchmarks.py times one against the other.
+
+The only change is that a comment at the very end of the text ends there,
+rather than looping forever.
+"""
+
+from prolog import (TokenError, LPAREN, RPAREN, COMMA, LBRACKET, RBRACKET,
+                    BAR, QUESTION, DEFN_BEGIN, QUERY_BEGIN, NUM, IDENT, WHEN,
+                    CUT, SEMI, ARROW, NOT, ADD_OP, MUL_OP, COMPARE, EOF)
+
+
+class Lexer(object):
+    def __init__(self, line):
+        self.line = line
+        self.pos = 0
+        self.ch = line[self.pos]
+
+    def eat(self):
+        ret = self.ch
+        self.pos += 1
+        if self.pos >= len(self.line):
+            self.ch = EOF
+        else:
+            self.ch = self.line[self.pos]
+        return ret
+
+    def match(self, exp):
+        if self.ch != exp:
+            raise TokenError('expected %s' % exp)
+        self.eat()
+
+    def peek(self):
+        if self.pos + 1 >= len(self.line):
+            return EOF
+        return self.line[self.pos + 1]
+
+    def expect(self, is_type):
+        if not is_type():
+            raise TokenError('expected type %s' % repr(is_type))
+
+    def is_ws(self):
+        return self.ch in (' ', '\t', '\n')
+
+    def DEFN_BEGIN(self):
+        self.match('<')
+        self.match('-')
+        return DEFN_BEGIN, '<-'
+
+    def is_when(self):
+        return self.ch == ':'
+
+    def WHEN(self):
+        self.match(':')
+        self.match('-')
+        return WHEN, ':-'
+
+    def is_number(self):
+        return self.ch in '0123456789'
+
+    def NUM(self):
+        # read the whole part
+        num = ''
+        self.expect(self.is_number)
+        while self.is_number():
+            num += self.eat()
+
+        if not self.ch == '.':
+            return NUM, int(num)
+        num += self.eat()
+
+        # read the fractional part
+        self.expect(self.is_number)
+        while self.is_number():
+            num += self.eat()
+        return NUM, float(num)
+
+    def COMPARE(self):
+        op = self.eat()
+        if op == '=':
+            if self.ch == '<':
+                op += self.eat()
+            elif self.ch in (':', '\\'):
+                op += self.eat()
+                self.expect(lambda: self.ch == '=')
+                op += self.eat()
+            else:
+                raise TokenError('no token begins with =%s' % self.ch)
+        elif self.ch == '=':
+            op += self.eat()
+        return COMPARE, op
+
+    def is_ident(self):
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        return self.ch in letters or self.ch in letters.upper()
+
+    def IDENT(self):
+        ident = ''
+        self.expect(self.is_ident)
+        while self.is_ident() or self.is_number():
+            ident += self.eat()
+        return IDENT, ident
+
+    def comment(self):
+        self.match('#')
+        while self.ch not in ('\n', EOF):
+            self.eat()
+
+    def next(self):
+        while self.pos < len(self.line):
+            if self.is_ws():
+                self.eat()
+                continue
+            if self.ch == '#':
+                self.comment()
+                continue
+            if self.ch == '<' and self.peek() == '-':
+                return self.DEFN_BEGIN()
+            if self.ch in ('<', '>', '='):
+                return self.COMPARE()
+            if self.ch == '?':
+                self.eat()
+                if self.ch == '-':
+                    self.eat()
+                    return QUERY_BEGIN, '?-'
+                return QUESTION, '?'
+            if self.is_ident():
+                return self.IDENT()
+            if self.ch == '-' and self.peek() == '>':
+                self.eat()
+                self.eat()
+                return ARROW, '->'
+            if self.ch == '\\':
+                self.eat()
+                self.match('+')
+                return NOT, '\\+'
+            if self.is_number():
+                return self.NUM()
+            if self.ch in ('+', '-'):
+                return ADD_OP, self.eat()
+            if self.ch == '*':
+                return MUL_OP, self.eat()
+            if self.ch == '/':
+                self.eat()
+                if self.ch == '/':
+                    self.eat()
+                    return MUL_OP, '//'
+                return MUL_OP, '/'
+            if self.is_when():
+                return self.WHEN()
+            if self.ch == '(':
+                return LPAREN, self.eat()
+            if self.ch == ')':
+                return RPAREN, self.eat()
+            if self.ch == ',':
+                return COMMA, self.eat()
+            if self.ch == '[':
+                return LBRACKET, self.eat()
+            if self.ch == ']':
+                return RBRACKET, self.eat()
+            if self.ch == '|':
+                return BAR, self.eat()
+            if self.ch == '!':
+                return CUT, self.eat()
+            if self.ch == ';':
+                return SEMI, self.eat()
+            raise TokenError('no token begins with %s' % self.ch)
+        return EOF, EOF
+
+
+def tokens(line):
+    lexer = Lexer(line)
+    while True:
+        tokt, tok = lexer.next()
+        if tokt == EOF:
+            return
+        yield tokt, tok
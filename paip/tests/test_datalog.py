@@ -0,0 +1,159 @@
+import unittest
+from paip import datalog
+from paip import logic
+
+
+def atoms(*names):
+    return [logic.Atom(name) for name in names]
+
+
+class DatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.x = logic.Var('x')
+        self.y = logic.Var('y')
+        self.z = logic.Var('z')
+
+    def relation(self, pred, *args):
+        return logic.Relation(pred, args)
+
+    def graph_db(self, edges):
+        db = {}
+        for a, b in edges:
+            logic.store(db, logic.Clause(self.relation(
+                'linked', logic.Atom(a), logic.Atom(b))))
+        return db
+
+
+class CheckTests(DatalogTest):
+    def test_function_symbol(self):
+        db = {}
+        logic.store(db, logic.Clause(self.relation(
+            'length', self.relation('pair', self.x, logic.Atom('nil')),
+            logic.Atom(1))))
+        self.assertRaises(datalog.NotDatalog, datalog.check, db)
+
+    def test_unsafe_fact(self):
+        db = {}
+        logic.store(db, logic.Clause(self.relation('likes', self.x, self.x)))
+        self.assertRaises(datalog.NotDatalog, datalog.evaluate, db)
+
+    def test_unsafe_rule(self):
+        db = {}
+        logic.store(db, logic.Clause(self.relation('p', self.x, self.y),
+                                     [self.relation('q', self.x)]))
+        self.assertRaises(datalog.NotDatalog, datalog.check, db)
+
+    def test_procedure(self):
+        db = {}
+        logic.define_procedure(db, 'print', lambda *args: False)
+        self.assertRaises(datalog.NotDatalog, datalog.check, db)
+
+    def test_cut(self):
+        db = self.graph_db([('a', 'b')])
+        logic.store(db, logic.Clause(
+            self.relation('p', self.x),
+            [self.relation('linked', self.x, self.y), logic.CUT]))
+        self.assertRaises(datalog.NotDatalog, datalog.check, db)
+
+    def test_builtin(self):
+        db = self.graph_db([('a', 'b')])
+        logic.store(db, logic.Clause(
+            self.relation('p', self.x),
+            [self.relation('linked', self.x, self.y),
+             self.relation('<', self.x, self.y)]))
+        self.assertRaises(datalog.NotDatalog, datalog.check, db)
+
+    def test_ok(self):
+        db = self.graph_db([('a', 'b')])
+        logic.store(db, logic.Clause(self.relation('p', self.x),
+                                     [self.relation('linked', self.x, self.y)]))
+        datalog.check(db)
+
+
+class EvaluateTests(DatalogTest):
+    def test_facts_only(self):
+        db = self.graph_db([('a', 'b'), ('b', 'c')])
+        model = datalog.evaluate(db)
+        self.assertEqual(set([('a', 'b'), ('b', 'c')]),
+                         model.tables['linked'].rows)
+
+    def test_transitive_closure(self):
+        x, y, z = self.x, self.y, self.z
+        db = self.graph_db([(i, i + 1) for i in range(40)] + [(40, 0)])
+        logic.store(db, logic.Clause(self.relation('reachable', x, y),
+                                     [self.relation('linked', x, y)]))
+        logic.store(db, logic.Clause(self.relation('reachable', x, y),
+                                     [self.relation('reachable', x, z),
+                                      self.relation('reachable', z, y)]))
+        model = datalog.evaluate(db)
+        self.assertEqual(41 * 41, len(model.tables['reachable']))
+
+    def test_family(self):
+        x, y, z = self.x, self.y, self.z
+        db = {}
+        for child, parent in (('charles1', 'james1'),
+                              ('charles2', 'charles1'),
+                              ('sophia', 'elizabeth')):
+            logic.store(db, logic.Clause(self.relation(
+                'parent', logic.Atom(child), logic.Atom(parent))))
+        for name in ('elizabeth', 'sophia'):
+            logic.store(db, logic.Clause(self.relation(
+                'female', logic.Atom(name))))
+        logic.store(db, logic.Clause(self.relation('mother', x, y),
+                                     [self.relation('parent', x, y),
+                                      self.relation('female', y)]))
+        logic.store(db, logic.Clause(self.relation('ancestor', x, y),
+                                     [self.relation('parent', x, y)]))
+        logic.store(db, logic.Clause(self.relation('ancestor', x, y),
+                                     [self.relation('ancestor', x, z),
+                                      self.relation('ancestor', z, y)]))
+        model = datalog.evaluate(db)
+        self.assertEqual([self.relation('mother', *atoms('sophia',
+                                                         'elizabeth'))],
+                         model.facts('mother'))
+        self.assertEqual(set([('charles1', 'james1'), ('charles2', 'charles1'),
+                              ('charles2', 'james1'),
+                              ('sophia', 'elizabeth')]),
+                         model.tables['ancestor'].rows)
+
+    def test_constants_and_repeated_vars(self):
+        x, y = self.x, self.y
+        db = self.graph_db([('a', 'a'), ('a', 'b'), ('b', 'b'), ('c', 'a')])
+        logic.store(db, logic.Clause(self.relation('loop', x),
+                                     [self.relation('linked', x, x)]))
+        logic.store(db, logic.Clause(self.relation('into_a', x),
+                                     [self.relation('linked', x,
+                                                    logic.Atom('a'))]))
+        model = datalog.evaluate(db)
+        self.assertEqual(set([('a',), ('b',)]), model.tables['loop'].rows)
+        self.assertEqual(set([('a',), ('c',)]), model.tables['into_a'].rows)
+
+
+class ModelTests(DatalogTest):
+    def setUp(self):
+        DatalogTest.setUp(self)
+        x, y, z = self.x, self.y, self.z
+        db = self.graph_db([('a', 'b'), ('b', 'c'), ('c', 'd')])
+        logic.store(db, logic.Clause(self.relation('reachable', x, y),
+                                     [self.relation('linked', x, y)]))
+        logic.store(db, logic.Clause(self.relation('reachable', x, y),
+                                     [self.relation('reachable', x, z),
+                                      self.relation('linked', z, y)]))
+        self.model = datalog.evaluate(db)
+
+    def test_solve(self):
+        found = [s[self.y].atom for s in self.model.solve(
+            self.relation('reachable', logic.Atom('b'), self.y))]
+        self.assertEqual(['c', 'd'], sorted(found))
+
+    def test_solve_join(self):
+        goals = [self.relation('reachable', self.x, logic.Atom('d')),
+                 self.relation('linked', logic.Atom('a'), self.x)]
+        self.assertEqual([{self.x: logic.Atom('b')}],
+                         list(self.model.solve(goals)))
+
+    def test_to_db(self):
+        db = self.model.to_db()
+        goal = self.relation('reachable', logic.Atom('a'), self.y)
+        found = [s[self.y].atom for s in logic.solve(goal, db)]
+        self.assertEqual(['b', 'c', 'd'], sorted(found))
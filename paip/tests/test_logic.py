@@ -1,8 +1,31 @@
 import logging
+import pickle
+import StringIO
+import sys
 import unittest
 from paip import logic
 
 
+class AtomTests(unittest.TestCase):
+    def test_interned(self):
+        self.assertTrue(logic.Atom('a') is logic.Atom('a'))
+        self.assertFalse(logic.Atom(1) is logic.Atom(1.0))
+        self.assertEqual(logic.Atom(1), logic.Atom(1.0))
+
+    def test_hashable(self):
+        d = {logic.Atom('a'): 1}
+        self.assertEqual(1, d[logic.Atom('a')])
+        self.assertTrue(logic.Atom('b') != logic.Atom('a'))
+
+    def test_no_dict(self):
+        self.assertFalse(hasattr(logic.Atom('a'), '__dict__'))
+        self.assertFalse(hasattr(logic.Var('x'), '__dict__'))
+
+    def test_pickle(self):
+        a = logic.Atom('a')
+        self.assertTrue(a is pickle.loads(pickle.dumps(a, 2)))
+
+
 class VarTests(unittest.TestCase):
     def test_lookup_none(self):
         bindings = {}
@@ -93,6 +116,82 @@ class RelationTests(unittest.TestCase):
         p2 = logic.Relation('pair', (a, p3))
         p1 = logic.Relation('pair', (y, p2))
         self.assertEqual(set([x, y]), set(p1.get_vars()))
+
+    def test_get_vars_order(self):
+        x, y, z = logic.Var('x'), logic.Var('y'), logic.Var('z')
+        r = logic.Relation('f', (y, logic.List([x, y], z), x))
+        self.assertEqual([y, x, z], r.get_vars())
+        self.assertEqual([y, x, z], logic.query_vars([r, logic.Relation(
+            'g', (z,))]))
+
+    def test_deep(self):
+        # Terms deeper than Python's stack are walked without recursing.
+        depth = 3 * sys.getrecursionlimit()
+        nil = logic.Atom('nil')
+        items = nil
+        for i in range(depth):
+            items = logic.Relation('pair', (logic.Var('e%d' % i), items))
+        self.assertEqual(depth, len(logic.query_vars([items])))
+        bindings = {}
+        term = x = logic.Var('x')
+        for i in range(depth):
+            more = logic.Var('more%d' % i)
+            bindings[term] = logic.Relation('pair', (logic.Atom(i), more))
+            term = more
+        bindings[term] = nil
+        value = x.lookup(bindings)
+        for i in range(depth):
+            self.assertEqual(logic.Atom(i), value.args[0])
+            value = value.args[1]
+        self.assertEqual(nil, value)
+
+    def test_bind_cyclic(self):
+        # Without the occurs check, a Var can be bound to a term holding it.
+        x = logic.Var('x')
+        bindings = {x: logic.Relation('f', (x,))}
+        self.assertEqual('f(f(?x))', repr(x.lookup(bindings)))
+
+    def test_args_tuple(self):
+        r = logic.Relation('pair', [logic.Atom('a'), logic.Var('x')])
+        self.assertEqual(tuple, type(r.args))
+
+    def test_ground_interned(self):
+        a = logic.Atom('a')
+        r = logic.Relation('f', (logic.Relation('pair', (a, a)), a))
+        s = logic.Relation('f', [logic.Relation('pair', [a, a]), a])
+        self.assertTrue(r.ground)
+        self.assertTrue(r is s)
+        self.assertEqual(hash(r), hash(s))
+        self.assertTrue(r != logic.Relation('f', (a, a)))
+
+    def test_interned_by_type(self):
+        one = logic.Relation('f', [logic.Atom(1)])
+        r = logic.Relation('f', [logic.Atom(1.0)])
+        self.assertFalse(r is one)
+        self.assertEqual(float, type(r.args[0].atom))
+        logic.Relation('g', [logic.Atom(True)])
+        self.assertEqual('g(1)', repr(logic.Relation('g', [logic.Atom(1)])))
+        self.assertEqual('h([1.0])', repr(logic.Relation(
+            'h', [logic.List([logic.Atom(1.0)])])))
+        self.assertTrue(logic.Bindings().unify(one, r))
+
+    def test_not_ground(self):
+        x = logic.Var('x')
+        r = logic.Relation('pair', (logic.Atom('a'), x))
+        s = logic.Relation('pair', (logic.Atom('a'), x))
+        self.assertFalse(r.ground)
+        self.assertFalse(r is s)
+        self.assertEqual(r, s)
+        self.assertEqual(hash(r), hash(r))
+        self.assertNotEqual(hash(r), hash(s)) # by identity
+
+    def test_pickle(self):
+        a = logic.Atom('a')
+        x = logic.Var('x')
+        r = logic.Relation('pair', (a, logic.Relation('f', (a,))))
+        self.assertTrue(r is pickle.loads(pickle.dumps(r, 2)))
+        s = logic.Relation('pair', (x, a))
+        self.assertEqual(s, pickle.loads(pickle.dumps(s, 2)))
         
 
 class ClauseTests(unittest.TestCase):
@@ -357,6 +456,57 @@ class UnificationTests(unittest.TestCase):
         self.assertEqual({x: jorge, y: joe}, logic.unify(c, d, {}))
     
 
+class BindingsTests(unittest.TestCase):
+    def test_unify_in_place(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        a = logic.Atom('a')
+        bindings = logic.Bindings()
+        self.assertTrue(bindings.unify(logic.Relation('likes', (x, y)),
+                                       logic.Relation('likes', (a, x))))
+        self.assertEqual({x: a, y: a}, bindings)
+        self.assertEqual([x, y], bindings.trail)
+
+    def test_failure_leaves_bindings(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        a = logic.Atom('a')
+        b = logic.Atom('b')
+        bindings = logic.Bindings({y: b})
+        self.assertFalse(bindings.unify(logic.Relation('likes', (x, a)),
+                                        logic.Relation('likes', (a, y))))
+        self.assertEqual({y: b}, bindings)
+        self.assertEqual([], bindings.trail)
+
+    def test_undo(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        z = logic.Var('z')
+        a = logic.Atom('a')
+        bindings = logic.Bindings()
+        bindings.unify(x, y)
+        mark = bindings.mark()
+        bindings.unify(y, z)
+        bindings.unify(z, a)
+        self.assertEqual(a, bindings.deref(x))
+        bindings.undo(mark)
+        self.assertEqual({x: y}, bindings)
+        self.assertEqual(y, bindings.deref(x))
+
+    def test_deref_unbound(self):
+        x = logic.Var('x')
+        self.assertEqual(x, logic.Bindings().deref(x))
+
+    def test_compatible_unify_copies(self):
+        x = logic.Var('x')
+        a = logic.Atom('a')
+        bindings = {}
+        unified = logic.unify(x, a, bindings)
+        self.assertEqual({}, bindings)
+        self.assertEqual({x: a}, unified)
+        self.assertEqual(dict, type(unified))
+
+
 class ProveTests(unittest.TestCase):
     def test_prove_no_relevant_clauses(self):
         joe = logic.Atom('joe')
@@ -465,3 +615,1334 @@ class ProveTests(unittest.TestCase):
         
         bindings = logic.prove_all([goal, display], {}, db)
         self.assertEqual(['foo'], things)
+
+    def test_prove_primitive_empty_bindings(self):
+        calls = []
+        def prim(args, bindings, db, remaining):
+            calls.append(args)
+            return {}
+        db = {'prim': prim}
+        goal = logic.Relation('prim', ())
+        self.assertEqual([{}], [dict(solution) for solution in
+                                logic.resolve([goal], {}, db)])
+        self.assertEqual({}, logic.prove(goal, {}, db))
+
+    def test_prove_deep_recursion(self):
+        # A proof far deeper than Python's stack, through a chain of facts.
+        depth = 3 * sys.getrecursionlimit()
+        x = logic.Var('x')
+        y = logic.Var('y')
+        db = {}
+        for i in range(depth):
+            logic.store(db, logic.Clause(logic.Relation(
+                'next', (logic.Atom(i), logic.Atom(i + 1)))))
+        logic.store(db, logic.Clause(logic.Relation(
+            'reach', (logic.Atom(depth),))))
+        logic.store(db, logic.Clause(
+            logic.Relation('reach', (x,)),
+            [logic.Relation('next', (x, y)), logic.Relation('reach', (y,))]))
+        goal = logic.Relation('reach', (logic.Atom(0),))
+        self.assertNotEqual(False, logic.prove(goal, {}, db))
+        goal = logic.Relation('reach', (logic.Atom(-1),))
+        self.assertEqual(False, logic.prove(goal, {}, db))
+
+    def test_prove_deep_non_ground(self):
+        more = logic.Var('more')
+        n = logic.Var('n')
+        nil = logic.Atom('nil')
+
+        db = {}
+        logic.store(db, logic.Clause(logic.Relation('length', (nil, nil))))
+        logic.store(db, logic.Clause(
+            logic.Relation('length', (logic.Relation('pair', (logic.Var('x'),
+                                                              more)),
+                                      logic.Relation('+1', [n]))),
+            [logic.Relation('length', (more, n))]))
+
+        # Terms with variables are hashed by identity, so however deep they
+        # are, putting them in bindings doesn't recurse through them.
+        items = nil
+        depth = 3 * sys.getrecursionlimit()
+        for i in range(depth):
+            items = logic.Relation('pair', (logic.Var('e%d' % i), items))
+        length = logic.Var('length')
+        term = logic.first(logic.Relation('length', (items, length)),
+                           db)[length]
+        count = 0
+        while term != nil:
+            count += 1
+            term = term.args[0]
+        self.assertEqual(depth, count)
+
+    def test_resolve_all_solutions(self):
+        x = logic.Var('x')
+        db = {}
+        for name in ('a', 'b', 'c'):
+            logic.store(db, logic.Clause(
+                logic.Relation('letter', [logic.Atom(name)])))
+        goal = logic.Relation('letter', [x])
+        found = [b[x] for b in logic.resolve([goal], {}, db)]
+        self.assertEqual([logic.Atom('a'), logic.Atom('b'), logic.Atom('c')],
+                         found)
+
+
+class SolveTests(unittest.TestCase):
+    def setUp(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        z = logic.Var('z')
+        self.db = {}
+        for a, b in (('a', 'b'), ('b', 'c'), ('c', 'd')):
+            logic.store(self.db, logic.Clause(logic.Relation(
+                'linked', (logic.Atom(a), logic.Atom(b)))))
+        logic.store(self.db, logic.Clause(
+            logic.Relation('path', (x, y)),
+            [logic.Relation('linked', (x, y))]))
+        logic.store(self.db, logic.Clause(
+            logic.Relation('path', (x, y)),
+            [logic.Relation('linked', (x, z)), logic.Relation('path', (z, y))]))
+
+    def test_all_solutions(self):
+        x = logic.Var('x')
+        goal = logic.Relation('path', (logic.Atom('a'), x))
+        found = [s[x] for s in logic.solve(goal, self.db)]
+        self.assertEqual([logic.Atom('b'), logic.Atom('c'), logic.Atom('d')],
+                         found)
+
+    def test_only_goal_vars(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        goals = [logic.Relation('linked', (x, y)),
+                 logic.Relation('linked', (y, logic.Atom('d')))]
+        self.assertEqual([{x: logic.Atom('b'), y: logic.Atom('c')}],
+                         list(logic.solve(goals, self.db)))
+
+    def test_instantiates_relations(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        db = {}
+        logic.store(db, logic.Clause(logic.Relation(
+            'box', [logic.Relation('pair', (logic.Atom('a'), y))])))
+        solution = logic.first(logic.Relation('box', [x]), db)
+        self.assertEqual(logic.Atom('a'), solution[x].args[0])
+        self.assertTrue(isinstance(solution[x].args[1], logic.Var))
+
+    def test_ground_goal(self):
+        goal = logic.Relation('path', (logic.Atom('a'), logic.Atom('c')))
+        self.assertEqual([{}], list(logic.solve(goal, self.db)))
+
+    def test_limit(self):
+        x = logic.Var('x')
+        goal = logic.Relation('path', (logic.Atom('a'), x))
+        self.assertEqual(2, len(list(logic.solve(goal, self.db, limit=2))))
+
+    def test_first_none(self):
+        goal = logic.Relation('path', (logic.Atom('d'), logic.Var('x')))
+        self.assertEqual(None, logic.first(goal, self.db))
+
+    def test_solve_many(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        queries = [logic.Relation('path', (logic.Atom(a), x)) for a in 'abcd']
+        queries.append(logic.Relation('path', (logic.Atom('a'), y)))
+        results = list(logic.solve_many(queries, self.db))
+        self.assertEqual(range(5), [i for i, solutions, error in results])
+        for query, (i, solutions, error) in zip(queries, results):
+            self.assertEqual(list(logic.solve(query, self.db)), solutions)
+            self.assertEqual(None, error)
+        results = logic.solve_many(queries, self.db, limit=1)
+        self.assertEqual([1, 1, 1, 0, 1], [len(s) for i, s, e in results])
+
+    def test_solve_many_errors(self):
+        x = logic.Var('x')
+        logic.store(self.db, logic.Clause(
+            logic.Relation('loop', (x,)),
+            [logic.Relation('loop', (logic.Relation('f', (x,)),))]))
+        queries = [logic.Relation('loop', (x,)),
+                   logic.Relation('is', (x, logic.Atom('a'))),
+                   logic.Relation('path', (logic.Atom('c'), x))]
+        results = list(logic.solve_many(queries, self.db, inferences=100))
+        self.assertEqual([0, 1, 2], [i for i, solutions, error in results])
+        self.assertEqual('inferences', results[0][2].reason)
+        self.assertTrue(isinstance(results[1][2], logic.EvaluationError))
+        self.assertEqual((2, [{x: logic.Atom('d')}], None), results[2])
+
+    def test_solve_many_shares_tables(self):
+        x = logic.Var('x')
+        logic.table(self.db, 'path')
+        queries = [logic.Relation('path', (logic.Atom('b'), x)),
+                   logic.Relation('path', (logic.Atom('a'), x))]
+        evaluated = []
+        original = logic.Tabling.evaluate
+        def evaluate(tabling, table, db):
+            evaluated.append(table.goal.args[0])
+            return original(tabling, table, db)
+        logic.Tabling.evaluate = evaluate
+        try:
+            results = logic.solve_many(queries, self.db)
+            self.assertEqual(2, len(next(results)[1]))
+            del evaluated[:]
+            self.assertEqual(3, len(next(results)[1]))
+        finally:
+            logic.Tabling.evaluate = original
+        # The table for path(b, ?x) was completed by the first query.
+        self.assertTrue(evaluated)
+        self.assertFalse(logic.Atom('b') in evaluated)
+
+
+class TablingTests(unittest.TestCase):
+    def graph(self, edges, *rules):
+        db = {}
+        for a, b in edges:
+            logic.store(db, logic.Clause(logic.Relation(
+                'linked', (logic.Atom(a), logic.Atom(b)))))
+        for rule in rules:
+            logic.store(db, rule)
+        logic.table(db, 'reachable')
+        return db
+
+    def reachable(self, x, y):
+        return logic.Relation('reachable', (x, y))
+
+    def linked(self, x, y):
+        return logic.Relation('linked', (x, y))
+
+    def test_left_recursion(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        z = logic.Var('z')
+        db = self.graph([(i, i + 1) for i in range(500)] + [(500, 0)],
+                        logic.Clause(self.reachable(x, y),
+                                     [self.linked(x, y)]),
+                        logic.Clause(self.reachable(x, y),
+                                     [self.reachable(x, z),
+                                      self.linked(z, y)]))
+        found = [s[y].atom for s in
+                 logic.solve(self.reachable(logic.Atom(0), y), db)]
+        self.assertEqual(range(501), sorted(found))
+
+    def test_right_recursion(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        z = logic.Var('z')
+        db = self.graph([(i, i + 1) for i in range(50)],
+                        logic.Clause(self.reachable(x, y),
+                                     [self.linked(x, y)]),
+                        logic.Clause(self.reachable(x, y),
+                                     [self.linked(x, z),
+                                      self.reachable(z, y)]))
+        found = [s[y].atom for s in
+                 logic.solve(self.reachable(logic.Atom(0), y), db)]
+        self.assertEqual(range(1, 51), sorted(found))
+
+    def test_mutual_recursion(self):
+        # The graph from examples/prolog/graph.prolog, made transitive.
+        x = logic.Var('x')
+        y = logic.Var('y')
+        z = logic.Var('z')
+        edges = [('a', 'b'), ('b', 'c'), ('a', 'c'), ('c', 'd'), ('d', 'e'),
+                 ('b', 'e'), ('f', 'g')]
+        db = self.graph(edges,
+                        logic.Clause(self.reachable(x, y),
+                                     [self.linked(x, y)]),
+                        logic.Clause(self.reachable(x, y),
+                                     [self.linked(y, x)]),
+                        logic.Clause(self.reachable(x, y),
+                                     [self.reachable(x, z),
+                                      self.reachable(z, y)]))
+        found = set(s[y].atom for s in
+                    logic.solve(self.reachable(logic.Atom('e'), y), db))
+        self.assertEqual(set('abcde'), found)
+        self.assertEqual(None, logic.first(
+            self.reachable(logic.Atom('a'), logic.Atom('f')), db))
+
+    def test_non_ground_answers(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        z = logic.Var('z')
+        likes = lambda a, b: logic.Relation('likes', (a, b))
+        db = {}
+        logic.store(db, logic.Clause(likes(logic.Atom('kim'),
+                                           logic.Atom('robin'))))
+        logic.store(db, logic.Clause(likes(x, x)))
+        logic.store(db, logic.Clause(likes(x, y), [likes(x, z), likes(z, y)]))
+        logic.table(db, 'likes')
+        solutions = list(logic.solve(likes(x, y), db))
+        self.assertEqual(2, len(solutions))
+        self.assertTrue({x: logic.Atom('kim'), y: logic.Atom('robin')}
+                        in solutions)
+        self.assertEqual([{y: logic.Atom('cats')}],
+                         list(logic.solve(likes(logic.Atom('cats'), y), db)))
+
+    def test_variant_key(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        a = logic.Atom('a')
+        key = logic.variant_key(logic.Relation('p', (x, y, x)), {})
+        self.assertEqual(key, logic.variant_key(
+            logic.Relation('p', (y, x, y)), {}))
+        self.assertNotEqual(key, logic.variant_key(
+            logic.Relation('p', (x, x, y)), {}))
+        self.assertEqual(logic.variant_key(logic.Relation('p', (a, y, a)), {}),
+                         logic.variant_key(logic.Relation('p', (x, y, x)),
+                                           {x: a}))
+
+
+class IndexTests(unittest.TestCase):
+    def linked_db(self, n):
+        db = {}
+        for i in range(n):
+            logic.store(db, logic.Clause(logic.Relation(
+                'linked', (logic.Atom(i), logic.Atom(i + 1)))))
+        return db
+
+    def test_store_creates_predicate(self):
+        db = self.linked_db(3)
+        self.assertTrue(isinstance(db['linked'], logic.Predicate))
+        self.assertEqual(3, len(logic.retrieve(db, 'linked')))
+
+    def test_store_upgrades_plain_list(self):
+        a = logic.Atom('a')
+        fact = logic.Clause(logic.Relation('p', [a]))
+        db = {'p': [fact]}
+        logic.store(db, fact)
+        self.assertTrue(isinstance(db['p'], logic.Predicate))
+        self.assertEqual([fact, fact], list(db['p']))
+
+    def test_first_argument(self):
+        db = self.linked_db(100)
+        goal = logic.Relation('linked', (logic.Atom(42), logic.Var('x')))
+        candidates = logic.retrieve(db, 'linked', goal.args)
+        self.assertEqual([db['linked'][42]], list(candidates))
+
+    def test_second_argument(self):
+        db = self.linked_db(100)
+        goal = logic.Relation('linked', (logic.Var('x'), logic.Atom(42)))
+        candidates = logic.retrieve(db, 'linked', goal.args)
+        self.assertEqual([db['linked'][41]], list(candidates))
+
+    def test_bound_through_bindings(self):
+        db = self.linked_db(100)
+        x = logic.Var('x')
+        y = logic.Var('y')
+        goal = logic.Relation('linked', (x, logic.Var('z')))
+        candidates = logic.retrieve(db, 'linked', goal.args,
+                                    {x: y, y: logic.Atom(7)})
+        self.assertEqual([db['linked'][7]], list(candidates))
+
+    def test_unbound_returns_all(self):
+        db = self.linked_db(100)
+        goal = logic.Relation('linked', (logic.Var('x'), logic.Var('y')))
+        self.assertEqual(100, len(logic.retrieve(db, 'linked', goal.args)))
+
+    def test_var_heads_keep_order(self):
+        db = self.linked_db(10)
+        x = logic.Var('x')
+        rule = logic.Clause(logic.Relation('linked', (x, x)))
+        logic.store(db, rule)
+        goal = logic.Relation('linked', (logic.Atom(3), logic.Var('y')))
+        logic.retrieve(db, 'linked', goal.args)
+        logic.store(db, logic.Clause(logic.Relation(
+            'linked', (logic.Atom(3), logic.Atom(0)))))
+        candidates = list(logic.retrieve(db, 'linked', goal.args))
+        self.assertEqual([db['linked'][3], rule, db['linked'][11]], candidates)
+        goal = logic.Relation('linked', (logic.Atom('q'), logic.Var('y')))
+        self.assertEqual([rule], list(logic.retrieve(db, 'linked', goal.args)))
+
+    def test_relation_keys(self):
+        db = {}
+        x = logic.Var('x')
+        nil = logic.Atom('nil')
+        for i in range(10):
+            logic.store(db, logic.Clause(logic.Relation(
+                'f', (logic.Relation('g', (logic.Atom(i),)),))))
+        logic.store(db, logic.Clause(logic.Relation('f', (nil,))))
+        goal = logic.Relation('f', (nil,))
+        self.assertEqual([db['f'][10]], list(logic.retrieve(db, 'f', goal.args)))
+        goal = logic.Relation('f', (logic.Relation('g', (x,)),))
+        self.assertEqual(10, len(logic.retrieve(db, 'f', goal.args)))
+
+    def test_modification_drops_indexes(self):
+        db = self.linked_db(10)
+        goal = logic.Relation('linked', (logic.Atom(3), logic.Var('y')))
+        logic.retrieve(db, 'linked', goal.args)
+        del db['linked'][3]
+        self.assertEqual([], list(logic.retrieve(db, 'linked', goal.args)))
+
+    def test_prove_uses_index(self):
+        db = self.linked_db(100)
+        x = logic.Var('x')
+        goal = logic.Relation('linked', (logic.Atom(42), x))
+        bindings = logic.prove(goal, {}, db)
+        self.assertEqual(logic.Atom(43), x.lookup(bindings))
+
+
+
+class CompileTests(unittest.TestCase):
+    def test_compile_cached(self):
+        x = logic.Var('x')
+        clause = logic.Clause(logic.Relation('p', (x,)))
+        self.assertTrue(clause.compile() is clause.compile())
+
+    def test_match_fact(self):
+        x = logic.Var('x')
+        a = logic.Atom('a')
+        b = logic.Atom('b')
+        compiled = logic.Clause(logic.Relation('p', (a, b))).compile()
+        bindings = logic.Bindings()
+        self.assertEqual([], compiled.match(logic.Relation('p', (x, b)),
+                                            bindings))
+        self.assertEqual(a, bindings.deref(x))
+
+    def test_match_fail_undoes(self):
+        x = logic.Var('x')
+        a = logic.Atom('a')
+        b = logic.Atom('b')
+        compiled = logic.Clause(logic.Relation('p', (a, a))).compile()
+        bindings = logic.Bindings()
+        self.assertEqual(None, compiled.match(logic.Relation('p', (x, b)),
+                                              bindings))
+        self.assertEqual({}, dict(bindings))
+
+    def test_match_arity(self):
+        x = logic.Var('x')
+        compiled = logic.Clause(logic.Relation('p', (x,))).compile()
+        goal = logic.Relation('p', (logic.Atom('a'), logic.Atom('b')))
+        self.assertEqual(None, compiled.match(goal, logic.Bindings()))
+
+    def test_match_repeated_var(self):
+        x = logic.Var('x')
+        a = logic.Atom('a')
+        b = logic.Atom('b')
+        compiled = logic.Clause(logic.Relation('p', (x, x))).compile()
+        self.assertEqual(None, compiled.match(logic.Relation('p', (a, b)),
+                                              logic.Bindings()))
+        self.assertEqual([], compiled.match(logic.Relation('p', (a, a)),
+                                            logic.Bindings()))
+
+    def test_match_structure(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        z = logic.Var('z')
+        a = logic.Atom('a')
+        compiled = logic.Clause(
+            logic.Relation('p', (logic.Relation('f', (x, a)),)),
+            [logic.Relation('q', (x,))]).compile()
+
+        bindings = logic.Bindings()
+        goal = logic.Relation('p', (logic.Relation('f', (y, z)),))
+        body = compiled.match(goal, bindings)
+        self.assertEqual([logic.Relation('q', (y,))], body)
+        self.assertEqual(a, bindings.deref(z))
+
+        bindings = logic.Bindings()
+        body = compiled.match(logic.Relation('p', (y,)), bindings)
+        self.assertEqual(1, len(body))
+        fresh = body[0].args[0]
+        self.assertTrue(isinstance(fresh, logic.Var))
+        self.assertEqual(logic.Relation('f', (fresh, a)),
+                         bindings.instantiate(y))
+
+    def test_body_vars_fresh(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        compiled = logic.Clause(logic.Relation('p', (x,)),
+                                [logic.Relation('q', (x, y))]).compile()
+        body = compiled.match(logic.Relation('p', (logic.Atom('a'),)),
+                              logic.Bindings())
+        self.assertEqual(logic.Atom('a'), body[0].args[0])
+        self.assertFalse(body[0].args[1] == y)
+
+    def test_recursive(self):
+        x = logic.Var('x')
+        self.assertTrue(logic.Clause(logic.Relation('p', (x,)),
+                                     [logic.Relation('p', (x,))])
+                        .compile().recursive)
+        self.assertFalse(logic.Clause(logic.Relation('p', (x,)),
+                                      [logic.Relation('q', (x,))])
+                         .compile().recursive)
+
+
+class ProfileTests(unittest.TestCase):
+    def setUp(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        z = logic.Var('z')
+        self.db = {}
+        for a, b in [('a', 'b'), ('b', 'c'), ('c', 'd')]:
+            logic.store(self.db, logic.Clause(logic.Relation(
+                'linked', (logic.Atom(a), logic.Atom(b)))))
+        logic.store(self.db, logic.Clause(
+            logic.Relation('path', (x, y)), [logic.Relation('linked', (x, y))]))
+        logic.store(self.db, logic.Clause(
+            logic.Relation('path', (x, y)),
+            [logic.Relation('linked', (x, z)), logic.Relation('path', (z, y))]))
+
+    def test_ports(self):
+        y = logic.Var('y')
+        profile = logic.Profile()
+        goal = logic.Relation('path', (logic.Atom('a'), y))
+        solutions = list(logic.solve(goal, self.db, monitor=profile))
+        self.assertEqual(3, len(solutions))
+        rows = dict((row[0], row[1:5]) for row in profile.table())
+        # Each call is entered once and left once.
+        for calls, exits, redos, fails in rows.values():
+            self.assertEqual(calls + redos, exits + fails)
+        # path(a, ?y) calls path(b, ?y), path(c, ?y) and path(d, ?y).
+        self.assertEqual((4, 6, 6, 4), rows['path'])
+
+    def test_clause_counts(self):
+        y = logic.Var('y')
+        profile = logic.Profile()
+        goal = logic.Relation('path', (logic.Atom('a'), y))
+        list(logic.solve(goal, self.db, monitor=profile))
+        rows = profile.clause_table(self.db, 'path')
+        self.assertEqual([(4, 3, 3, 4), (4, 3, 3, 4)],
+                         [row[1:5] for row in rows])
+
+    def test_times(self):
+        ticks = iter(xrange(1000))
+        profile = logic.Profile(clock=lambda: next(ticks))
+        goal = logic.Relation('path', (logic.Atom('c'), logic.Atom('d')))
+        self.assertNotEqual(None, logic.first(goal, self.db, profile))
+        for pred, calls, exits, redos, fails, incl, excl in profile.table():
+            self.assertTrue(0 < excl <= incl)
+        rows = profile.table()
+        self.assertEqual('path', rows[0][0])
+        total = sum(row[6] for row in rows)
+        self.assertTrue(total <= rows[0][5])
+        # Each clause's time is part of its predicate's.
+        clauses = profile.clause_table(self.db, 'path')
+        self.assertEqual([1, 0], [row[1] for row in clauses])
+        self.assertTrue(0 < clauses[0][6] <= clauses[0][5] <= rows[0][5])
+        self.assertTrue(sum(row[6] for row in clauses) <= rows[0][6])
+
+    def test_unknown_predicate(self):
+        profile = logic.Profile()
+        goal = logic.Relation('unknown', (logic.Atom('a'),))
+        self.assertEqual(None, logic.first(goal, self.db, profile))
+        self.assertEqual([('unknown', 1, 0, 0, 1)],
+                         [row[:5] for row in profile.table()])
+
+    def test_tabled(self):
+        y = logic.Var('y')
+        logic.table(self.db, 'path')
+        profile = logic.Profile()
+        goal = logic.Relation('path', (logic.Atom('a'), y))
+        answers = [s[y].atom for s in logic.solve(goal, self.db,
+                                                  monitor=profile)]
+        self.assertEqual(['b', 'c', 'd'], sorted(answers))
+        for pred, calls, exits, redos, fails, incl, excl in profile.table():
+            self.assertEqual(calls + redos, exits + fails)
+
+    def test_repl_query(self):
+        # The REPL's display of solutions is not part of the profile.
+        replies = iter(['y', 'n'])
+        logic.raw_input = lambda prompt: next(replies)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            profile = logic.Profile()
+            goal = logic.Relation('path', (logic.Atom('a'), logic.Var('y')))
+            logic.prolog_prove([goal], self.db, profile)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            del logic.raw_input
+        self.assertEqual('?y : b\n?y : c\nNo.\n', output)
+        self.assertEqual(['linked', 'path'],
+                         sorted(row[0] for row in profile.table()))
+        self.assertFalse('display_bindings' in self.db)
+
+
+class TraceTests(unittest.TestCase):
+    def setUp(self):
+        self.x = logic.Var('x')
+        self.db = {}
+        for a in ['a', 'b']:
+            logic.store(self.db, logic.Clause(
+                logic.Relation('p', (logic.Atom(a),))))
+        logic.store(self.db, logic.Clause(
+            logic.Relation('q', (self.x,)), [logic.Relation('p', (self.x,))]))
+
+    def trace(self, goal):
+        events = []
+        tracer = logic.Tracer(events.append)
+        solutions = list(logic.solve(goal, self.db, monitor=tracer))
+        return solutions, events
+
+    def test_ports(self):
+        y = logic.Var('y')
+        solutions, events = self.trace(logic.Relation('q', (y,)))
+        self.assertEqual(2, len(solutions))
+        self.assertEqual(['call', 'clause', 'call', 'clause', 'exit', 'exit',
+                          'redo', 'redo', 'clause', 'exit', 'exit', 'redo',
+                          'redo', 'fail', 'fail'],
+                         [event.port for event in events])
+        self.assertEqual([0, 0, 1, 1, 1, 0, 0, 1, 1, 1, 0, 0, 1, 1, 0],
+                         [event.depth for event in events])
+
+    def test_clause_bindings(self):
+        y = logic.Var('y')
+        solutions, events = self.trace(logic.Relation('p', (y,)))
+        clauses = [event for event in events if event.port == 'clause']
+        self.assertEqual([[(y, logic.Atom('a'))], [(y, logic.Atom('b'))]],
+                         [event.bindings for event in clauses])
+        self.assertEqual('Clause: p(a) {?y: a}', repr(clauses[0]))
+
+    def test_goal_instantiated(self):
+        y = logic.Var('y')
+        solutions, events = self.trace(logic.Relation('q', (y,)))
+        self.assertEqual('Exit: q(a)', repr(events[5]))
+        self.assertEqual('  Exit: p(a)', repr(events[4]))
+
+    def test_monitors(self):
+        events = []
+        profile = logic.Profile()
+        monitor = logic.Monitors([logic.Tracer(events.append), profile])
+        goal = logic.Relation('q', (logic.Atom('b'),))
+        self.assertEqual({}, logic.first(goal, self.db, monitor))
+        self.assertEqual(['q', 'p'], [row[0] for row in profile.table()])
+        self.assertEqual('exit', events[-1].port)
+
+
+class ControlTests(unittest.TestCase):
+    def setUp(self):
+        self.x = logic.Var('x')
+        self.y = logic.Var('y')
+        self.db = {}
+        for a in ['a', 'b', 'c']:
+            self.fact('p', a)
+        self.fact('q', 'b')
+
+    def fact(self, pred, *args):
+        logic.store(self.db, logic.Clause(
+            logic.Relation(pred, [logic.Atom(a) for a in args])))
+
+    def answers(self, goal, var):
+        return [s[var].atom for s in logic.solve(goal, self.db)]
+
+    def test_cut_commits(self):
+        x = self.x
+        logic.store(self.db, logic.Clause(
+            logic.Relation('first', (x,)),
+            [logic.Relation('p', (x,)), logic.CUT]))
+        self.assertEqual(['a'], self.answers(logic.Relation('first', (x,)), x))
+
+    def test_cut_skips_clauses(self):
+        x = self.x
+        logic.store(self.db, logic.Clause(
+            logic.Relation('r', (x,)), [logic.Relation('q', (x,)), logic.CUT]))
+        logic.store(self.db, logic.Clause(
+            logic.Relation('r', (x,)), [logic.Relation('p', (x,))]))
+        self.assertEqual(['b'], self.answers(logic.Relation('r', (x,)), x))
+
+    def test_cut_is_local(self):
+        x, y = self.x, self.y
+        logic.store(self.db, logic.Clause(
+            logic.Relation('first', (x,)),
+            [logic.Relation('p', (x,)), logic.CUT]))
+        goals = [logic.Relation('p', (y,)), logic.Relation('first', (x,))]
+        self.assertEqual(['a', 'b', 'c'], self.answers(goals, y))
+
+    def test_cut_then_fail(self):
+        x = self.x
+        logic.store(self.db, logic.Clause(
+            logic.Relation('none', (x,)),
+            [logic.Relation('p', (x,)), logic.CUT, logic.FAIL]))
+        logic.store(self.db, logic.Clause(
+            logic.Relation('none', (x,)), [logic.Relation('p', (x,))]))
+        self.assertEqual([], self.answers(logic.Relation('none', (x,)), x))
+
+    def test_top_level_cut(self):
+        x = self.x
+        goals = [logic.Relation('p', (x,)), logic.CUT]
+        self.assertEqual(['a'], self.answers(goals, x))
+
+    def test_disjunction(self):
+        x = self.x
+        goal = logic.Relation(';', (logic.Relation('q', (x,)),
+                                    logic.Relation('p', (x,))))
+        self.assertEqual(['b', 'a', 'b', 'c'], self.answers(goal, x))
+
+    def test_disjunction_cut(self):
+        x = self.x
+        logic.store(self.db, logic.Clause(
+            logic.Relation('r', (x,)),
+            [logic.Relation(';', (logic.conjunction(
+                [logic.Relation('q', (x,)), logic.CUT]),
+                logic.Relation('p', (x,))))]))
+        logic.store(self.db, logic.Clause(
+            logic.Relation('r', (logic.Atom('d'),))))
+        self.assertEqual(['b'], self.answers(logic.Relation('r', (x,)), x))
+
+    def test_if_then_else(self):
+        x, y = self.x, self.y
+        goal = logic.Relation(';', (
+            logic.Relation('->', (logic.Relation('p', (x,)),
+                                  logic.Relation('q', (y,)))),
+            logic.Relation('p', (y,))))
+        # Only the first solution of the condition is used.
+        self.assertEqual([{x: logic.Atom('a'), y: logic.Atom('b')}],
+                         list(logic.solve(goal, self.db)))
+
+    def test_else(self):
+        x = self.x
+        goal = logic.Relation(';', (
+            logic.Relation('->', (logic.Relation('q', (logic.Atom('a'),)),
+                                  logic.TRUE)),
+            logic.Relation('p', (x,))))
+        self.assertEqual(['a', 'b', 'c'], self.answers(goal, x))
+
+    def test_if_then_fails(self):
+        goal = logic.Relation('->', (logic.Relation('q', (logic.Atom('a'),)),
+                                     logic.TRUE))
+        self.assertEqual(None, logic.first(goal, self.db))
+
+    def test_cut_in_condition(self):
+        x = self.x
+        condition = logic.conjunction([logic.Relation('p', (x,)), logic.CUT])
+        goal = logic.Relation(';', (
+            logic.Relation('->', (condition, logic.Relation('q', (x,)))),
+            logic.TRUE))
+        self.assertEqual(None, logic.first(goal, self.db))
+
+    def test_negation(self):
+        x = self.x
+        goals = [logic.Relation('p', (x,)),
+                 logic.Relation('\\+', (logic.Relation('q', (x,)),))]
+        self.assertEqual(['a', 'c'], self.answers(goals, x))
+
+    def test_negation_binds_nothing(self):
+        x = self.x
+        goals = [logic.Relation('\\+', (logic.Relation('q', (logic.Atom('a'),)),)),
+                 logic.Relation('q', (x,))]
+        self.assertEqual(['b'], self.answers(goals, x))
+
+    def test_conjunction(self):
+        a = logic.Relation('p', (self.x,))
+        b = logic.Relation('q', (self.x,))
+        self.assertEqual(logic.TRUE, logic.conjunction([]))
+        self.assertEqual(a, logic.conjunction([a]))
+        self.assertEqual(logic.Relation(',', (a, b)),
+                         logic.conjunction([a, b]))
+        self.assertEqual(['b'], self.answers(logic.conjunction([a, b]),
+                                             self.x))
+        self.assertEqual('(p(?x), q(?x))', repr(logic.conjunction([a, b])))
+
+    def test_profile_cut(self):
+        x = self.x
+        logic.store(self.db, logic.Clause(
+            logic.Relation('none', (x,)),
+            [logic.Relation('p', (x,)), logic.CUT, logic.FAIL]))
+        logic.store(self.db, logic.Clause(
+            logic.Relation('first', (x,)),
+            [logic.Relation('p', (x,)), logic.CUT]))
+        profile = logic.Profile()
+        goals = [logic.Relation('first', (x,)),
+                 logic.Relation('\\+', (logic.Relation('none', (x,)),))]
+        self.assertEqual(1, len(list(logic.solve(goals, self.db,
+                                                 monitor=profile))))
+        for pred, calls, exits, redos, fails, incl, excl in profile.table():
+            self.assertEqual(calls + redos, exits + fails)
+        rows = dict((row[0], row[1:5]) for row in profile.table())
+        self.assertEqual((1, 0, 0, 1), rows['none'])
+
+
+class BuiltinTests(unittest.TestCase):
+    def setUp(self):
+        self.x = logic.Var('x')
+        self.y = logic.Var('y')
+
+    def expr(self, op, *args):
+        return logic.Relation(op, [a if isinstance(a, (logic.Var,
+                                                       logic.Relation))
+                                   else logic.Atom(a) for a in args])
+
+    def value(self, expr, db=None):
+        solution = logic.first(logic.Relation('is', (self.x, expr)), db or {})
+        return solution[self.x].atom
+
+    def test_evaluate(self):
+        self.assertEqual(14, self.value(self.expr(
+            '+', 2, self.expr('*', 3, 4))))
+        self.assertEqual(3.5, self.value(self.expr('/', 7, 2)))
+        self.assertEqual(3, self.value(self.expr('/', 6, 2)))
+        self.assertEqual(-3, self.value(self.expr('//', -7, 2)))
+        self.assertEqual(1, self.value(self.expr('mod', -7, 2)))
+        self.assertEqual(-2, self.value(self.expr('-', 2)))
+        self.assertEqual(5, self.value(self.expr('max', 5, self.expr('abs', -1))))
+
+    def test_evaluate_bound(self):
+        goals = [logic.Relation('is', (self.y, logic.Atom(4))),
+                 logic.Relation('is', (self.x, self.expr('*', self.y, 2)))]
+        self.assertEqual(8, logic.first(goals, {})[self.x].atom)
+
+    def test_is_checks(self):
+        goal = logic.Relation('is', (logic.Atom(3), self.expr('+', 1, 2)))
+        self.assertEqual({}, logic.first(goal, {}))
+        goal = logic.Relation('is', (logic.Atom(4), self.expr('+', 1, 2)))
+        self.assertEqual(None, logic.first(goal, {}))
+
+    def test_errors(self):
+        for expr in [self.expr('+', 1, self.y), logic.Atom('a'),
+                     self.expr('/', 1, 0), self.expr('foo', 1),
+                     self.expr('mod', 1.5, 2)]:
+            goal = logic.Relation('is', (self.x, expr))
+            self.assertRaises(logic.EvaluationError, logic.first, goal, {})
+
+    def test_comparisons(self):
+        cases = [('<', 1, 2, True), ('<', 2, 2, False), ('>', 3, 2, True),
+                 ('=<', 2, 2, True), ('>=', 1, 2, False),
+                 ('=:=', 1, 1.0, True), ('=\\=', 1, 2, True),
+                 ('=\\=', 2, 2, False)]
+        for op, a, b, result in cases:
+            goal = self.expr(op, a, self.expr('+', b, 0))
+            self.assertEqual(result, logic.first(goal, {}) is not None)
+
+    def test_counting(self):
+        db = {}
+        n = logic.Var('n')
+        m = logic.Var('m')
+        logic.store(db, logic.Clause(logic.Relation(
+            'count', (logic.Atom(0),))))
+        logic.store(db, logic.Clause(
+            logic.Relation('count', (n,)),
+            [self.expr('>', n, 0), logic.Relation('is', (m, self.expr('-', n, 1))),
+             logic.Relation('count', (m,))]))
+        self.assertEqual({}, logic.first(logic.Relation(
+            'count', (logic.Atom(1000),)), db))
+
+    def test_define_procedure(self):
+        db = {}
+        def between(args, bindings):
+            low, high, x = args
+            for i in xrange(bindings.deref(low).atom,
+                            bindings.deref(high).atom + 1):
+                if bindings.unify(x, logic.Atom(i)):
+                    yield
+        logic.define_procedure(db, 'between',
+                               logic.Builtin(between, deterministic=False))
+        goals = [logic.Relation('between', (logic.Atom(1), logic.Atom(5),
+                                            self.x)),
+                 self.expr('=:=', self.expr('mod', self.x, 2), 1)]
+        answers = [s[self.x].atom for s in logic.solve(goals, db)]
+        self.assertEqual([1, 3, 5], answers)
+
+    def test_db_overrides(self):
+        db = {}
+        logic.define_procedure(db, '<', logic.Builtin(lambda args, b: True))
+        goal = self.expr('<', 2, 1)
+        self.assertEqual({}, logic.first(goal, db))
+        self.assertEqual(None, logic.first(goal, {}))
+
+    def test_profile(self):
+        profile = logic.Profile()
+        goal = logic.Relation('is', (self.x, self.expr('+', 1, 2)))
+        logic.first([goal, self.expr('<', self.x, 2)], {}, profile)
+        rows = dict((row[0], row[1:5]) for row in profile.table())
+        self.assertEqual({'is': (1, 1, 0, 0), '<': (1, 0, 0, 1)}, rows)
+
+    def test_repr(self):
+        expr = self.expr('is', self.x, self.expr('-', self.expr('+', 1, 2)))
+        self.assertEqual('?x is -(1 + 2)', repr(expr))
+
+
+class ListTests(unittest.TestCase):
+    def setUp(self):
+        self.x = logic.Var('x')
+        self.y = logic.Var('y')
+        self.t = logic.Var('t')
+
+    def list(self, *items, **kwargs):
+        return logic.List([i if isinstance(i, (logic.Var, logic.List))
+                           else logic.Atom(i) for i in items],
+                          kwargs.get('tail', logic.NIL))
+
+    def answers(self, goal, var, db=None, limit=None):
+        return [s[var] for s in logic.solve(goal, db or {}, limit)]
+
+    def test_repr(self):
+        self.assertEqual('[a, b]', repr(self.list('a', 'b')))
+        self.assertEqual('[a | ?t]', repr(self.list('a', tail=self.t)))
+        self.assertEqual('[a, b, c]', repr(
+            self.list('a', tail=self.list('b', 'c'))))
+
+    def test_segments_equal(self):
+        joined = self.list(1, tail=self.list(2, 3))
+        self.assertEqual(self.list(1, 2, 3), joined)
+        self.assertEqual(hash(self.list(1, 2, 3)), hash(joined))
+        self.assertNotEqual(self.list(1, 2), self.list(1, 2, tail=self.t))
+        self.assertEqual(self.list(2, 3), self.list(1, 2, 3).view(1))
+        self.assertEqual(logic.NIL, self.list(1, 2, 3).view(3))
+
+    def test_ground(self):
+        self.assertTrue(self.list(1, self.list(2)).ground)
+        self.assertFalse(self.list(1, self.x).ground)
+        self.assertFalse(self.list(1, tail=self.t).ground)
+        pred = logic.Relation('p', (self.list(1, 2),))
+        self.assertTrue(pred is logic.Relation('p', (self.list(1, 2),)))
+
+    def test_vars(self):
+        items = self.list(self.x, self.y, self.x, tail=self.t)
+        self.assertEqual([self.x, self.y, self.t], items.get_vars())
+        renamed = items.rename_vars({self.t: self.y})
+        self.assertEqual(self.list(self.x, self.y, self.x, tail=self.y),
+                         renamed)
+
+    def test_unify(self):
+        bindings = logic.Bindings()
+        self.assertTrue(bindings.unify(self.list(self.x, 2, tail=self.t),
+                                       self.list(1, 2, 3, 4)))
+        self.assertEqual(logic.Atom(1), bindings.instantiate(self.x))
+        self.assertEqual(self.list(3, 4), bindings.instantiate(self.t))
+        self.assertFalse(bindings.unify(self.list(1), self.list(1, 2)))
+        self.assertFalse(bindings.unify(self.list(1), logic.NIL))
+        self.assertFalse(bindings.unify(self.list(self.y),
+                                        logic.Relation('f', (self.y,))))
+
+    def test_instantiate(self):
+        bindings = logic.Bindings({self.t: self.list(self.y, 3),
+                                   self.y: logic.Atom(2)})
+        term = logic.Relation('f', (self.list(1, tail=self.t),))
+        self.assertEqual('f([1, 2, 3])', repr(bindings.instantiate(term)))
+
+    def test_variant_key(self):
+        self.assertEqual(
+            logic.variant_key(self.list(1, 2, tail=self.x), {}),
+            logic.variant_key(self.list(1, tail=self.t),
+                              {self.t: self.list(2, tail=self.y)}))
+
+    def test_pickle(self):
+        items = self.list(1, self.x, tail=self.t)
+        self.assertEqual(items, pickle.loads(pickle.dumps(items)))
+
+    def test_clause_patterns(self):
+        db = {}
+        rest = logic.Var('rest')
+        logic.store(db, logic.Clause(logic.Relation(
+            'member', (self.x, self.list(self.x, tail=rest)))))
+        logic.store(db, logic.Clause(
+            logic.Relation('member', (self.x, self.list(self.y, tail=rest))),
+            [logic.Relation('member', (self.x, rest))]))
+        goal = logic.Relation('member', (self.x, self.list('a', 'b', 'c')))
+        self.assertEqual(map(logic.Atom, 'abc'), self.answers(goal, self.x, db))
+
+    def test_length(self):
+        goal = logic.Relation('length', (self.list(1, tail=self.list(2)),
+                                         self.x))
+        self.assertEqual([logic.Atom(2)], self.answers(goal, self.x))
+        goal = logic.Relation('length', (self.list(1, tail=self.t),
+                                         logic.Atom(3)))
+        [items] = self.answers(goal, self.t)
+        self.assertEqual(2, len(items))
+        goal = logic.Relation('length', (self.t, self.x))
+        self.assertEqual(map(logic.Atom, [0, 1, 2]),
+                         self.answers(goal, self.x, limit=3))
+
+    def test_nth(self):
+        items = self.list('a', tail=self.list('b', 'c'))
+        goal = logic.Relation('nth', (logic.Atom(3), items, self.x))
+        self.assertEqual([logic.Atom('c')], self.answers(goal, self.x))
+        goal = logic.Relation('nth', (logic.Atom(4), items, self.x))
+        self.assertEqual([], self.answers(goal, self.x))
+        goal = logic.Relation('nth', (self.y, items, logic.Atom('b')))
+        self.assertEqual([logic.Atom(2)], self.answers(goal, self.y))
+
+    def test_append(self):
+        second = self.list(3, 4)
+        goal = logic.Relation('append', (self.list(1, 2), second, self.x))
+        [both] = self.answers(goal, self.x)
+        self.assertEqual(self.list(1, 2, 3, 4), both)
+        self.assertTrue(both.tail is second)
+        goal = logic.Relation('append', (self.x, self.y, self.list(1, 2)))
+        splits = [(s[self.x], s[self.y]) for s in logic.solve(goal, {})]
+        self.assertEqual([(logic.NIL, self.list(1, 2)),
+                          (self.list(1), self.list(2)),
+                          (self.list(1, 2), logic.NIL)], splits)
+        goal = logic.Relation('append', (self.x, self.list(3), self.t))
+        shortest, longer = self.answers(goal, self.t, limit=2)
+        self.assertEqual(self.list(3), shortest)
+        self.assertEqual(2, len(longer))
+
+
+class UpdateTests(unittest.TestCase):
+    def setUp(self):
+        self.x = logic.Var('x')
+        self.y = logic.Var('y')
+
+    def fact(self, pred, *args):
+        return logic.Clause(logic.Relation(pred, map(logic.Atom, args)))
+
+    def linked_db(self, n):
+        db = {}
+        for i in range(n):
+            logic.store(db, self.fact('linked', i % 3, i))
+        return db
+
+    def answers(self, goal, db):
+        return [s[self.x].atom for s in logic.solve(goal, db)]
+
+    def test_asserta(self):
+        for n in (2, 20):
+            db = self.linked_db(n)
+            logic.asserta(db, self.fact('linked', 1, 'first'))
+            goal = logic.Relation('linked', (logic.Atom(1), self.x))
+            self.assertEqual(['first'] + range(1, n, 3),
+                             self.answers(goal, db))
+
+    def test_retract(self):
+        db = self.linked_db(20)
+        goal = logic.Relation('linked', (logic.Atom(1), self.x))
+        self.answers(goal, db)
+        index = db['linked'].indexes[0]
+        pattern = logic.Clause(logic.Relation('linked',
+                                              (logic.Atom(1), self.y)))
+        bindings = logic.retract(db, pattern)
+        self.assertEqual(logic.Atom(1), bindings[self.y])
+        self.assertEqual(19, len(db['linked']))
+        self.assertEqual(range(4, 20, 3), self.answers(goal, db))
+        self.assertTrue(index is db['linked'].indexes[0])
+        self.assertEqual(None, logic.retract(db, self.fact('linked', 1, 1)))
+
+    def test_retract_rule(self):
+        db = {}
+        rule = logic.Clause(logic.Relation('p', (self.x,)),
+                            [logic.Relation('q', (self.x,))])
+        logic.store(db, rule)
+        self.assertEqual(None, logic.retract(db, logic.Clause(
+            logic.Relation('p', (self.y,)))))
+        self.assertNotEqual(None, logic.retract(db, logic.Clause(
+            logic.Relation('p', (self.y,)), [logic.Relation('q', (self.y,))])))
+        self.assertEqual([], db['p'])
+
+    def test_view_ignores_additions(self):
+        for n in (2, 20):
+            db = self.linked_db(n)
+            goals = [logic.Relation('linked', (self.y, self.x)),
+                     logic.Relation('assertz', (logic.Relation(
+                         'linked', (self.y, self.x)),))]
+            self.assertEqual(range(n), self.answers(goals, db))
+            self.assertEqual(2 * n, len(db['linked']))
+
+    def test_view_keeps_removed(self):
+        for n in (6, 20):
+            db = self.linked_db(n)
+            solutions = logic.solve(logic.Relation('linked', (self.y, self.x)),
+                                    db)
+            self.assertEqual(0, next(solutions)[self.x].atom)
+            logic.asserta(db, self.fact('linked', 0, 'first'))
+            for i in range(n):
+                logic.retract(db, self.fact('linked', i % 3, i))
+            self.assertEqual(range(1, n), [s[self.x].atom for s in solutions])
+            self.assertEqual(['first'], self.answers(logic.Relation(
+                'linked', (self.y, self.x)), db))
+
+    def test_builtins(self):
+        db = self.linked_db(3)
+        z = logic.Var('z')
+        rule = logic.Relation(':-', (
+            logic.Relation('path', (self.x, z)),
+            logic.conjunction([logic.Relation('linked', (self.x, self.y)),
+                               logic.Relation('linked', (self.y, z))])))
+        self.assertNotEqual(None, logic.first(
+            logic.Relation('assertz', (rule,)), db))
+        self.assertEqual('path(?x, ?z) :- linked(?x, ?y), linked(?y, ?z)',
+                         repr(db['path'][0]))
+        goal = logic.Relation('retract', (logic.Relation(
+            'linked', (self.y, self.x)),))
+        self.assertEqual([0, 1, 2], self.answers(goal, db))
+        self.assertEqual([], db['linked'])
+        self.assertEqual(None, logic.first(goal, db))
+
+
+class BudgetTests(unittest.TestCase):
+    def setUp(self):
+        x = logic.Var('x')
+        y = logic.Var('y')
+        z = logic.Var('z')
+        self.db = {}
+        logic.store(self.db, logic.Clause(
+            logic.Relation('reachable', (x, y)),
+            [logic.Relation('reachable', (x, z)),
+             logic.Relation('linked', (z, y))]))
+        logic.store(self.db, logic.Clause(logic.Relation(
+            'linked', (logic.Atom('a'), logic.Atom('b')))))
+        self.loop = logic.Relation('reachable', (logic.Atom('a'), y))
+
+    def test_inferences(self):
+        budget = logic.Budget(inferences=1000)
+        try:
+            logic.first(self.loop, self.db, budget=budget)
+            self.fail('loop finished')
+        except logic.BudgetExceeded as e:
+            self.assertEqual('inferences', e.reason)
+            self.assertEqual(1000, e.inferences)
+            self.assertEqual(999, e.deepest)
+            self.assertEqual('reachable/2', e.predicate)
+            self.assertTrue(e.goal.startswith('reachable(a, '))
+
+    def test_deep_goal(self):
+        x = logic.Var('x')
+        logic.store(self.db, logic.Clause(
+            logic.Relation('grow', (x,)),
+            [logic.Relation('grow', (logic.Relation('f', (x,)),))]))
+        try:
+            logic.first(logic.Relation('grow', (logic.Atom('a'),)), self.db,
+                        budget=logic.Budget(inferences=5000))
+            self.fail('loop finished')
+        except logic.BudgetExceeded as e:
+            self.assertEqual('grow/1', e.predicate)
+            self.assertEqual('grow(f(f(f(...))))', e.goal)
+            self.assertTrue('deepest goal grow(f(f(f(...)))) at depth' in
+                            str(e))
+
+    def test_within_budget(self):
+        budget = logic.Budget(inferences=1)
+        goal = logic.Relation('linked', (logic.Var('x'), logic.Var('y')))
+        self.assertEqual(1, len(list(logic.solve(goal, self.db,
+                                                 budget=budget))))
+        self.assertEqual(1, budget.inferences)
+        self.assertRaises(logic.BudgetExceeded, logic.prove, goal, {},
+                          self.db, budget=budget)
+
+    def test_timeout(self):
+        now = [0]
+        def clock():
+            now[0] += 1
+            return now[0]
+        budget = logic.Budget(timeout=10, clock=clock)
+        try:
+            logic.first(self.loop, self.db, budget=budget)
+            self.fail('loop finished')
+        except logic.BudgetExceeded as e:
+            self.assertEqual('timeout', e.reason)
+            self.assertEqual(10 * logic.Budget.interval, e.inferences)
+
+    def test_cancel(self):
+        class Event(object):
+            def is_set(self):
+                return budget.inferences > 500
+        budget = logic.Budget(cancel=Event())
+        try:
+            logic.first(self.loop, self.db, budget=budget)
+            self.fail('loop finished')
+        except logic.BudgetExceeded as e:
+            self.assertEqual('cancelled', e.reason)
+            self.assertTrue(500 < e.inferences <= 500 + logic.Budget.interval)
+
+    def test_profile_balanced(self):
+        profile = logic.Profile()
+        self.assertRaises(logic.BudgetExceeded, logic.first, self.loop,
+                          self.db, profile, logic.Budget(100))
+        [row] = [row for row in profile.table() if row[0] == 'reachable']
+        pred, calls, exits, redos, fails = row[:5]
+        self.assertEqual(calls + redos, exits + fails)
+
+
+class CacheTests(unittest.TestCase):
+    def setUp(self):
+        self.x = logic.Var('x')
+        self.y = logic.Var('y')
+        z = logic.Var('z')
+        self.db = {}
+        for a, b in (('a', 'b'), ('b', 'c'), ('c', 'd')):
+            self.link(a, b)
+        logic.store(self.db, logic.Clause(
+            logic.Relation('path', (self.x, self.y)),
+            [logic.Relation('linked', (self.x, self.y))]))
+        logic.store(self.db, logic.Clause(
+            logic.Relation('path', (self.x, self.y)),
+            [logic.Relation('linked', (self.x, z)),
+             logic.Relation('path', (z, self.y))]))
+        self.cache = logic.AnswerCache(self.db)
+
+    def link(self, a, b):
+        logic.store(self.db, logic.Clause(logic.Relation(
+            'linked', (logic.Atom(a), logic.Atom(b)))))
+
+    def path(self, a, var):
+        return logic.Relation('path', (logic.Atom(a), var))
+
+    def test_variants_hit(self):
+        expected = list(logic.solve(self.path('a', self.x), self.db))
+        self.assertEqual(expected, list(self.cache.solve(self.path('a',
+                                                                   self.x))))
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+        solutions = list(self.cache.solve(self.path('a', self.y)))
+        self.assertEqual([s[self.x] for s in expected],
+                         [s[self.y] for s in solutions])
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        self.assertEqual(expected[:1],
+                         list(self.cache.solve(self.path('a', self.x), 1)))
+
+    def test_unbound_answers_renamed(self):
+        logic.store(self.db, logic.Clause(logic.Relation('any', (self.x,))))
+        goal = logic.Relation('any', (self.y,))
+        [first] = [s[self.y] for s in self.cache.solve(goal)]
+        [second] = [s[self.y] for s in self.cache.solve(goal)]
+        self.assertEqual(1, self.cache.hits)
+        self.assertTrue(isinstance(second, logic.Var))
+        self.assertNotEqual(first, second)
+
+    def test_invalidated(self):
+        goal = self.path('a', self.x)
+        self.assertEqual(3, len(list(self.cache.solve(goal))))
+        self.link('d', 'e')
+        self.assertEqual(4, len(list(self.cache.solve(goal))))
+        logic.retract(self.db, logic.Clause(logic.Relation(
+            'linked', (logic.Atom('a'), logic.Atom('b')))))
+        self.assertEqual([], list(self.cache.solve(goal)))
+        self.assertEqual(0, self.cache.hits)
+        # Other predicates don't matter.
+        logic.store(self.db, logic.Clause(logic.Relation('other', ())))
+        self.assertEqual([], list(self.cache.solve(goal)))
+        self.assertEqual(1, self.cache.hits)
+
+    def test_new_predicates(self):
+        goal = logic.Relation('q', (self.x,))
+        logic.store(self.db, logic.Clause(goal, [logic.Relation('p',
+                                                                (self.x,))]))
+        self.assertEqual([], list(self.cache.solve(goal)))
+        logic.store(self.db, logic.Clause(logic.Relation(
+            'p', (logic.Atom('a'),))))
+        self.assertEqual([{self.x: logic.Atom('a')}],
+                         list(self.cache.solve(goal)))
+        self.assertEqual(0, self.cache.hits)
+
+    def test_incomplete_not_cached(self):
+        goal = self.path('a', self.x)
+        self.assertEqual(2, len(list(self.cache.solve(goal, limit=2))))
+        self.assertEqual(0, len(self.cache))
+        self.assertRaises(logic.BudgetExceeded, list,
+                          self.cache.solve(goal, budget=logic.Budget(3)))
+        self.assertEqual(0, len(self.cache))
+
+    def test_side_effects_not_cached(self):
+        goal = logic.Relation('assertz', (logic.Relation('p', ()),))
+        self.assertEqual([{}], list(self.cache.solve(goal)))
+        self.assertEqual(0, len(self.cache))
+
+    def test_eviction(self):
+        cache = logic.AnswerCache(self.db, max_queries=2, max_answers=4)
+        for a in 'abc':
+            list(cache.solve(self.path(a, self.x)))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(3, cache.answers)
+        list(cache.solve(self.path('c', self.x)))
+        self.assertEqual(1, cache.hits)
+        list(cache.solve(self.path('a', self.x)))
+        self.assertEqual([1, 3], sorted(len(answers) for answers, versions
+                                        in cache.entries.values()))
+
+    def test_changed_after_eviction(self):
+        # An entry added by evicting another depends on its own predicates.
+        cache = logic.AnswerCache(self.db, max_queries=1)
+        def fact(pred, a):
+            logic.store(self.db, logic.Clause(logic.Relation(
+                pred, (logic.Atom(a),))))
+        p = logic.Relation('p', (self.x,))
+        q = logic.Relation('q', (self.x,))
+        fact('p', 'a')
+        fact('q', 'b')
+        list(cache.solve(p))
+        list(cache.solve(q))
+        fact('q', 'a')
+        self.assertEqual(['b', 'a'], [s[self.x].atom for s in cache.solve(q)])
+        self.assertEqual((0, 3), (cache.hits, cache.misses))
+
+
+class FactTableTests(unittest.TestCase):
+    def setUp(self):
+        self.x = logic.Var('x')
+        self.y = logic.Var('y')
+        self.db = {}
+        self.table = logic.fact_table(self.db, 'linked')
+        for a, b in (('a', 'b'), ('b', 'c'), ('a', 'c'), ('c', 'd')):
+            logic.store(self.db, self.linked(a, b))
+
+    def linked(self, *args):
+        return logic.Clause(logic.Relation('linked', [
+            logic.Atom(arg) if not isinstance(arg, logic.Var) else arg
+            for arg in args]))
+
+    def solutions(self, goal):
+        return [tuple(s[v].atom for v in sorted(s, key=str))
+                for s in logic.solve(goal, self.db)]
+
+    def test_stored_as_rows(self):
+        self.assertTrue(self.db['linked'] is self.table)
+        self.assertEqual(4, len(self.table))
+        self.assertEqual(4, len(self.table.symbols))
+        self.assertEqual([c.head for c in map(self.linked, 'abac', 'bccd')],
+                         [c.head for c in self.table])
+
+    def test_solve(self):
+        self.assertEqual([('a', 'b'), ('b', 'c'), ('a', 'c'), ('c', 'd')],
+                         self.solutions(self.linked(self.x, self.y).head))
+        self.assertEqual([('b',), ('c',)],
+                         self.solutions(self.linked('a', self.y).head))
+        self.assertEqual([('b',), ('a',)],
+                         self.solutions(self.linked(self.x, 'c').head))
+        self.assertEqual([], self.solutions(self.linked('e', self.y).head))
+        self.assertEqual([], self.solutions(self.linked(self.x, self.x).head))
+        self.assertEqual([()], self.solutions(self.linked('c', 'd').head))
+
+    def test_rules(self):
+        z = logic.Var('z')
+        path = logic.Relation('path', (self.x, self.y))
+        logic.store(self.db, logic.Clause(path, [self.linked(self.x,
+                                                             self.y).head]))
+        logic.store(self.db, logic.Clause(path, [
+            self.linked(self.x, z).head,
+            logic.Relation('path', (z, self.y))]))
+        goal = logic.Relation('path', (logic.Atom('a'), self.y))
+        self.assertEqual([('b',), ('c',), ('c',), ('d',), ('d',)],
+                         self.solutions(goal))
+
+    def test_numbers(self):
+        table = logic.fact_table(self.db, 'n')
+        for n in (1, 1.0, 2):
+            logic.store(self.db, logic.Clause(logic.Relation(
+                'n', (logic.Atom(n),))))
+        self.assertEqual(3, len(table.symbols))
+        goal = logic.Relation('n', (logic.Atom(1.0),))
+        self.assertEqual(2, len(list(logic.solve(goal, self.db))))
+        values = [s[self.x].atom for s in logic.solve(
+            logic.Relation('n', (self.x,)), self.db)]
+        self.assertEqual([int, float, int], map(type, values))
+
+    def test_retract(self):
+        bindings = logic.retract(self.db, self.linked('a', self.y))
+        self.assertEqual(logic.Atom('b'), bindings[self.y])
+        self.assertEqual([('c',)],
+                         self.solutions(self.linked('a', self.y).head))
+        self.assertEqual(3, len(self.table))
+
+    def test_logical_view(self):
+        goal = self.linked(self.x, self.y).head
+        solutions = logic.solve(goal, self.db)
+        next(solutions)
+        logic.store(self.db, self.linked('d', 'e'))
+        logic.retract(self.db, self.linked('a', 'c'))
+        self.assertEqual(3, len(list(solutions)))
+        self.assertEqual(4, len(list(logic.solve(goal, self.db))))
+
+    def test_other_clauses(self):
+        logic.store(self.db, self.linked('d', self.x))
+        self.assertTrue(isinstance(self.db['linked'], logic.Predicate))
+        self.assertEqual(5, len(self.db['linked']))
+        self.assertEqual([('b',), ('c',)],
+                         self.solutions(self.linked('a', self.y).head))
+        goal = self.linked('d', self.y).head
+        self.assertEqual(1, len(list(logic.solve(goal, self.db))))
+        self.assertRaises(ValueError, logic.fact_table, self.db, 'linked')
+
+    def test_builtins(self):
+        goal = logic.Relation('retract', [self.linked('b', self.y).head])
+        self.assertEqual([{self.y: logic.Atom('c')}],
+                         list(logic.solve(goal, self.db)))
+        goal = logic.Relation('assertz', [self.linked('e', 'f').head])
+        self.assertEqual([{}], list(logic.solve(goal, self.db)))
+        self.assertTrue(self.db['linked'] is self.table)
+        self.assertEqual(4, len(self.table))
@@ -0,0 +1,118 @@
+import unittest
+from paip import logic
+from paip import parallel
+
+
+class ParallelTests(unittest.TestCase):
+    def setUp(self):
+        self.x = logic.Var('x')
+        self.y = logic.Var('y')
+        self.db = {}
+        for a, b in [('a', 'b'), ('b', 'c'), ('a', 'c'), ('c', 'd')]:
+            logic.store(self.db, logic.Clause(logic.Relation(
+                'linked', (logic.Atom(a), logic.Atom(b)))))
+        z = logic.Var('z')
+        logic.store(self.db, logic.Clause(
+            logic.Relation('path', (self.x, self.y)),
+            [logic.Relation('linked', (self.x, self.y))]))
+        logic.store(self.db, logic.Clause(
+            logic.Relation('path', (self.x, self.y)),
+            [logic.Relation('linked', (self.x, z)),
+             logic.Relation('path', (z, self.y))]))
+        self.goal = logic.Relation('path', (self.x, self.y))
+
+    def tearDown(self):
+        if hasattr(self, 'pool'):
+            self.pool.close()
+
+    def test_branches(self):
+        template = logic.Relation('solution', [self.x, self.y])
+        self.assertEqual(2, len(parallel.branches([self.goal], template,
+                                                  self.db, 1)))
+        self.assertEqual(8, len(parallel.branches([self.goal], template,
+                                                  self.db, 2)))
+
+    def test_cut_not_split(self):
+        logic.store(self.db, logic.Clause(
+            logic.Relation('one', (self.x,)),
+            [logic.Relation('linked', (self.x, self.y)), logic.CUT]))
+        goal = logic.Relation('one', (self.x,))
+        self.assertEqual([([goal], None)],
+                         parallel.branches([goal], None, self.db, 3))
+
+    def test_solve_in_order(self):
+        self.pool = parallel.ProverPool(self.db, processes=2, depth=2)
+        self.assertEqual(list(logic.solve(self.goal, self.db)),
+                         list(self.pool.solve(self.goal)))
+        self.assertEqual(list(logic.solve(self.goal, self.db, limit=3)),
+                         list(self.pool.solve(self.goal, limit=3)))
+
+    def test_unordered_and_first(self):
+        self.pool = parallel.ProverPool(self.db, processes=2)
+        expected = list(logic.solve(self.goal, self.db))
+        solutions = list(self.pool.solve(self.goal, ordered=False))
+        self.assertEqual(sorted(expected), sorted(solutions))
+        self.assertTrue(self.pool.first(self.goal) in expected)
+        goal = logic.Relation('path', (logic.Atom('d'), self.y))
+        self.assertEqual(None, self.pool.first(goal))
+
+    def test_errors(self):
+        self.pool = parallel.ProverPool(self.db, processes=2)
+        goal = logic.Relation('is', (self.x, logic.Atom('a')))
+        self.assertRaises(logic.EvaluationError, list, self.pool.solve(goal))
+        disjunction = logic.Relation(';', (self.goal, self.goal))
+        self.assertRaises(logic.BudgetExceeded, list,
+                          self.pool.solve(disjunction, inferences=5))
+
+    def test_solve_many(self):
+        self.pool = parallel.ProverPool(self.db, processes=2)
+        queries = [logic.Relation('path', (logic.Atom(a), self.y))
+                   for a in 'abcda']
+        expected = list(logic.solve_many(queries, self.db))
+        self.assertEqual(expected, list(self.pool.solve_many(queries)))
+        self.assertEqual(sorted(expected),
+                         sorted(self.pool.solve_many(queries, ordered=False)))
+        self.assertEqual(expected,
+                         list(logic.solve_many(queries, self.db, workers=2)))
+
+    def test_solve_many_errors(self):
+        logic.store(self.db, logic.Clause(
+            logic.Relation('loop', (self.x,)),
+            [logic.Relation('loop', (logic.Relation('f', (self.x,)),))]))
+        queries = [logic.Relation('loop', (self.x,)),
+                   logic.Relation('path', (logic.Atom('c'), self.y))]
+        self.pool = parallel.ProverPool(self.db, processes=2)
+        for ordered in (True, False):
+            results = sorted(self.pool.solve_many(queries, ordered=ordered,
+                                                  inferences=100))
+            self.assertEqual([0, 1], [i for i, solutions, error in results])
+            self.assertEqual('inferences', results[0][2].reason)
+            self.assertEqual((1, [{self.y: logic.Atom('d')}], None),
+                             results[1])
+
+    def test_query_cut_not_split(self):
+        goals = [self.goal, logic.CUT]
+        self.assertEqual([(goals, None)],
+                         parallel.branches(goals, None, self.db, 2))
+        self.pool = parallel.ProverPool(self.db, processes=2)
+        self.assertEqual(list(logic.solve(goals, self.db)),
+                         list(self.pool.solve(goals)))
+
+    def test_branch_vars_apart(self):
+        t = logic.Var('t')
+        head = logic.Relation('p', (logic.Relation('f', (self.y,)),))
+        logic.store(self.db, logic.Clause(head, [logic.Relation('g', (t,))]))
+        logic.store(self.db, logic.Clause(head, [logic.Relation('g', (t,))]))
+        logic.store(self.db, logic.Clause(logic.Relation('g', (t,)),
+                                          [logic.Relation('h', (self.x,))]))
+        logic.store(self.db, logic.Clause(logic.Relation(
+            'h', (logic.Atom('hval'),))))
+        goal = logic.Relation('p', (self.x,))
+        # The workers start with the same counter of fresh variables as the
+        # query is split with.
+        list(logic.solve(goal, self.db))
+        self.pool = parallel.ProverPool(self.db, processes=2)
+        solutions = list(self.pool.solve(goal))
+        self.assertEqual(2, len(solutions))
+        for solution in solutions:
+            self.assertTrue(isinstance(solution[self.x].args[0], logic.Var))
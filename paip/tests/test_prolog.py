@@ -0,0 +1,497 @@
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import unittest
+import prolog
+from paip import logic
+from paip.tests import reference_lexer
+
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', 'examples', 'prolog')
+
+
+class LexerTests(unittest.TestCase):
+    def test_examples_as_before(self):
+        for name in sorted(os.listdir(EXAMPLES)):
+            with open(os.path.join(EXAMPLES, name)) as f:
+                text = f.read()
+            self.assertEqual(list(reference_lexer.tokens(text)),
+                             list(prolog.tokens(text)), name)
+
+    def test_operators_as_before(self):
+        text = ('?- ?x is -3 + 4.5 * 2 // 7 / 1 mod 2, ?x =< 1, ?x >= 2, '
+                '?x < 3, ?x > 4, ?x =:= 5, ?x =\\= 6, \\+ p, (a -> b ; c), '
+                '!, [a | ?t] # comment\n<- p(?x) :- q(?x)  # at the end')
+        self.assertEqual(list(reference_lexer.tokens(text)),
+                         list(prolog.tokens(text)))
+
+    def test_lines(self):
+        lines = ['<- p(a)\n', '\n', '?- p(?x)\n']
+        self.assertEqual(list(prolog.tokens(''.join(lines))),
+                         list(prolog.tokens(lines)))
+
+    def test_error_position(self):
+        try:
+            list(prolog.tokens(['<- p(a)\n', '?- p(?x) & q\n']))
+            self.fail('no error')
+        except prolog.TokenError as e:
+            self.assertEqual('Token error: no token begins with & at line 2, '
+                             'column 10', str(e))
+
+    def test_no_less_or_equal(self):
+        # No built-in compares with <=, so it isn't a token.
+        self.assertRaises(prolog.TokenError, list, prolog.tokens('?x <= 1'))
+
+
+class ParserTests(unittest.TestCase):
+    def parse(self, line):
+        return repr(prolog.parse(line))
+
+    def assertError(self, message, line):
+        try:
+            prolog.parse(line)
+            self.fail('no error')
+        except prolog.ParseError as e:
+            self.assertEqual('Parse error: ' + message, str(e))
+
+    def test_cut_and_negation(self):
+        self.assertEqual('(p(?x), (!, q))', self.parse('?- p(?x), !, q'))
+        self.assertEqual('m(?x) :- \\+ \\+ p(?x), !',
+                         self.parse('<- m(?x) :- \\+ \\+ p(?x), !'))
+
+    def test_disjunction(self):
+        self.assertEqual('(p ; (q ; r))', self.parse('?- (p ; q ; r)'))
+        self.assertEqual('(((p, q) -> r) ; s)',
+                         self.parse('?- (p, q -> r ; s)'))
+        self.assertEqual('(p -> q)', self.parse('?- (p -> q)'))
+        self.assertEqual('(p, q)', self.parse('?- (p), q'))
+
+    def test_unparenthesized_disjunction(self):
+        self.assertError('Expected the end of the line, got SEMI at line 1, '
+                         'column 10', '?- p(?x) ; q')
+        self.assertError('Expected the end of the line, got ARROW at line 1, '
+                         'column 9', '?- p, q -> r')
+
+    def test_clause_argument(self):
+        self.assertEqual('assertz((g(?x) :- (p(?x), q(?x))))',
+                         self.parse('?- assertz(g(?x) :- p(?x), q(?x))'))
+
+    def test_precedence(self):
+        self.assertEqual('?x is ((1 + (2 * 3)) - 4)',
+                         self.parse('?- ?x is 1 + 2 * 3 - 4'))
+        self.assertEqual('?x is ((1 + 2) * 3)',
+                         self.parse('?- ?x is (1 + 2) * 3'))
+        self.assertEqual('?x is (((7 mod 3) // 2) / 1)',
+                         self.parse('?- ?x is 7 mod 3 // 2 / 1'))
+        self.assertEqual('?x is (max(1, 2) + abs(-3))',
+                         self.parse('?- ?x is max(1, 2) + abs(-3)'))
+
+    def test_signs(self):
+        # A minus sign is folded into a number, but not into anything else.
+        q = prolog.parse('?- ?x is 2 - -1.5')
+        self.assertEqual(logic.Atom(-1.5), q.args[1].args[1])
+        self.assertEqual('?x is -?y', self.parse('?- ?x is - ?y'))
+        self.assertEqual('?x is -(2 + 1)', self.parse('?- ?x is -(2 + 1)'))
+        self.assertEqual('?x is 4', self.parse('?- ?x is +4'))
+
+    def test_comparisons(self):
+        self.assertEqual('(1 + 2) =:= 3', self.parse('?- 1 + 2 =:= 3'))
+        for op in ['<', '>', '=<', '>=', '=:=', '=\\=']:
+            q = prolog.parse('?- ?x %s 2' % op)
+            self.assertEqual((op, 2), (q.pred, len(q.args)))
+
+    def test_prefix_is(self):
+        q = prolog.parse('?- is(?n, 2 + 1)')
+        self.assertEqual('?n is (2 + 1)', repr(q))
+        self.assertEqual(3, logic.first(q, {})[logic.Var('n')].atom)
+
+    def test_expressions_not_goals(self):
+        self.assertError('Not a goal: (?x + 1) at line 1, column 10',
+                         '?- ?x + 1')
+        self.assertError('Not a goal: (1 mod 2) at line 1, column 13',
+                         '?- mod(1, 2)')
+        self.assertError('Unknown term lookahead: EOF at line 1, column 13',
+                         '?- ?x is 1 +')
+
+    def test_lists(self):
+        self.assertTrue(prolog.parse('?- p([])').args[0] is logic.NIL)
+        self.assertEqual('p([a, b, c])', self.parse('?- p([a, b, c])'))
+        self.assertEqual('p([a, b | ?t])', self.parse('?- p([a, b | ?t])'))
+        self.assertEqual('p([[1, 2], []])',
+                         self.parse('?- p([[1, 2], [] | []])'))
+        self.assertEqual('p([(1 + 2), f(x)])',
+                         self.parse('?- p([1 + 2, f(x)])'))
+        self.assertEqual(prolog.parse('?- p([a, b, c])'),
+                         prolog.parse('?- p([a | [b, c]])'))
+
+    def test_list_tail(self):
+        q = prolog.parse('?- append([a | ?t], [c], [a, b, c])')
+        self.assertEqual('[b]', repr(logic.first(q, {})[logic.Var('t')]))
+
+    def test_bad_lists(self):
+        self.assertError('Unknown term lookahead: | at line 1, column 10',
+                         '?- p([a, | ?t])')
+        self.assertError('Expected RBRACKET, got COMMA at line 1, column 13',
+                         '?- p([a | ?t, b])')
+        self.assertError('Unknown term lookahead: | at line 1, column 7',
+                         '?- p([| ?t])')
+        self.assertError('Expected RBRACKET, got IDENT at line 1, column 9',
+                         '?- p([a b])')
+
+    def test_not_goals(self):
+        self.assertError('Not a goal: 3 at line 1, column 5', '?- 3')
+        self.assertError('Not a goal: ?x at line 1, column 6', '?- ?x')
+        self.assertError('Not a goal: [] at line 1, column 6', '?- []')
+        self.assertError('Expected RPAREN, got EOF at line 1, column 6',
+                         '?- (p')
+
+
+class ConsultTests(unittest.TestCase):
+    def consult(self, text):
+        return prolog.consult(StringIO.StringIO(text))
+
+    def assertError(self, error, message, text):
+        try:
+            self.consult(text)
+            self.fail('no error')
+        except error as e:
+            self.assertEqual(message, str(e))
+
+    def test_examples(self):
+        db = prolog.consult(os.path.join(EXAMPLES, 'family.prolog'))
+        self.assertEqual('male(james1)', repr(db['male'][0]))
+        self.assertTrue(logic.first(logic.Relation(
+            'parent', (logic.Atom('charles1'), logic.Var('x'))), db))
+
+    def test_definitions_span_lines(self):
+        db = self.consult('# comment\n<- p(a)  # another\n<- q(b,\n  c)\n')
+        self.assertEqual(['p(a)'], map(repr, db['p']))
+        self.assertEqual(['q(b, c)'], map(repr, db['q']))
+
+    def test_into_db(self):
+        db = {}
+        self.assertTrue(prolog.consult(StringIO.StringIO('<- p(a)\n'), db)
+                        is db)
+        self.assertEqual(1, len(db['p']))
+
+    def test_parse_error_position(self):
+        self.assertError(prolog.ParseError,
+                         'Parse error: Expected RPAREN, got DEFN_BEGIN at '
+                         'line 5, column 1',
+                         '<- p(a)\n<- q(?x) :-\n    p(?x),\n    r(?x\n'
+                         '<- s(b)\n')
+
+    def test_token_error_position(self):
+        self.assertError(prolog.TokenError,
+                         'Token error: no token begins with @ at line 2, '
+                         'column 19', '<- p(a)\n<- q(?x) :- p(?x) @\n')
+
+    def test_query_rejected(self):
+        self.assertError(prolog.ParseError,
+                         'Parse error: Expected a definition, got a query at '
+                         'line 3, column 4', '<- p(a)\n\n   ?- p(?x)\n')
+
+
+class ImageTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, 'db.prolog')
+        self.image = self.source + prolog.IMAGE_SUFFIX
+        self.write('<- p(a)\n<- p(b)\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text, mtime=1000000000):
+        with open(self.source, 'w') as f:
+            f.write(text)
+        os.utime(self.source, (mtime, mtime))
+
+    def load_db(self, compile=False):
+        with open(self.source) as f:
+            return prolog.load_db(f, compile=compile)
+
+    def header(self):
+        with open(self.image, 'rb') as f:
+            return prolog.IMAGE_HEADER.unpack(
+                f.read(prolog.IMAGE_HEADER.size))
+
+    def test_no_image(self):
+        self.assertEqual(None, prolog.load_image(self.source, self.image))
+        self.assertEqual(2, len(self.load_db()['p']))
+        self.assertFalse(os.path.exists(self.image))
+
+    def test_current(self):
+        self.load_db(compile=True)
+        db = prolog.load_image(self.source, self.image)
+        self.assertEqual(['p(a)', 'p(b)'], map(repr, db['p']))
+
+    def test_touched(self):
+        self.load_db(compile=True)
+        digest = self.header()[4]
+        os.utime(self.source, (2000000000, 2000000000))
+        self.assertNotEqual(None, prolog.load_image(self.source, self.image))
+        self.assertEqual(('PAIPDB', prolog.IMAGE_VERSION, 2000000000.0,
+                          16, digest), self.header())
+
+    def test_stale(self):
+        self.load_db(compile=True)
+        self.write('<- p(c)\n')
+        self.assertEqual(None, prolog.load_image(self.source, self.image))
+        # Loading rebuilds the image from the source.
+        self.assertEqual(['p(c)'], map(repr, self.load_db()['p']))
+        db = prolog.load_image(self.source, self.image)
+        self.assertEqual(['p(c)'], map(repr, db['p']))
+
+    def test_stale_same_size(self):
+        self.load_db(compile=True)
+        self.write('<- p(a)\n<- p(c)\n', 1000000001)
+        self.assertEqual(None, prolog.load_image(self.source, self.image))
+
+    def test_other_version(self):
+        self.load_db(compile=True)
+        magic, version, mtime, size, digest = self.header()
+        with open(self.image, 'r+b') as f:
+            f.write(prolog.IMAGE_HEADER.pack(magic, version + 1, mtime, size,
+                                             digest))
+        self.assertEqual(None, prolog.load_image(self.source, self.image))
+
+    def test_damaged(self):
+        self.load_db(compile=True)
+        with open(self.image, 'r+b') as f:
+            f.truncate(prolog.IMAGE_HEADER.size + 5)
+        self.assertEqual(None, prolog.load_image(self.source, self.image))
+        self.assertEqual(2, len(self.load_db()['p']))
+        self.assertNotEqual(None, prolog.load_image(self.source, self.image))
+
+
+class BatchTests(unittest.TestCase):
+    lines = ['<- p(a)\n', '<- p(b)\n', '?- p(?x)\n', '\n', '?- q(\n',
+             '?- ?x is 1 + a\n', '<- r(?x) :- r(f(?x))\n', '?- r(a)\n',
+             '?- p(c)\n']
+
+    def run_queries(self, lines, **options):
+        out = StringIO.StringIO()
+        errors = prolog.run_queries({}, lines, out, 'jsonl', **options)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        for record in records:
+            self.assertTrue(isinstance(record.pop('elapsed'), float))
+        return errors, records
+
+    def test_records(self):
+        errors, records = self.run_queries(self.lines, limit=None,
+                                           inferences=50)
+        self.assertEqual(2, errors)
+        self.assertEqual([
+            {'query': 3, 'solution': {'x': 'a'}},
+            {'query': 3, 'solution': {'x': 'b'}},
+            {'query': 3, 'goal': 'p(?x)', 'status': 'ok', 'solutions': 2,
+             'inferences': 1}], records[:3])
+        self.assertEqual({'query': 9, 'goal': 'p(c)', 'status': 'ok',
+                          'solutions': 0, 'inferences': 1}, records[-1])
+
+    def test_error_records(self):
+        errors, records = self.run_queries(self.lines, inferences=50)
+        parse, evaluation, budget = records[2:5]
+        self.assertEqual(5, parse['query'])
+        self.assertEqual('error', parse['status'])
+        self.assertTrue(parse['error'].startswith('Parse error: '))
+        self.assertEqual({'query': 6, 'goal': '?x is (1 + a)',
+                          'status': 'error', 'solutions': 0, 'inferences': 1,
+                          'error': 'Evaluation error: a is not a number'},
+                         evaluation)
+        self.assertEqual(8, budget['query'])
+        self.assertEqual('inferences', budget['status'])
+        self.assertEqual(50, budget['inferences'])
+        self.assertTrue('deepest goal r(f(f(f(...))))' in budget['error'])
+
+    def test_limit(self):
+        errors, records = self.run_queries(self.lines[:3])
+        self.assertEqual([{'query': 3, 'solution': {'x': 'a'}},
+                          {'query': 3, 'goal': 'p(?x)', 'status': 'ok',
+                           'solutions': 1, 'inferences': 1}], records)
+
+    def test_values(self):
+        errors, records = self.run_queries(
+            ['?- ?n is 7 / 2, ?i is 6 / 2, append([a], [1], ?l)\n'])
+        self.assertEqual({'n': 3.5, 'i': 3, 'l': '[a, 1]'},
+                         records[0]['solution'])
+
+    def test_text(self):
+        out = StringIO.StringIO()
+        prolog.run_queries({}, self.lines[:3] + ['?- p(a)\n', '?- p(c)\n'],
+                           out)
+        # Leave out the inferences and time from the summaries.
+        lines = [', '.join(line.split(', ')[:2]) if line.startswith('#')
+                 else line for line in out.getvalue().splitlines()]
+        self.assertEqual(['?x : a', '', '# query 3, ok: 1 solutions', '',
+                          'Yes.', '', '# query 4, ok: 1 solutions', '',
+                          'No.', '# query 5, ok: 0 solutions', ''], lines)
+
+
+class ServerTests(unittest.TestCase):
+    # The server runs in a thread, handing requests to this test in place of
+    # its pool of workers.
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        address = os.path.join(self.dir, 'socket')
+        prolog.install_db(prolog.consult(StringIO.StringIO(
+            '<- p(a)\n<- p(b)\n<- r(?x) :- r(f(?x))\n')))
+        self.server = prolog.UnixQueryServer(address, prolog.QueryHandler)
+        self.server.pool = self
+        self.server.limit = 1
+        self.server.inferences = 100
+        self.server.timeout = None
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.01,))
+        self.thread.start()
+        self.client = prolog.Client(address)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        prolog.install_db(None)
+        shutil.rmtree(self.dir)
+
+    def apply(self, function, args):
+        return function(*args)
+
+    def query(self, query, **options):
+        records = self.client.query(query, **options)
+        for record in records:
+            record.pop('elapsed')
+        return records
+
+    def test_query(self):
+        self.assertEqual([{'query': 1, 'solution': {'x': 'a'}},
+                          {'query': 1, 'goal': 'p(?x)', 'status': 'ok',
+                           'solutions': 1, 'inferences': 1}],
+                         self.query('?- p(?x)'))
+
+    def test_options(self):
+        records = self.query('?- p(?x)', id='q', limit=None)
+        self.assertEqual([{'x': 'a'}, {'x': 'b'}],
+                         [record['solution'] for record in records[:-1]])
+        self.assertEqual(('q', 2), (records[-1]['query'],
+                                    records[-1]['solutions']))
+
+    def test_inferences_capped(self):
+        summary = self.query('?- r(a)', inferences=1000)[-1]
+        self.assertEqual(('inferences', 100),
+                         (summary['status'], summary['inferences']))
+        summary = self.query('?- r(a)', inferences=10)[-1]
+        self.assertEqual(10, summary['inferences'])
+
+    def test_numbered_by_line(self):
+        self.query('?- p(a)')
+        self.assertEqual(2, self.query('?- p(c)')[-1]['query'])
+
+    def test_bad_request(self):
+        self.client.wfile.write('{bad\n')
+        self.client.wfile.flush()
+        summary = json.loads(self.client.rfile.readline())
+        self.assertEqual('error', summary['status'])
+        self.assertTrue(summary['error'].startswith('Bad request: '))
+        self.assertEqual(1, len(self.query('?- p(c)')))
+
+    def test_parse_address(self):
+        self.assertEqual(('localhost', 8000), prolog.parse_address(':8000'))
+        self.assertEqual(('example.com', 80),
+                         prolog.parse_address('example.com:80'))
+        self.assertEqual('/tmp/prolog', prolog.parse_address('/tmp/prolog'))
+
+    def test_at_most(self):
+        self.assertEqual(5, prolog.at_most(None, 5))
+        self.assertEqual(3, prolog.at_most(3, 5))
+        self.assertEqual(7, prolog.at_most(7, None))
+
+
+class InspectTests(unittest.TestCase):
+    def setUp(self):
+        self.db = {}
+        logic.fact_table(self.db, 'linked')
+        text = ''.join('<- likes(x%d, y)\n' % i for i in range(10))
+        text += '<- likes(?x, ?x)\n<- linked(a, b)\n<- linked(b, c)\n'
+        prolog.consult(StringIO.StringIO(text), self.db)
+
+    def inspect(self, line):
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self.assertTrue(prolog.inspect(self.db, line))
+            return sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+
+    def test_describe(self):
+        self.assertEqual('11 clauses', prolog.describe(self.db['likes']))
+        self.assertEqual('1 clause', prolog.describe(self.db['likes'][:1]))
+        self.assertEqual('2 facts in a table',
+                         prolog.describe(self.db['linked']))
+
+    def test_clauses(self):
+        self.assertEqual(['likes: 11 clauses', 'linked: 2 facts in a table',
+                          '13 clauses in all.'], self.inspect('clauses'))
+
+    def test_listing(self):
+        self.assertEqual(['linked: 2 facts in a table', '\tlinked(a, b)',
+                          '\tlinked(b, c)'], self.inspect('listing linked'))
+        self.assertEqual(['No clauses for nope.'],
+                         self.inspect('listing nope'))
+        # The whole listing leaves out the facts in tables.
+        lines = self.inspect('listing')
+        self.assertEqual('Database:', lines[0])
+        self.assertTrue('linked: 2 facts in a table' in lines)
+        self.assertEqual(14, len(lines))
+
+    def test_indexes(self):
+        self.assertEqual(['likes: 11 clauses', '\tno indexes'],
+                         self.inspect('indexes likes'))
+        y = logic.Var('y')
+        logic.first(logic.Relation('likes', (logic.Atom('x3'), y)), self.db)
+        logic.first(logic.Relation('linked', (logic.Atom('b'), y)), self.db)
+        self.assertEqual(['likes: 11 clauses',
+                          '\targument 1: 10 keys, largest bucket 2, '
+                          '1 clauses for any key',
+                          'linked: 2 facts in a table',
+                          '\targument 1: 2 keys, largest bucket 1'],
+                         self.inspect('indexes'))
+        self.assertEqual(['No clauses for nope.'],
+                         self.inspect('indexes nope'))
+
+    def test_other_lines(self):
+        for line in ['?- listing', 'listing a b', 'clauses now', '']:
+            self.assertFalse(prolog.inspect(self.db, line))
+
+
+class RequestTests(unittest.TestCase):
+    def test_plain_query(self):
+        self.assertEqual((3, '?- p(?x)\n', 1, 100, 2.0),
+                         prolog.parse_request('?- p(?x)\n', 3, 1, 100, 2.0))
+
+    def test_json(self):
+        line = ('{"query": "?- p(?x)", "id": "q", "limit": null, '
+                '"inferences": 50, "timeout": 5}')
+        self.assertEqual(('q', '?- p(?x)', None, 50, 2.0),
+                         prolog.parse_request(line, 3, 1, 100, 2.0))
+
+    def test_capped(self):
+        line = '{"query": "?- p(?x)", "inferences": 500, "timeout": 0.5}'
+        self.assertEqual((1, '?- p(?x)', 1, 100, 0.5),
+                         prolog.parse_request(line, 1, 1, 100, 2.0))
+
+    def test_invalid(self):
+        for line in ['{"query": 5}', '{bad', '{"id": 1}',
+                     '{"query": "?- p", "limit": "x"}',
+                     '{"query": "?- p", "limit": -1}',
+                     '{"query": "?- p", "inferences": "9"}',
+                     '{"query": "?- p", "timeout": true}',
+                     '{"query": "?- p", "id": [1]}']:
+            self.assertRaises(ValueError, prolog.parse_request, line, 1, 1,
+                              None, None)
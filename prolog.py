@@ -1,7 +1,19 @@
 #! /usr/bin/env python
 
 import argparse
+import cPickle
+import hashlib
+import json
 import logging
+import mmap
+import multiprocessing
+import os
+import re
+import signal
+import socket
+import SocketServer
+import StringIO
+import struct
 import sys
 
 from paip import logic
@@ -12,22 +24,48 @@ from paip import logic
 # QUESTION = "?"
 # DEFN_BEGIN = "<-"
 # QUERY_BEGIN = QUESTION "-"
-# NUM = (-|+)?[0-9]+("."[0-9]+)?
+# NUM = [0-9]+("."[0-9]+)?
 # IDENT: [a-zA-Z][a-zA-Z0-9_]*
 # WHEN = ":-"
 # LPAREN = "("
 # RPAREN = ")"
 # COMMA = ","
+# LBRACKET = "["
+# RBRACKET = "]"
+# BAR = "|"
+# CUT = "!"
+# SEMI = ";"
+# ARROW = "->"
+# NOT = "\+"
+# ADD_OP = "+" | "-"
+# MUL_OP = "*" | "/" | "//"
+# COMPARE = "<" | ">" | "=<" | ">=" | "=:=" | "=\="
 
 # command: EOF | query | defn
-# query: QUERY_BEGIN relation
-# defn: DEFN_BEGIN relation (WHEN relation_list)?
-# relation_list = relation [COMMA relation]*
-# relation: IDENT LPAREN term [COMMA term]* RPAREN
-# term: relation | var | atom
+# query: QUERY_BEGIN goal_list
+# defn: DEFN_BEGIN relation (WHEN goal_list)?
+# goal_list: goal [COMMA goal]*
+# goal: CUT | NOT goal | LPAREN disjunction RPAREN | comparison | IDENT
+#     | relation
+# disjunction: conditional [SEMI conditional]*
+# conditional: goal_list (ARROW goal_list)?
+# comparison: term (COMPARE | "is") term
+# relation: IDENT LPAREN argument [COMMA argument]* RPAREN
+# argument: term (WHEN goal_list)?
+# term: product [ADD_OP product]*
+# product: factor [(MUL_OP | "mod") factor]*
+# factor: ADD_OP factor | LPAREN term RPAREN | list | relation | var | atom
+# list: LBRACKET (term [COMMA term]* (BAR term)?)? RBRACKET
 # atom: NUM | IDENT
 # var: QUESTION IDENT
 
+# Since a goal beginning with LPAREN is a disjunction, a comparison can't
+# begin with a parenthesized expression.  A relation whose predicate is an
+# arithmetic operator, like ?x + 1, is a term but not a goal.  A minus sign
+# before a number is folded into the number.  An argument with a WHEN is a
+# clause, as asserted by assertz(head :- body); its goal_list takes up the
+# rest of the arguments.
+
 
 class ParseError(Exception):
     def __init__(self, err):
@@ -43,18 +81,29 @@ class Parser(object):
     def __init__(self, lexer):
         self.lexer = lexer
         self.lookahead = []
+        # Where each lookahead token is (see `Lexer.location`).
+        self.locations = []
         for i in xrange(Parser.k):
-            self.lookahead.append(lexer.next())
+            self.advance()
+
+    def advance(self):
+        self.lookahead.append(self.lexer.next())
+        self.locations.append(self.lexer.location())
 
     def la(self, i):
         return self.lookahead[i-1]
 
+    def error(self, err):
+        return ParseError('%s at line %d, column %d' %
+                          ((err,) + position(*self.locations[0])))
+
     def match(self, exp_tt):
         tt, tok = self.la(1)
         if tt != exp_tt:
-            raise ParseError('Expected %s, got %s' % (exp_tt, tt))
+            raise self.error('Expected %s, got %s' % (exp_tt, tt))
         self.lookahead.pop(0)
-        self.lookahead.append(self.lexer.next())
+        self.locations.pop(0)
+        self.advance()
         return tok
 
     def command(self):
@@ -65,11 +114,11 @@ class Parser(object):
             return self.query()
         elif tt == DEFN_BEGIN:
             return self.defn()
-        raise ParseError('Unknown command: %s' % tok)
+        raise self.error('Unknown command: %s' % tok)
 
     def query(self):
         self.match(QUERY_BEGIN)
-        return self.relation()
+        return logic.conjunction(self.goal_list())
 
     def defn(self):
         self.match(DEFN_BEGIN)
@@ -77,33 +126,120 @@ class Parser(object):
         tt, tok = self.la(1)
         if tt == WHEN:
             self.match(WHEN)
-            return logic.Clause(head, self.relation_list())
+            return logic.Clause(head, self.goal_list())
         return logic.Clause(head)
 
-    def relation_list(self):
-        rels = [self.relation()]
+    def goal_list(self):
+        goals = [self.goal()]
         tt, tok = self.la(1)
         while tt == COMMA:
             self.match(COMMA)
-            rels.append(self.relation())
+            goals.append(self.goal())
             tt, tok = self.la(1)
-        return rels
+        return goals
+
+    def goal(self):
+        tt, tok = self.la(1)
+        if tt == CUT:
+            self.match(CUT)
+            return logic.CUT
+        if tt == NOT:
+            self.match(NOT)
+            return logic.Relation('\\+', [self.goal()])
+        if tt == LPAREN:
+            self.match(LPAREN)
+            goal = self.disjunction()
+            self.match(RPAREN)
+            return goal
+        left = self.term()
+        tt, tok = self.la(1)
+        if tt == COMPARE or (tt, tok) == (IDENT, 'is'):
+            self.match(tt)
+            return logic.Relation(tok, [left, self.term()])
+        if (isinstance(left, logic.Atom) and isinstance(left.atom, str)
+            and left is not logic.NIL):
+            return logic.Relation(left.atom, [])
+        # Arithmetic expressions aren't goals, but is(?x, 3) is.
+        if isinstance(left, logic.Relation) and logic.INFIX.get(left.pred,
+                                                                True):
+            return left
+        raise self.error('Not a goal: %s' % left)
+
+    def disjunction(self):
+        goal = self.conditional()
+        tt, tok = self.la(1)
+        if tt == SEMI:
+            self.match(SEMI)
+            return logic.Relation(';', [goal, self.disjunction()])
+        return goal
+
+    def conditional(self):
+        goal = logic.conjunction(self.goal_list())
+        tt, tok = self.la(1)
+        if tt == ARROW:
+            self.match(ARROW)
+            then = logic.conjunction(self.goal_list())
+            return logic.Relation('->', [goal, then])
+        return goal
 
     def relation(self):
         pred = self.match(IDENT)
         body = []
         self.match(LPAREN)
-        body.append(self.term())
+        body.append(self.argument())
         tt, tok = self.la(1)
         while tt == COMMA:
             self.match(COMMA)
-            body.append(self.term())
+            body.append(self.argument())
             tt, tok = self.la(1)
         self.match(RPAREN)
         return logic.Relation(pred, body)
 
+    def argument(self):
+        term = self.term()
+        tt, tok = self.la(1)
+        if tt == WHEN:
+            self.match(WHEN)
+            goals = logic.conjunction(self.goal_list())
+            return logic.Relation(':-', [term, goals])
+        return term
+
     def term(self):
+        term = self.product()
+        tt, tok = self.la(1)
+        while tt == ADD_OP:
+            self.match(ADD_OP)
+            term = logic.Relation(tok, [term, self.product()])
+            tt, tok = self.la(1)
+        return term
+
+    def product(self):
+        product = self.factor()
+        tt, tok = self.la(1)
+        while tt == MUL_OP or (tt, tok) == (IDENT, 'mod'):
+            self.match(tt)
+            product = logic.Relation(tok, [product, self.factor()])
+            tt, tok = self.la(1)
+        return product
+
+    def factor(self):
         tt, tok = self.la(1)
+        if tt == ADD_OP:
+            self.match(ADD_OP)
+            factor = self.factor()
+            if tok == '+':
+                return factor
+            if (isinstance(factor, logic.Atom)
+                and isinstance(factor.atom, (int, long, float))):
+                return logic.Atom(-factor.atom)
+            return logic.Relation('-', [factor])
+        if tt == LPAREN:
+            self.match(LPAREN)
+            term = self.term()
+            self.match(RPAREN)
+            return term
+        if tt == LBRACKET:
+            return self.list()
         if tt == QUESTION:
             return self.var()
         elif tt == NUM:
@@ -115,7 +251,26 @@ class Parser(object):
             else:
                 return self.atom()
         else:
-            raise ParseError('Unknown term lookahead: %s' % tok)
+            raise self.error('Unknown term lookahead: %s' % tok)
+
+    def list(self):
+        self.match(LBRACKET)
+        tt, tok = self.la(1)
+        if tt == RBRACKET:
+            self.match(RBRACKET)
+            return logic.NIL
+        elements = [self.term()]
+        tt, tok = self.la(1)
+        while tt == COMMA:
+            self.match(COMMA)
+            elements.append(self.term())
+            tt, tok = self.la(1)
+        tail = logic.NIL
+        if tt == BAR:
+            self.match(BAR)
+            tail = self.term()
+        self.match(RBRACKET)
+        return logic.List(elements, tail)
 
     def var(self):
         self.match(QUESTION)
@@ -128,7 +283,7 @@ class Parser(object):
         elif tt == IDENT:
             return logic.Atom(self.match(IDENT))
         else:
-            raise ParseError('Unknown atom: %s' % tok)
+            raise self.error('Unknown atom: %s' % tok)
 
 
 class TokenError(Exception):
@@ -142,133 +297,118 @@ class TokenError(Exception):
 LPAREN = 'LPAREN'
 RPAREN = 'RPAREN'
 COMMA = 'COMMA'
+LBRACKET = 'LBRACKET'
+RBRACKET = 'RBRACKET'
+BAR = 'BAR'
 QUESTION = 'QUESTION'
 DEFN_BEGIN = 'DEFN_BEGIN'
 QUERY_BEGIN = 'QUERY_BEGIN'
 NUM = 'NUM'
 IDENT = 'IDENT'
 WHEN = 'WHEN'
+CUT = 'CUT'
+SEMI = 'SEMI'
+ARROW = 'ARROW'
+NOT = 'NOT'
+ADD_OP = 'ADD_OP'
+MUL_OP = 'MUL_OP'
+COMPARE = 'COMPARE'
 EOF = 'EOF'
 
 
-class Lexer(object):
-    def __init__(self, line):
-        self.line = line
-        self.pos = 0
-        self.ch = line[self.pos]
-
-    def eat(self):
-        ret = self.ch
-        self.pos += 1
-        if self.pos >= len(self.line):
-            self.ch = EOF
-        else:
-            self.ch = self.line[self.pos]
-        return ret
-
-    def match(self, exp):
-        if self.ch != exp:
-            raise TokenError('expected %s' % exp)
-        self.eat()
-
-    def expect(self, is_type):
-        if not is_type():
-            raise TokenError('expected type %s' % repr(is_type))
+# The lexer finds the tokens with a single regular expression, which tries
+# each kind of token in turn, as named groups, and matches the longest token
+# of the first kind that fits.  Whitespace and comments are matched as tokens
+# too, and skipped, and any other character is an error, so the matches
+# cover the whole text and the regular expression module can find them all
+# without our looking at each character.
+#
+# No token spans lines, so a lexer can read a file a line at a time, never
+# holding more than a line of it.  Its text is then a file or other iterable
+# of lines rather than a string.  The lexer records the offset in the current
+# line (or string) at which each token begins, from which its line and column
+# can be found.
+
+TOKEN = re.compile(r"""
+    (?P<SKIP>[ \t\n]+|\#[^\n]*)
+  | (?P<DEFN_BEGIN><-)
+  | (?P<COMPARE>=<|=:=|=\\=|<|>=?)
+  | (?P<QUERY_BEGIN>\?-)
+  | (?P<QUESTION>\?)
+  | (?P<IDENT>[a-zA-Z][a-zA-Z0-9]*)
+  | (?P<ARROW>->)
+  | (?P<NOT>\\\+)
+  | (?P<NUM>[0-9]+(?P<FRACTION>\.[0-9]+)?)
+  | (?P<ADD_OP>[+-])
+  | (?P<MUL_OP>//|[*/])
+  | (?P<WHEN>:-)
+  | (?P<LPAREN>\()
+  | (?P<RPAREN>\))
+  | (?P<COMMA>,)
+  | (?P<LBRACKET>\[)
+  | (?P<RBRACKET>\])
+  | (?P<BAR>\|)
+  | (?P<CUT>!)
+  | (?P<SEMI>;)
+  | (?P<ERROR>[\s\S])
+""", re.VERBOSE)
+
+
+def position(text, lineno, start):
+    """
+    Return the line and column of the offset start in text, which begins on
+    line lineno.
+    """
+    line = lineno + text.count('\n', 0, start)
+    column = start - (text.rfind('\n', 0, start) + 1) + 1
+    return line, column
 
-    def is_ws(self):
-        return self.ch in (' ', '\t', '\n')
-    
-    def DEFN_BEGIN(self):
-        self.match('<')
-        self.match('-')
-        return DEFN_BEGIN, '<-'
-
-    def is_when(self):
-        return self.ch == ':'
-
-    def WHEN(self):
-        self.match(':')
-        self.match('-')
-        return WHEN, ':-'
 
-    def is_number(self):
-        return self.ch in '0123456789'
+class Lexer(object):
+    def __init__(self, text):
+        if isinstance(text, basestring):
+            text = [text]
+        self.lines = iter(text)
+        self.text = ''
+        self.matches = iter(())
+        # The line on which the current text begins, and the offset in it at
+        # which the last token began.
+        self.lineno = 1
+        self.start = 0
+
+    def location(self):
+        """Return where the last token began, for `position`."""
+        return self.text, self.lineno, self.start
+
+    def position(self):
+        """Return the line and column at which the last token began."""
+        return position(self.text, self.lineno, self.start)
 
-    def is_num(self):
-        return self.is_number() or self.ch in ('+', '-')
-    
-    def NUM(self):
-        # get the leading sign
-        sign = 1
-        if self.ch == '+':
-            self.eat()
-        elif self.ch == '-':
-            sign = -1
-            self.eat()
-
-        # read the whole part
-        num = ''
-        self.expect(self.is_number)
-        while self.is_number():
-            num += self.eat()
-
-        if not self.ch == '.':
-            return NUM, int(num)
-        num += self.eat()
-
-        # read the fractional part
-        self.expect(self.is_number)
-        while self.is_number():
-            num += self.eat()
-        return NUM, float(num)
-
-    def is_ident(self):
-        letters = 'abcdefghijklmnopqrstuvwxyz'
-        return self.ch in letters or self.ch in letters.upper()
-
-    def IDENT(self):
-        ident = ''
-        self.expect(self.is_ident)
-        while self.is_ident() or self.is_number():
-            ident += self.eat()
-        return IDENT, ident
-
-    def comment(self):
-        self.match('#')
-        while self.ch != '\n':
-            self.eat()
-    
     def next(self):
-        while self.pos < len(self.line):
-            if self.is_ws():
-                self.eat()
-                continue
-            if self.ch == '#':
-                self.comment()
-                continue
-            if self.ch == '<':
-                return self.DEFN_BEGIN()
-            if self.ch == '?':
-                self.eat()
-                if self.ch == '-':
-                    self.eat()
-                    return QUERY_BEGIN, '?-'
-                return QUESTION, '?'
-            if self.is_ident():
-                return self.IDENT()
-            if self.is_num():
-                return self.NUM()
-            if self.is_when():
-                return self.WHEN()
-            if self.ch == '(':
-                return LPAREN, self.eat()
-            if self.ch == ')':
-                return RPAREN, self.eat()
-            if self.ch == ',':
-                return COMMA, self.eat()
-            raise TokenError('no token begins with %s' % self.ch)
-        return EOF, EOF
-    
+        while True:
+            for token in self.matches:
+                tt = token.lastgroup
+                if tt == 'SKIP':
+                    continue
+                self.start = token.start()
+                tok = token.group()
+                if tt == NUM:
+                    # lastgroup is the number, not its fraction, inside it.
+                    if token.group('FRACTION'):
+                        return NUM, float(tok)
+                    return NUM, int(tok)
+                if tt == 'ERROR':
+                    raise TokenError('no token begins with %s at line %d, '
+                                     'column %d' % ((tok,) + self.position()))
+                return tt, tok
+            line = next(self.lines, None)
+            if line is None:
+                self.start = len(self.text)
+                return EOF, EOF
+            self.lineno += self.text.count('\n')
+            self.text = line
+            self.matches = TOKEN.finditer(line)
+
 
 def tokens(line):
     lexer = Lexer(line)
@@ -281,16 +421,34 @@ def tokens(line):
 
 def parse(line):
     p = Parser(Lexer(line))
-    return p.command()
+    q = p.command()
+    # A disjunction must be parenthesized, so ?- p ; q is an error, not p.
+    tt, tok = p.la(1)
+    if tt != EOF:
+        raise p.error('Expected the end of the line, got %s' % tt)
+    return q
+
+
+def predicates(db):
+    """Return the (pred, clauses) of the database's predicates, by name."""
+    return sorted((pred, items) for pred, items in db.items()
+                  if isinstance(items, (list, logic.FactTable)))
+
+
+def describe(items):
+    """Return how many clauses items holds, and how."""
+    plural = '' if len(items) == 1 else 's'
+    if isinstance(items, logic.FactTable):
+        return '%d fact%s in a table' % (len(items), plural)
+    return '%d clause%s' % (len(items), plural)
 
 
 def print_db(db):
     print 'Database:'
-    longest = -1
-    for pred in db:
-        if len(pred) > longest:
-            longest = len(pred)
     for pred, items in db.items():
+        if isinstance(items, logic.FactTable):
+            print '%s: %s' % (pred, describe(items))
+            continue
         if not isinstance(items, list):
             continue
         print '%s:' % pred
@@ -298,21 +456,562 @@ def print_db(db):
             print '\t', item
 
 
-def read_db(db_file):
-    db = {}
-    for line in db_file:
-        if line == '\n': continue
-        q = parse(line)
-        if q:
-            logic.store(db, q)
+def print_listing(db, pred):
+    """Print the clauses of pred."""
+    items = db.get(pred)
+    if not isinstance(items, (list, logic.FactTable)):
+        print 'No clauses for %s.' % pred
+        return
+    print '%s: %s' % (pred, describe(items))
+    for item in items:
+        print '\t', item
+
+
+def print_counts(db):
+    """Print the number of clauses of each predicate, and the total."""
+    total = 0
+    for pred, items in predicates(db):
+        print '%s: %s' % (pred, describe(items))
+        total += len(items)
+    print '%d clauses in all.' % total
+
+
+# The argument indexes of a predicate are only built when a goal first has
+# that argument bound (see `logic.Predicate`), so a predicate may have none.
+
+def print_indexes(db, pred=None):
+    """Print the size of each argument index, of pred or of every predicate."""
+    found = False
+    for name, items in predicates(db):
+        if pred is not None and name != pred:
+            continue
+        found = True
+        print '%s: %s' % (name, describe(items))
+        if not items.indexes:
+            print '\tno indexes'
+        for position, index in sorted(items.indexes.items()):
+            buckets = getattr(index, 'buckets', index)
+            largest = max([len(bucket) for bucket in buckets.values()] or [0])
+            stats = '\targument %d: %d keys, largest bucket %d' % (
+                position + 1, len(buckets), largest)
+            if isinstance(index, logic.ArgumentIndex):
+                stats += ', %d clauses for any key' % len(index.unkeyed)
+            print stats
+    if not found:
+        print 'No clauses for %s.' % pred
+
+
+def inspect(db, line):
+    """
+    Carry out the REPL command on line if it inspects db (`listing`,
+    `clauses` or `indexes`), returning whether it did.
+    """
+    words = line.split()
+    if words and words[0] == 'listing' and len(words) <= 2:
+        if len(words) == 1:
+            print_db(db)
+        else:
+            print_listing(db, words[1])
+        return True
+    if words == ['clauses']:
+        print_counts(db)
+        return True
+    if words and words[0] == 'indexes' and len(words) <= 2:
+        print_indexes(db, *words[1:])
+        return True
+    return False
+
+
+## Consulting files
+
+# A database file is a sequence of definitions, read by a single parser.
+# Since a definition ends where the next begins, one may span as many lines
+# as it likes.  Each clause is stored as soon as it has been parsed, and the
+# file is read a line at a time, so consulting a file takes memory for the
+# clauses alone, not the text.
+
+def consult(source, db=None):
+    """
+    Store the clauses defined in source, a file or the path of one, in db (a
+    new database by default), and return it.  Raises ParseError or TokenError,
+    giving the line and column, if source has an error.
+    """
+    if db is None:
+        db = {}
+    if isinstance(source, basestring):
+        with open(source) as f:
+            return consult(f, db)
+    parser = Parser(Lexer(source))
+    while True:
+        location = parser.locations[0]
+        q = parser.command()
+        if q is None:
+            return db
+        if not isinstance(q, logic.Clause):
+            raise ParseError('Expected a definition, got a query at line %d, '
+                             'column %d' % position(*location))
+        logic.store(db, q)
+
+
+## Database images
+
+# Parsing a large database takes a long time, and it is the same every time
+# the interpreter starts.  So `--compile` saves the parsed database in an
+# *image* next to the source file, and later runs load the image instead.
+# The image is a pickle, read through a memory map of the file, but unpickling
+# still builds the whole database in memory: an image saves the time spent
+# parsing, not the memory the database takes.  It begins with a header
+# recording the version of its format and the modification time, size and
+# SHA-1 hash of the source it was made from.  If the source's time or size has
+# changed, its hash is checked too.  If the hash is the same, the image is used
+# and its header given the new time and size; if it has changed (or the image
+# is from another version, or damaged) the image is rebuilt from the source.
+
+IMAGE_SUFFIX = '.image'
+IMAGE_MAGIC = 'PAIPDB'
+IMAGE_VERSION = 1
+IMAGE_HEADER = struct.Struct('<6sIdQ20s')
+
+
+def source_stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+def source_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            sha.update(chunk)
+    return sha.digest()
+
+
+def save_image(db, source, image):
+    mtime, size = source_stamp(source)
+    header = IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, mtime, size,
+                               source_hash(source))
+    # Write a new image alongside the old, so a reader never sees half of it.
+    temp = image + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(header)
+        cPickle.dump(db, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp, image)
+
+
+def load_image(source, image):
+    """Return the database in image if it is current for source, or None."""
+    try:
+        f = open(image, 'rb')
+    except IOError:
+        return None
+    with f:
+        header = f.read(IMAGE_HEADER.size)
+        if len(header) < IMAGE_HEADER.size:
+            return None
+        magic, version, mtime, size, digest = IMAGE_HEADER.unpack(header)
+        if magic != IMAGE_MAGIC or version != IMAGE_VERSION:
+            return None
+        stamp = source_stamp(source)
+        if (mtime, size) != stamp and digest != source_hash(source):
+            return None
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            mapped.seek(IMAGE_HEADER.size)
+            db = cPickle.load(mapped)
+        except Exception: # a damaged image is rebuilt
+            return None
+        finally:
+            mapped.close()
+    if (mtime, size) != stamp:
+        restamp(image, stamp, digest)
+    return db
+
+
+def restamp(image, stamp, digest):
+    """
+    Record stamp in the header of image, whose source was touched without
+    changing, so later loads needn't hash the source again.
+    """
+    header = IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, stamp[0], stamp[1],
+                               digest)
+    try:
+        with open(image, 'r+b') as f:
+            f.write(header)
+    except IOError: # the image still works, it is just checked more slowly
+        pass
+
+
+def load_db(db_file, facts=(), compile=False):
+    """
+    Return the database in db_file, storing the facts of the predicates in
+    facts in tables.  Its image is used if it is current, and rebuilt if it
+    isn't or compile is true.
+    """
+    source = db_file.name
+    image = source + IMAGE_SUFFIX
+    db = None if compile else load_image(source, image)
+    if db is None:
+        db = {}
+        for pred in facts:
+            logic.fact_table(db, pred)
+        consult(db_file, db)
+        if compile or os.path.exists(image):
+            save_image(db, source, image)
+    for pred in facts:
+        logic.fact_table(db, pred)
     return db
 
 
+## Answering queries in batches
+
+# Run from a pipeline, the interpreter answers a file of queries, one to a
+# line, without asking anything, and writes each solution as soon as it is
+# found.  Lines may also define clauses, as in the REPL, which later queries
+# can use.  In the `jsonl` format each solution is a JSON object on a line of
+# its own:
+#
+#     {"query": 1, "solution": {"x": "b"}, "elapsed": 0.0002}
+#
+# Variables are named without their `?`, and their values are numbers or
+# strings, with terms other than atoms written as in queries.  Once a query
+# is done, a summary of it follows:
+#
+#     {"query": 1, "goal": "path(a, ?x)", "status": "ok", "solutions": 3,
+#      "inferences": 12, "elapsed": 0.0004}
+#
+# The status is `ok` if the query was answered, `error` if it couldn't be
+# parsed or evaluated (with the error given as `error`), or the reason its
+# budget ran out: `inferences`, `timeout` or `cancelled`.  Times are in
+# seconds.  Queries are numbered by their lines.
+
+def term_json(term):
+    if isinstance(term, logic.Atom) and not isinstance(term.atom, bool):
+        if isinstance(term.atom, (int, long, float, basestring)):
+            return term.atom
+    return str(term)
+
+
+class BatchWriter(object):
+
+    """Writes the solutions and summaries of queries in a format."""
+
+    def __init__(self, out, format):
+        self.out = out
+        self.format = format
+
+    def solution(self, query, solution, elapsed):
+        if self.format == 'jsonl':
+            self.write({'query': query, 'elapsed': elapsed,
+                        'solution': dict((var.var, term_json(value))
+                                         for var, value in solution.items())})
+        elif solution:
+            for var, value in sorted(solution.items(), key=str):
+                self.out.write('%s : %s\n' % (var, value))
+            self.out.write('\n')
+        else:
+            self.out.write('Yes.\n\n')
+
+    def summary(self, query, goal, status, solutions=0, inferences=0,
+                elapsed=0.0, error=None):
+        if self.format == 'jsonl':
+            record = {'query': query, 'goal': str(goal), 'status': status,
+                      'solutions': solutions, 'inferences': inferences,
+                      'elapsed': elapsed}
+            if error is not None:
+                record['error'] = error
+            self.write(record)
+        else:
+            if error is not None:
+                self.out.write('%s\n' % error)
+            elif not solutions:
+                self.out.write('No.\n')
+            self.out.write('# query %d, %s: %d solutions, %d inferences, '
+                           '%.4fs\n\n' % (query, status, solutions, inferences,
+                                           elapsed))
+        self.out.flush()
+
+    def write(self, record):
+        self.out.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def run_queries(db, lines, out, format='text', limit=1, inferences=None,
+                timeout=None, monitor=None):
+    """
+    Answer the query on each of lines against db, writing at most limit
+    solutions of each (or all of them, if limit is None) to out in format.
+    Each query may make at most `inferences` inferences and take `timeout`
+    seconds.  Returns the number of queries that failed with errors.
+    """
+    writer = BatchWriter(out, format)
+    errors = 0
+    for number, line in enumerate(lines, 1):
+        if not answer_query(db, number, line, writer, limit, inferences,
+                            timeout, monitor):
+            errors += 1
+    return errors
+
+
+def answer_query(db, number, line, writer, limit=1, inferences=None,
+                 timeout=None, monitor=None, definitions=True):
+    """
+    Answer the query on line as run_queries does, numbering it number, or
+    store the clause it defines if definitions are allowed.  Returns False
+    if there was an error.
+    """
+    if not line.strip():
+        return True
+    try:
+        q = parse(line.rstrip('\n'))
+    except (ParseError, TokenError) as e:
+        writer.summary(number, line.strip(), 'error', error=str(e))
+        return False
+    if isinstance(q, logic.Clause):
+        if definitions:
+            logic.store(db, q)
+            return True
+        writer.summary(number, q, 'error',
+                       error='Definitions are not accepted here')
+        return False
+    if q is None:
+        return True
+    budget = logic.Budget(inferences, timeout)
+    found = 0
+    try:
+        for solution in logic.solve(q, db, limit, monitor, budget):
+            found += 1
+            writer.solution(number, solution, budget.elapsed())
+    except logic.EvaluationError as e:
+        writer.summary(number, q, 'error', found, budget.inferences,
+                       budget.elapsed(), str(e))
+        return False
+    except logic.BudgetExceeded as e:
+        writer.summary(number, q, e.reason, found, e.inferences, e.elapsed,
+                       str(e))
+    else:
+        writer.summary(number, q, 'ok', found, budget.inferences,
+                       budget.elapsed())
+    return True
+
+
+## Serving queries
+
+# Starting the interpreter for each query means loading the database each
+# time.  With `--serve ADDRESS`, it loads the database once and answers
+# queries sent to it over a socket, either TCP, for an address `host:port`,
+# or a Unix domain socket, for any other address, which is the path of the
+# socket.  The queries are answered by a pool of worker processes, started
+# (by forking) once the database is loaded, so that they share its memory
+# until they change it.  Each connection is served by a thread of its own,
+# which hands its queries to the pool one at a time, so that queries from
+# different connections are answered concurrently.
+#
+# A client sends one request to a line, and the answer is written back in
+# the `jsonl` format of `--queries`, ending with the query's summary.  A
+# request is either a query, as written in the REPL, or a JSON object:
+#
+#     {"query": "?- path(a, ?x)", "id": "q1", "limit": null,
+#      "inferences": 10000, "timeout": 1.5}
+#
+# The answer is numbered with the request's `id` (a string or an integer),
+# or by its line on the connection, and `limit` is the number of solutions to
+# find (`null` for all).  The server's `--limit`, `--inferences` and
+# `--timeout` are the defaults for requests that don't give their own, and
+# the inferences and timeout are also the most any request may have.  Since
+# a query must never run unchecked, a server started without them allows
+# each query `SERVE_INFERENCES` inferences and `SERVE_TIMEOUT` seconds.  The
+# limit is only a default, since the budget already bounds what a query can
+# do.  A request that isn't valid is answered with an `error` summary, as is
+# one the workers fail to answer.  The server's database can't be changed by
+# requests, since each worker has its own copy.
+
+SERVE_INFERENCES = 10 ** 6
+SERVE_TIMEOUT = 10.0
+
+SERVER_DB = None
+
+
+def install_db(db):
+    global SERVER_DB
+    SERVER_DB = db
+
+
+def serve_request(request):
+    """Answer a request in a worker, returning the lines of the answer."""
+    number, line, limit, inferences, timeout = request
+    out = StringIO.StringIO()
+    answer_query(SERVER_DB, number, line, BatchWriter(out, 'jsonl'), limit,
+                 inferences, timeout, definitions=False)
+    return out.getvalue()
+
+
+def at_most(value, limit):
+    if value is None:
+        return limit
+    return value if limit is None else min(value, limit)
+
+
+def is_number(value, kinds=(int, long)):
+    return isinstance(value, kinds) and not isinstance(value, bool)
+
+
+def parse_request(line, number, limit, inferences, timeout):
+    """
+    Return the number, query, limit, inferences and timeout of the request on
+    line, given their defaults.  Raises ValueError if it isn't valid.
+    """
+    if not line.lstrip().startswith('{'):
+        return number, line, limit, inferences, timeout
+    request = json.loads(line)
+    if not isinstance(request, dict):
+        raise ValueError('a request must be an object')
+    query = request.get('query')
+    if not isinstance(query, basestring):
+        raise ValueError('"query" must be a string')
+    number = request.get('id', number)
+    if not (isinstance(number, basestring) or is_number(number)):
+        raise ValueError('"id" must be a string or an integer')
+    limit = request.get('limit', limit)
+    if not (limit is None or is_number(limit) and limit > 0):
+        raise ValueError('"limit" must be a positive integer or null')
+    value = request.get('inferences')
+    if not (value is None or is_number(value) and value > 0):
+        raise ValueError('"inferences" must be a positive integer')
+    inferences = at_most(value, inferences)
+    value = request.get('timeout')
+    if not (value is None or is_number(value, (int, long, float))
+            and value > 0):
+        raise ValueError('"timeout" must be a positive number of seconds')
+    timeout = at_most(value, timeout)
+    return number, query, limit, inferences, timeout
+
+
+class QueryHandler(SocketServer.StreamRequestHandler):
+
+    """Answers the requests sent over one connection."""
+
+    def handle(self):
+        server = self.server
+        count = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if not line.strip():
+                continue
+            count += 1
+            try:
+                request = parse_request(line, count, server.limit,
+                                        server.inferences, server.timeout)
+            except ValueError as e:
+                BatchWriter(self.wfile, 'jsonl').summary(
+                    count, line.strip(), 'error', error='Bad request: %s' % e)
+                continue
+            try:
+                answer = server.pool.apply(serve_request, [request])
+            except Exception as e:
+                BatchWriter(self.wfile, 'jsonl').summary(
+                    request[0], request[1].strip(), 'error',
+                    error='Failed to answer: %s' % e)
+                continue
+            self.wfile.write(answer)
+            self.wfile.flush()
+
+
+class TCPQueryServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixQueryServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def parse_address(address):
+    """Return the (host, port) of a TCP address, or a Unix socket's path."""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return host or 'localhost', int(port)
+    return address
+
+
+def serve(db, address, workers=None, limit=1, inferences=None, timeout=None):
+    """Answer queries against db sent to address, until interrupted."""
+    # The workers are forked before any threads are started.
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers, install_db, (db,))
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        server = TCPQueryServer(address, QueryHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixQueryServer(address, QueryHandler)
+    server.pool = pool
+    server.limit = limit
+    server.inferences = SERVE_INFERENCES if inferences is None else inferences
+    server.timeout = SERVE_TIMEOUT if timeout is None else timeout
+    print 'Serving queries on %s with %d workers.' % (
+        '%s:%d' % address if isinstance(address, tuple) else address,
+        workers)
+    sys.stdout.flush()
+    # Being terminated shuts the server down as an interrupt does.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        pool.terminate()
+        pool.join()
+        if not isinstance(address, tuple):
+            os.remove(address)
+
+
+class Client(object):
+
+    """A connection to a query server."""
+
+    def __init__(self, address):
+        address = parse_address(address)
+        if isinstance(address, tuple):
+            self.socket = socket.create_connection(address)
+        else:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(address)
+        self.rfile = self.socket.makefile('rb')
+        self.wfile = self.socket.makefile('wb')
+
+    def query(self, query, **options):
+        """
+        Send a query, with the options of a request, and return the records
+        of its answer, the last of which is its summary.
+        """
+        options['query'] = query
+        self.wfile.write(json.dumps(options) + '\n')
+        self.wfile.flush()
+        records = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                raise IOError('Connection closed by the server')
+            records.append(json.loads(line))
+            if 'status' in records[-1]:
+                return records
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.socket.close()
+
+
 ## Running
 
 help='''This interpreter provides basic functionality only--the subset of Prolog known
-as "Pure Prolog".  That is, only clauses are supported--no lists, user-defined
-procedures, or arithmetic evaluation.
+as "Pure Prolog", plus the cut, arithmetic and lists.  That is, only clauses,
+the control constructs and the arithmetic and list built-ins below are
+supported--no user-defined procedures.
 
 The REPL allows both rule/fact definition as well as goal proving.  The syntax
 is as follows:
@@ -326,8 +1025,86 @@ Proving goals:
 
     ?- coprime(?x, 9)
 
+The bodies of rules and queries may also use the cut (!), true and fail,
+negation (\\+ goal), disjunction ((goal ; goal)), and if-then-else
+((condition -> goal ; goal)):
+
+    <- max(?x, ?y, ?x) :- bigger(?x, ?y), !
+    <- max(?x, ?y, ?y)
+    <- single(?x) :- person(?x), \\+ married(?x)
+
+Numbers can be compared with <, >, =<, >=, =:= (equal) and =\\= (not equal),
+and `is` computes the value of an arithmetic expression using +, -, *, /, //
+(integer division), mod, min, max and abs:
+
+    <- count(nil, 0)
+    <- count(pair(?x, ?more), ?n) :- count(?more, ?m), ?n is ?m + 1
+
+`is` may also be written before its arguments, as is(?n, ?m + 1), but the
+comparisons are only written between theirs.
+
+Lists are written [a, b, c], or [a, b | ?rest] for a list beginning with a and
+b, and [] is the empty list.  The built-ins length(?list, ?n), nth(?n, ?list,
+?x) (counting from 1) and append(?x, ?y, ?xy) work on lists:
+
+    <- member(?x, [?x | ?rest])
+    <- member(?x, [?y | ?rest]) :- member(?x, ?rest)
+    ?- append(?x, [c], [a, b, c]), length(?x, ?n)
+
+Queries and rules can change the database: assertz(clause) adds a clause
+after the others for its predicate, asserta(clause) adds it before them, and
+retract(clause) removes the first clause that unifies with it.  A rule is
+written head :- body, and a running query never sees the changes it makes:
+
+    ?- assertz(grandparent(?x, ?z) :- parent(?x, ?y), parent(?y, ?z))
+    ?- retract(parent(abe, ?child))
+
 For some example rule databases, see `paip/examples/prolog`.  They can be loaded
-with the `--db` option.
+with the `--db` option, and a definition in them may span several lines.
+Large databases load much faster once compiled with `--compile`, which saves
+an image of the parsed database next to the file; the image is used from then
+on, and rebuilt whenever the file changes.  Loading it still takes as much
+memory as parsing the file does.  Left-recursive rules, like `ancestor` in the
+family tree example, only terminate if their predicate is tabled with
+`--table`.
+Large tables of facts take far less memory if their predicate is given with
+`--facts`, which stores its facts in columns rather than as clauses.
+
+Queries that take too long can be stopped with Ctrl-C, or automatically after
+a number of inferences (goals tried) with `--inferences`, or a number of
+seconds with `--timeout`.
+
+Instead of running the REPL, the interpreter can answer a file of queries, one
+to a line, with `--queries FILE` (`-` for standard input), writing the first
+solution of each, or `--limit N` of them, or with `--all` all of them.  With
+`--format jsonl`, each solution is written as a JSON object, followed by a
+summary of the query with its status, number of solutions, inferences and
+time taken:
+
+    prolog.py --db rules.prolog --queries q.txt --all --format jsonl
+
+With `--serve ADDRESS`, the interpreter loads the database once and answers
+queries sent over a socket by a pool of `--workers` processes.  The address is
+host:port for TCP, or else the path of a Unix socket.  Each line sent is a
+query, or a JSON object such as {"query": "?- likes(?x, ?y)", "limit": null,
+"timeout": 2}, and each answer is written back in the `jsonl` format.  A query
+may make at most `--inferences` inferences and take `--timeout` seconds, a
+million inferences and ten seconds unless they are given.
+`run_load_test.py` sends a server many queries at once.
+
+To find out where queries spend their time, turn on profiling with
+`profile on` (or the `--profile` option).  `profile` then prints the number of
+calls, exits, redos and failures of each predicate and clause, and the time
+spent in them, and `profile off` turns profiling off again.  Similarly,
+`trace on` prints each step taken to prove queries, until `trace off`.  The
+`--logging` option logs these steps instead.
+
+Each definition is acknowledged with the number of clauses its predicate now
+has.  To look at the database, `listing` prints all of it and `listing NAME`
+the clauses of one predicate, `clauses` prints how many clauses each
+predicate has, and `indexes` (or `indexes NAME`) prints the argument indexes
+built so far for goals with bound arguments: the number of keys in each, and
+the size of its largest bucket.
 '''
 
 argparser = argparse.ArgumentParser(description='A Prolog implementation.',
@@ -336,23 +1113,126 @@ argparser = argparse.ArgumentParser(description='A Prolog implementation.',
 
 argparser.add_argument('--logging',
                        action='store_true',
-                       help='Enable logging',
+                       help='Enable logging, including a trace of each proof',
                        dest='log')
 argparser.add_argument('--db',
                        type=file,
                        help='Database file',
                        dest='db_file')
+argparser.add_argument('--compile',
+                       action='store_true',
+                       help='Save an image of the database for fast loading, '
+                            'and exit',
+                       dest='compile')
+argparser.add_argument('--table',
+                       action='append',
+                       default=[],
+                       help='Prove goals of this predicate by tabling',
+                       metavar='PRED',
+                       dest='tabled')
+argparser.add_argument('--facts',
+                       action='append',
+                       default=[],
+                       help='Store the facts of this predicate in a table',
+                       metavar='PRED',
+                       dest='facts')
+argparser.add_argument('--queries',
+                       type=argparse.FileType('r'),
+                       help='Answer the queries in this file, one to a line, '
+                            'instead of running the REPL',
+                       metavar='FILE',
+                       dest='queries')
+argparser.add_argument('--all',
+                       action='store_const',
+                       const=None,
+                       default=1,
+                       help='Find all solutions of each query in --queries',
+                       dest='limit')
+argparser.add_argument('--limit',
+                       type=int,
+                       help='Find at most N solutions of each query in '
+                            '--queries (1 by default)',
+                       metavar='N',
+                       dest='limit')
+argparser.add_argument('--format',
+                       choices=['text', 'jsonl'],
+                       default='text',
+                       help='Format of the answers to --queries',
+                       dest='format')
+argparser.add_argument('--serve',
+                       help='Answer queries sent to this address, host:port '
+                            'or the path of a Unix socket, instead of '
+                            'running the REPL',
+                       metavar='ADDRESS',
+                       dest='serve')
+argparser.add_argument('--workers',
+                       type=int,
+                       help='Number of processes answering queries for '
+                            '--serve (one per processor by default)',
+                       metavar='N',
+                       dest='workers')
+argparser.add_argument('--profile',
+                       action='store_true',
+                       help='Profile queries',
+                       dest='profile')
+argparser.add_argument('--inferences',
+                       type=int,
+                       help='Stop queries after this many inferences',
+                       metavar='N',
+                       dest='inferences')
+argparser.add_argument('--timeout',
+                       type=float,
+                       help='Stop queries after this many seconds',
+                       metavar='SECONDS',
+                       dest='timeout')
+
+
+def monitor(*monitors):
+    monitors = [m for m in monitors if m is not None]
+    if len(monitors) > 1:
+        return logic.Monitors(monitors)
+    return monitors[0] if monitors else None
 
 
 def main():
-    print 'Welcome to PyLogic.  Type "help" for help.'
-    
     args = argparser.parse_args()
-    db = read_db(args.db_file) if args.db_file else {}
+    if args.compile:
+        if not args.db_file:
+            argparser.error('--compile needs a database file (--db)')
+        load_db(args.db_file, args.facts, compile=True)
+        print 'Compiled %s.' % (args.db_file.name + IMAGE_SUFFIX)
+        return
+
+    db = {}
+    for pred in args.facts:
+        logic.fact_table(db, pred)
+    if args.db_file:
+        db = load_db(args.db_file, args.facts)
+    for pred in args.tabled:
+        logic.table(db, pred)
+    log = None
     if args.log:
         logging.basicConfig(level=logging.DEBUG)
+        log = logic.Tracer(logic.log_trace)
+    profile = logic.Profile() if args.profile else None
+    trace = None
+
+    if args.serve:
+        serve(db, args.serve, args.workers, args.limit, args.inferences,
+              args.timeout)
+        return
+
+    if args.queries:
+        errors = run_queries(db, args.queries, sys.stdout, args.format,
+                             args.limit, args.inferences, args.timeout,
+                             monitor(log, profile))
+        if profile is not None:
+            sys.stderr.write(profile.format(db) + '\n')
+        sys.exit(1 if errors else 0)
+
+    print 'Welcome to PyLogic.  Type "help" for help.'
 
-    print_db(db)
+    print_counts(db)
     while True:
         try:
             line = raw_input('>> ')
@@ -365,6 +1245,26 @@ def main():
         if line == 'help':
             print help
             continue
+        if line == 'profile':
+            if profile is None:
+                print 'Profiling is off.'
+            else:
+                print profile.format(db)
+            continue
+        if line == 'profile on':
+            profile = logic.Profile()
+            continue
+        if line == 'profile off':
+            profile = None
+            continue
+        if line == 'trace on':
+            trace = logic.Tracer(logic.print_trace)
+            continue
+        if line == 'trace off':
+            trace = None
+            continue
+        if inspect(db, line):
+            continue
         try:
             q = parse(line)
         except ParseError as e:
@@ -375,13 +1275,22 @@ def main():
             continue
 
         if isinstance(q, logic.Relation):
+            budget = None
+            if args.inferences is not None or args.timeout is not None:
+                budget = logic.Budget(args.inferences, args.timeout)
             try:
-                logic.prolog_prove([q], db)
+                logic.prolog_prove([q], db, monitor(log, trace, profile),
+                                   budget)
             except KeyboardInterrupt:
                 print 'Cancelled.'
+            except logic.EvaluationError as e:
+                print e
+            except logic.BudgetExceeded as e:
+                print e
         elif isinstance(q, logic.Clause):
             logic.store(db, q)
-            print_db(db)
+            print 'Defined %s: %s.' % (q.head.pred,
+                                       describe(db[q.head.pred]))
 
     print 'Goodbye.'
 
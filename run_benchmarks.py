@@ -0,0 +1,228 @@
+"""
+Time the logic programming library.
+
+Run all the benchmarks with `python run_benchmarks.py`, or only some of them
+by giving their names as arguments.
+"""
+
+import sys
+import timeit
+
+from paip import logic
+
+
+def chain_db(n):
+    """A database of n links in a chain, and the paths along it."""
+    x = logic.Var('x')
+    y = logic.Var('y')
+    z = logic.Var('z')
+    db = {}
+    for i in xrange(n):
+        logic.store(db, logic.Clause(logic.Relation(
+            'linked', (logic.Atom(i), logic.Atom(i + 1)))))
+    logic.store(db, logic.Clause(logic.Relation('path', (x, y)),
+                                 [logic.Relation('linked', (x, y))]))
+    logic.store(db, logic.Clause(logic.Relation('path', (x, y)),
+                                 [logic.Relation('linked', (x, z)),
+                                  logic.Relation('path', (z, y))]))
+    return db
+
+
+def report(name, seconds, baseline=None):
+    if baseline:
+        print '%-40s %8.3fs %7.2fx' % (name, seconds, seconds / baseline)
+    else:
+        print '%-40s %8.3fs' % (name, seconds)
+
+
+def best_of(f, repeat=3):
+    return min(timeit.repeat(f, number=1, repeat=repeat))
+
+
+## Benchmarks
+
+def tracing():
+    """The overhead of monitoring a proof, of tracing it, and of a budget."""
+    db = chain_db(200)
+    goal = logic.Relation('path', (logic.Atom(0), logic.Var('y')))
+
+    def run(monitor):
+        return lambda: list(logic.solve(goal, db, monitor=monitor))
+
+    off = best_of(run(None))
+    report('all paths, no monitor', off)
+    report('all paths, tracing to a null sink',
+           best_of(run(logic.Tracer(lambda event: None))), off)
+    report('all paths, profiling', best_of(run(logic.Profile())), off)
+    report('all paths, with a budget',
+           best_of(lambda: list(logic.solve(goal, db, budget=logic.Budget(
+               inferences=10 ** 9, timeout=60)))), off)
+
+def unify():
+    """Unifying terms with plain dictionaries of bindings."""
+    x = logic.Var('x')
+    y = logic.Var('y')
+    a = logic.Relation('pair', (x, logic.Relation('pair', (y, x))))
+    b = logic.Relation('pair', (logic.Atom(1), logic.Var('z')))
+    bindings = dict((logic.Var('v%d' % i), logic.Atom(i)) for i in xrange(50))
+
+    def run():
+        for i in xrange(10000):
+            logic.unify(a, b, bindings)
+    report('10000 unifications', best_of(run))
+
+def lists():
+    """Finding the length of a list, as pairs and as a native list."""
+    n = 1000
+    x = logic.Var('x')
+    more = logic.Var('more')
+    m = logic.Var('m')
+    db = {}
+    logic.store(db, logic.Clause(logic.Relation(
+        'count', (logic.Atom('nil'), logic.Atom(0)))))
+    logic.store(db, logic.Clause(
+        logic.Relation('count', (logic.Relation('pair', (x, more)), m)),
+        [logic.Relation('count', (more, x)),
+         logic.Relation('is', (m, logic.Relation('+', (x, logic.Atom(1)))))]))
+    pairs = logic.Atom('nil')
+    for i in xrange(n):
+        pairs = logic.Relation('pair', (logic.Atom(i), pairs))
+    items = logic.List(logic.Atom(i) for i in xrange(n))
+
+    def run(goal):
+        return lambda: logic.first(goal, db)
+    pairs_time = best_of(run(logic.Relation('count', (pairs, x))))
+    report('count %d pairs' % n, pairs_time)
+    report('length of a %d element list' % n,
+           best_of(run(logic.Relation('length', (items, x)))), pairs_time)
+    report('element %d of a %d element list' % (n, n),
+           best_of(run(logic.Relation('nth', (logic.Atom(n), items, x)))),
+           pairs_time)
+
+def parallel():
+    """Generate and test, sequentially and with a pool of processes."""
+    from paip import parallel
+    x = logic.Var('x')
+    n = logic.Var('n')
+    m = logic.Var('m')
+    db = {}
+    for i in xrange(16):
+        logic.store(db, logic.Clause(logic.Relation('candidate',
+                                                    (logic.Atom(i),))))
+    logic.store(db, logic.Clause(logic.Relation('spin', (logic.Atom(0),))))
+    logic.store(db, logic.Clause(
+        logic.Relation('spin', (n,)),
+        [logic.Relation('>', (n, logic.Atom(0))),
+         logic.Relation('is', (m, logic.Relation('-', (n, logic.Atom(1))))),
+         logic.Relation('spin', (m,))]))
+    goals = [logic.Relation('candidate', (x,)),
+             logic.Relation('spin', (logic.Atom(500),))]
+    sequential = best_of(lambda: list(logic.solve(goals, db)))
+    report('16 candidates, sequentially', sequential)
+    pool = parallel.ProverPool(db)
+    report('16 candidates, %d processes' % len(pool.pool._pool),
+           best_of(lambda: list(pool.solve(goals))), sequential)
+    pool.close()
+
+def batch():
+    """Many queries against one database, one at a time and as a batch."""
+    db = chain_db(50)
+    logic.table(db, 'path')
+    y = logic.Var('y')
+    queries = [logic.Relation('path', (logic.Atom(i % 50), y))
+               for i in xrange(100)]
+    separately = best_of(lambda: [list(logic.solve(query, db))
+                                  for query in queries])
+    report('100 queries, one at a time', separately)
+    report('100 queries, as a batch',
+           best_of(lambda: list(logic.solve_many(queries, db))), separately)
+
+
+def cache():
+    """Asking the same query again, with and without an answer cache."""
+    db = chain_db(200)
+    goal = logic.Relation('path', (logic.Atom(0), logic.Var('y')))
+    answers = logic.AnswerCache(db)
+    list(answers.solve(goal))
+    uncached = best_of(lambda: list(logic.solve(goal, db)))
+    report('all paths', uncached)
+    report('all paths, cached', best_of(lambda: list(answers.solve(goal))),
+           uncached)
+
+
+def facts():
+    """Storing and querying ground facts as clauses and in a fact table."""
+    n = 100000
+    x = logic.Var('x')
+    facts = [logic.Clause(logic.Relation('linked', (logic.Atom(i % 1000),
+                                                    logic.Atom(i))))
+             for i in xrange(n)]
+
+    def load(table):
+        db = {}
+        if table:
+            logic.fact_table(db, 'linked')
+        for fact in facts:
+            logic.store(db, fact)
+        return db
+
+    def query(db):
+        goals = [logic.Relation('linked', (logic.Atom(i), x))
+                 for i in xrange(0, 1000, 10)]
+        return lambda: [list(logic.solve(goal, db)) for goal in goals]
+
+    clauses = best_of(lambda: load(False))
+    report('store %d facts as clauses' % n, clauses)
+    report('store %d facts in a table' % n, best_of(lambda: load(True)),
+           clauses)
+    clauses = best_of(query(load(False)))
+    report('100 lookups in clauses', clauses)
+    report('100 lookups in a table', best_of(query(load(True))), clauses)
+
+
+def lexer():
+    """Tokenizing, with the old and new lexers, and parsing, in MB/s."""
+    import prolog
+    from paip.tests import reference_lexer
+    lines = []
+    for i in xrange(20000):
+        lines.append('<- linked(node%d, node%d, %d.5)  # edge %d\n' %
+                     (i, i + 1, i % 97, i))
+        lines.append('<- path(?x, [?y | ?rest]) :- linked(?x, ?z, ?w), '
+                     '?w >= %d, path(?z, ?rest)\n' % (i % 13))
+    text = ''.join(lines)
+    megabytes = len(text) / float(1 << 20)
+
+    def throughput(name, seconds, baseline=None):
+        rate = megabytes / seconds
+        if baseline:
+            print '%-40s %8.2fMB/s %5.2fx' % (name, rate, rate / baseline)
+        else:
+            print '%-40s %8.2fMB/s' % (name, rate)
+        return rate
+
+    old = throughput('tokenize %.1fMB, old lexer' % megabytes,
+                     best_of(lambda: list(reference_lexer.tokens(text))))
+    tokens = throughput('tokenize %.1fMB' % megabytes,
+                        best_of(lambda: list(prolog.tokens(text))), old)
+    throughput('tokenize and parse %.1fMB, by line' % megabytes,
+               best_of(lambda: [prolog.parse(line) for line in lines]),
+               tokens)
+    throughput('consult %.1fMB' % megabytes,
+               best_of(lambda: prolog.consult(iter(lines))), tokens)
+
+
+BENCHMARKS = [tracing, unify, lists, parallel, batch, cache, facts, lexer]
+
+
+def main(names):
+    for benchmark in BENCHMARKS:
+        if names and benchmark.__name__ not in names:
+            continue
+        print '%s: %s' % (benchmark.__name__, benchmark.__doc__)
+        benchmark()
+        print
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,110 @@
+"""
+Load test a Prolog query server.
+
+Start a server with, say,
+
+    python prolog.py --db paip/examples/prolog/family.prolog --serve /tmp/prolog
+
+and then send it queries from many connections at once with
+
+    python run_load_test.py /tmp/prolog --connections 8 --requests 100 \\
+        --query '?- lineage(?x, ?y)' --all
+
+Each connection sends its requests one after another, cycling through the
+queries given, and the throughput and latencies of all of them are reported.
+"""
+
+import argparse
+import threading
+import timeit
+
+import prolog
+
+
+parser = argparse.ArgumentParser(description='Load test a query server.')
+parser.add_argument('address',
+                    help='The server address, host:port or a Unix socket')
+parser.add_argument('--connections', type=int, default=4,
+                    help='Number of concurrent connections')
+parser.add_argument('--requests', type=int, default=100,
+                    help='Number of requests sent on each connection')
+parser.add_argument('--query', action='append', default=[], dest='queries',
+                    help='A query to send (may be repeated)')
+parser.add_argument('--queries', type=argparse.FileType('r'), dest='file',
+                    help='A file of queries to send, one to a line')
+parser.add_argument('--all', action='store_true',
+                    help='Ask for all solutions of each query')
+parser.add_argument('--timeout', type=float,
+                    help='Timeout of each query in seconds')
+
+
+def connection(address, queries, requests, options, latencies, statuses):
+    """
+    Send requests on a new connection, recording the latency and status of
+    each in latencies and statuses.
+    """
+    client = prolog.Client(address)
+    try:
+        for i in xrange(requests):
+            start = timeit.default_timer()
+            records = client.query(queries[i % len(queries)], **options)
+            latencies.append(timeit.default_timer() - start)
+            status = records[-1]['status']
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        client.close()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main():
+    args = parser.parse_args()
+    queries = list(args.queries)
+    if args.file:
+        queries.extend(line.strip() for line in args.file if line.strip())
+    if not queries:
+        parser.error('no queries given')
+    options = {}
+    if args.all:
+        options['limit'] = None
+    if args.timeout is not None:
+        options['timeout'] = args.timeout
+
+    # Each thread counts its own requests, and the counts are added up once
+    # they are all done.
+    results = [([], {}) for i in xrange(args.connections)]
+    threads = [threading.Thread(target=connection,
+                                args=(args.address, queries, args.requests,
+                                      options, latencies, statuses))
+               for latencies, statuses in results]
+    start = timeit.default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = timeit.default_timer() - start
+
+    latencies = []
+    statuses = {}
+    for thread_latencies, thread_statuses in results:
+        latencies.extend(thread_latencies)
+        for status, count in thread_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    latencies.sort()
+    if not latencies:
+        print 'No requests were answered.'
+        return
+    print '%d requests in %.3fs: %.1f requests/s' % (
+        len(latencies), elapsed, len(latencies) / elapsed)
+    print 'latency (ms): median %.2f, 90%% %.2f, 99%% %.2f, max %.2f' % tuple(
+        1000 * x for x in (percentile(latencies, 0.5),
+                           percentile(latencies, 0.9),
+                           percentile(latencies, 0.99), latencies[-1]))
+    print 'statuses: %s' % ', '.join('%s %d' % item
+                                     for item in sorted(statuses.items()))
+
+
+if __name__ == '__main__':
+    main()